@@ -0,0 +1,39 @@
+"""
+      Benchmark of ray tracing speed through a Cooke triplet, giving rays / second
+      for the general SurfaceInteraction tracing and the fast in place tracing.
+"""
+
+from poptics.lens import DataBaseLens
+from poptics.ray import RayPencil,setFastTrace
+from poptics.vector import Unit3d,Angle
+from poptics.tio import tprint
+import time
+
+def trace(lens,u,nrays,fast):
+    """
+    Trace a pencil through the lens to the back focal plane and return rays / second
+    """
+    setFastTrace(fast)
+    pencil = RayPencil().addBeam(lens,u,"array",nrays,path = True)
+    bf = lens.backFocalPlane()
+    start = time.perf_counter()
+    pencil *= lens
+    pencil *= bf
+    return len(pencil)/(time.perf_counter() - start)
+
+
+def main():
+
+    #      Cooke triplet from the database (Cooke.lens is in the old format)
+    lens = DataBaseLens("Cooke-F6.3.lens")
+    u = Unit3d(Angle().setDegrees(5.0))
+    nrays = 50
+
+    slow = trace(lens,u,nrays,False)
+    fast = trace(lens,u,nrays,True)
+    tprint("General tracing : ",int(slow)," rays / second")
+    tprint("Fast tracing : ",int(fast)," rays / second")
+    tprint("Speed up : ",fast/slow)
+
+
+main()
@@ -12,6 +12,13 @@ from poptics.vector import Vector2d,Vector3d,Unit3d,Angle
 import matplotlib.pyplot as plt
 import numpy as np
 import math
+from concurrent.futures import ProcessPoolExecutor
+
+"""
+Number of image elements in each tile when accumulating rays into large images, so the temporary arrays never
+exceed one tile.
+"""
+ImageTileSize = 4194304
 
 class TargetPlane(ImagePlane):
     """
@@ -182,6 +189,134 @@ class TargetPlane(ImagePlane):
         plt.plot(xpt,ypt,linestyle='none',color=col,marker='x')
 
 
+def accumulatePixels(image,fx,fy,weights,channel = None,mode = "nearest"):
+    """
+    Function to add weights to an image at fractional pixel coordinates, where pixel (i,j) is centred on (i,j). All the points
+    are binned together with np.bincount, or np.add.at for a small number of points in a large image. Points outside the
+    image, or with NaN coordinates, are ignored.
+
+    :param image: the image, updated in place
+    :type image: np.ndarray (xpixel,ypixel) or (xpixel,ypixel,channels)
+    :param fx: the x pixel coordinates
+    :type fx: np.ndarray
+    :param fy: the y pixel coordinates
+    :type fy: np.ndarray
+    :param weights: the weights, normally the ray intensities
+    :type weights: np.ndarray
+    :param channel: the colour channel of each point for a three dimensional image (Default = None)
+    :type channel: np.ndarray or int or None
+    :param mode: "nearest" to add to the nearest pixel, or "bilinear" to split between the four nearest pixels (Default = "nearest")
+    :type mode: str
+    :return: the image
+    """
+    nx,ny = image.shape[0],image.shape[1]
+    nc = image.shape[2] if image.ndim == 3 else 1
+    fx = np.asarray(fx,dtype = float)
+    fy = np.asarray(fy,dtype = float)
+    weights = np.broadcast_to(np.asarray(weights,dtype = float),fx.shape)
+    channel = np.broadcast_to(np.asarray(0 if channel is None else channel,dtype = int),fx.shape)
+
+    if mode == "nearest":
+        corners = [(np.rint(fx),np.rint(fy),weights)]
+    elif mode == "bilinear":
+        i = np.floor(fx)
+        j = np.floor(fy)
+        tx = fx - i
+        ty = fy - j
+        corners = [(i,j,(1.0 - tx)*(1.0 - ty)*weights),(i + 1,j,tx*(1.0 - ty)*weights),\
+                   (i,j + 1,(1.0 - tx)*ty*weights),(i + 1,j + 1,tx*ty*weights)]
+    else:
+        raise ValueError("analysis.accumulatePixels: unknown mode {0:s}".format(str(mode)))
+
+    index = []
+    values = []
+    for i,j,w in corners:
+        ok = (i >= 0) & (i < nx) & (j >= 0) & (j < ny)          # In image, will also catch NaN
+        index.append((i[ok].astype(int)*ny + j[ok].astype(int))*nc + channel[ok])
+        values.append(w[ok])
+    index = np.concatenate(index)
+    values = np.concatenate(values)
+
+    if len(index) < image.size//8 and image.flags.c_contiguous:
+        np.add.at(image.reshape(-1),index,values)                # Few points, so add in place
+    elif image.size <= ImageTileSize or not image.flags.c_contiguous:
+        image += np.bincount(index,values,minlength = image.size).reshape(image.shape)
+    else:
+        #        Large image, so sort the points into tiles and bin each tile in turn
+        flat = image.reshape(-1)
+        order = np.argsort(index,kind = "stable")              # Stable, so same sums as a single bincount
+        index = index[order]
+        values = values[order]
+        bounds = np.searchsorted(index,np.arange(0,image.size + ImageTileSize,ImageTileSize))
+        for k in range(len(bounds) - 1):
+            low,high = bounds[k],bounds[k + 1]
+            if high > low:
+                start = k*ImageTileSize
+                counts = np.bincount(index[low:high] - start,values[low:high])
+                flat[start:start + len(counts)] += counts
+    return image
+
+
+def makeImageBuffer(shape,filename = None):
+    """
+    Function to make a zeroed image buffer, either in memory or as a np.memmap backed by a file, so that images larger than
+    the available memory can be accumulated with the pages written to disc as needed.
+
+    :param shape: shape of the image
+    :type shape: tuple
+    :param filename: name of the file to back the image, this will be overwritten (Default = None, image in memory)
+    :type filename: str or None
+    :return: np.ndarray or np.memmap
+    """
+    if filename == None:
+        return np.zeros(shape,dtype = float)
+    else:
+        return np.memmap(filename,dtype = float,mode = "w+",shape = shape)     # New file is zero filled
+
+
+def accumulatePixel(image,fx,fy,weight,channel = None,mode = "nearest"):
+    """
+    Function to add a weight to an image at a single fractional pixel coordinate, being the scalar version of
+    accumulatePixels() used when tracing single rays.
+
+    :param image: the image, updated in place
+    :type image: np.ndarray (xpixel,ypixel) or (xpixel,ypixel,channels)
+    :param fx: the x pixel coordinate
+    :type fx: float
+    :param fy: the y pixel coordinate
+    :type fy: float
+    :param weight: the weight
+    :type weight: float
+    :param channel: the colour channel for a three dimensional image (Default = None)
+    :type channel: int or None
+    :param mode: "nearest" or "bilinear" (Default = "nearest")
+    :type mode: str
+    :return: the image
+    """
+    if math.isnan(fx) or math.isnan(fy):
+        return image
+    if mode == "nearest":
+        corners = [(round(fx),round(fy),weight)]
+    elif mode == "bilinear":
+        i = math.floor(fx)
+        j = math.floor(fy)
+        tx = fx - i
+        ty = fy - j
+        corners = [(i,j,(1.0 - tx)*(1.0 - ty)*weight),(i + 1,j,tx*(1.0 - ty)*weight),\
+                   (i,j + 1,(1.0 - tx)*ty*weight),(i + 1,j + 1,tx*ty*weight)]
+    else:
+        raise ValueError("analysis.accumulatePixel: unknown mode {0:s}".format(str(mode)))
+
+    nx,ny = image.shape[0],image.shape[1]
+    for i,j,w in corners:
+        if i >= 0 and i < nx and j >= 0 and j < ny:        # Check in image (due to distortions it may not be)
+            if channel == None:
+                image[i,j] += w
+            else:
+                image[i,j,channel] += w
+    return image
+
+
 class OpticalImage(ImagePlane):
     """
     Class to hold an image in a plane with a sampling grid. The actual image is held in a numpy array.
@@ -198,11 +333,15 @@ class OpticalImage(ImagePlane):
     :type xsize: float
     :param ysize: y size of plane (Default = 200)
     :type ysize: float
+    :param filename: file to hold the image as a np.memmap (Default = None, image held in memory)
+    :type filename: str or None
 
-
+    Rays reaching the image add their intensity to the nearest pixel, or are split between the four nearest pixels, see
+    setDeposit(). A RayBundle adds all its rays with one call of recordRays(). For a file backed image
+    flush() writes the image to the file.
     """
 
-    def __init__(self,pt = 0.0  ,xpixel = 256, ypixel = None, xsize = 200, ysize = None):
+    def __init__(self,pt = 0.0  ,xpixel = 256, ypixel = None, xsize = 200, ysize = None, filename = None):
         """
         Form the OpticalImage with either blank array of nmpy image array
         """
@@ -217,10 +356,11 @@ class OpticalImage(ImagePlane):
         if isinstance(xpixel,int):
             if ypixel == None:
                 ypixel = xpixel
-            self.image = np.zeros((xpixel,ypixel),dtype = float)  # Make array of zeros.
+            self.image = makeImageBuffer((xpixel,ypixel),filename)  # Make array of zeros.
         else:
             self.image = xpixel                             # assume numpy array given
         self.xpixel,self.ypixel = self.image.shape          # set xpixel and ypixel from image data
+        self.deposit = "nearest"
 
 
     def __str__(self):
@@ -248,6 +388,63 @@ class OpticalImage(ImagePlane):
         return self.getSourcePoint(x,y,self.image[i,j])
 
 
+    def setDeposit(self,mode = "nearest"):
+        """
+        Set how rays are added to the image.
+
+        :param mode: "nearest" to add to the nearest pixel, or "bilinear" to split between the four nearest pixels (Default = "nearest")
+        :type mode: str
+        :return: self
+        """
+        if not mode in ("nearest","bilinear"):
+            raise ValueError("analysis.OpticalImage.setDeposit: unknown mode {0:s}".format(str(mode)))
+        self.deposit = mode
+        return self
+
+
+    def flush(self):
+        """
+        Write a file backed image to its file, does nothing for an image held in memory.
+
+        :return: self
+        """
+        if isinstance(self.image,np.memmap):
+            self.image.flush()
+        return self
+
+
+    def addTile(self,tile,i = 0,j = 0):
+        """
+        Add a tile of pixel values to the image, so a large image can be rendered a tile at a time.
+
+        :param tile: the pixel values, with the same number of channels as the image
+        :type tile: np.ndarray
+        :param i: x pixel of the corner of the tile (Default = 0)
+        :type i: int
+        :param j: y pixel of the corner of the tile (Default = 0)
+        :type j: int
+        :return: self
+        """
+        self.image[i:i + tile.shape[0],j:j + tile.shape[1]] += tile
+        return self
+
+
+    def getPixelCoordinates(self,x,y):
+        """
+        Get the fractional pixel coordinates of points in global coordinates, where pixel (i,j) is centred on (i,j).
+
+        :param x: x positions
+        :type x: float or np.ndarray
+        :param y: y positions
+        :type y: float or np.ndarray
+        :return: fx,fy
+        """
+        pt = self.getPoint()
+        fx = self.xpixel*(x + self.xsize/2 - pt.x)/self.xsize
+        fy = self.ypixel*(y + self.ysize/2 - pt.y)/self.ysize
+        return fx,fy
+
+
     def getSurfaceInteraction(self,r):
         """
         Method to get back the surface interaction information for a ray and also add the ray to the image
@@ -259,18 +456,48 @@ class OpticalImage(ImagePlane):
 
         #       get interaction with super class
         info = ImagePlane.getSurfaceInteraction(self,r)
+        self.recordRay(info.position,r.intensity,r.wavelength)
+        return info
 
-        #            Add ray to pixel
-        if not math.isnan(info.position.x) or not math.isnan(info.position.y) :
-            i = int(round(self.xpixel*(info.position.x + self.xsize/2 - info.point.x)/self.xsize))
-            j = int(round(self.ypixel*(info.position.y + self.ysize/2 - info.point.y)/self.ysize))
 
-            #          Check if pixel is in image (note due to distrortions it may not be)
-            if i >= 0 and i < self.xpixel and j >=0 and j < self.ypixel:
-                self.image[i,j] += r.intensity               # Add it to the image
+    def getBatchInteraction(self,positions,directors,point = None):
+        """
+        Get the surface interaction for arrays of rays, the rays are added to the image by recordRays() which
+        is called by poptics.ray.RayBundle, which has the intensities.
+        """
+        return ImagePlane.getBatchInteraction(self,positions,directors,point)
 
-        #          Retun info to calling object
-        return info
+
+    def recordRay(self,position,intensity,wavelength = None):
+        """
+        Add a single ray at a position on the image.
+
+        :param position: the position in global coordinates
+        :type position: Vector3d
+        :param intensity: the intensity
+        :type intensity: float
+        :param wavelength: the wavelength, not used for a monochrome image (Default = None)
+        :type wavelength: float
+        """
+        fx,fy = self.getPixelCoordinates(position.x,position.y)
+        accumulatePixel(self.image,fx,fy,intensity,None,self.deposit)
+
+
+    def recordRays(self,positions,intensities,wavelengths = None):
+        """
+        Add arrays of rays to the image, being the batched version of recordRay().
+
+        :param positions: the positions in global coordinates
+        :type positions: np.ndarray (N,3)
+        :param intensities: the intensities
+        :type intensities: np.ndarray (N,)
+        :param wavelengths: the wavelengths, not used for a monochrome image (Default = None)
+        :type wavelengths: np.ndarray or None
+        :return: self
+        """
+        fx,fy = self.getPixelCoordinates(positions[:,0],positions[:,1])
+        accumulatePixels(self.image,fx,fy,intensities,None,self.deposit)
+        return self
 
 
     def getRayPencil(self,ca,i,j,nrays = 5,wavelength = None):
@@ -297,7 +524,7 @@ class OpticalImage(ImagePlane):
         else:
             return ray.RayPencil().addBeam(ca,source,"array",nrays,wavelength)
 
-    def getImage(self, lens, ip, nrays = 5, wavelength = None):
+    def getImage(self, lens, ip, nrays = 5, wavelength = None, filename = None):
         """
         Method to get the image of OpticalPlane where the image localion is specifed
         by the supplied ImagePlane.
@@ -306,11 +533,13 @@ class OpticalImage(ImagePlane):
         :param ip: ImagePlane
         :param nrays: number of rays on radius
         :param wave: wavelength of imaging (to do the actual tracing)
+        :param filename: file to hold the image as a np.memmap (Default = None, image held in memory)
+        :type filename: str or None
         :return: OpticalImage with same pixel resolution as the object
 
         """
 
-        image = OpticalImage(ip,self.xpixel,self.ypixel)      # Form image
+        image = OpticalImage(ip,self.xpixel,self.ypixel,filename = filename)      # Form image
 
         #
         #            Go through each pixel in turn and progate it.
@@ -323,9 +552,9 @@ class OpticalImage(ImagePlane):
                     pencil *= lens
                     pencil *= image
 
-        return image                                 # Return the image
+        return image.flush()                         # Return the image
 
-    def getSystemImage(self,lens,mag,nrays = 5, wavelength = None, design = None):
+    def getSystemImage(self,lens,mag,nrays = 5, wavelength = None, design = None, filename = None):
         """
         Method to get the image of the object plane from and imaging system with specified lens and magnification.
         The location of the object and image planes are given by paraxial optics using the design wavelength.
@@ -339,6 +568,8 @@ class OpticalImage(ImagePlane):
         :param wave: wavelength of rays in simulation (Default = optics.wavelength.Default)
         :type wave: float
         :param design: wavelength used for the paraxial location of the planes (Default = None) (same as wave)
+        :param filename: file to hold the image as a np.memmap (Default = None, image held in memory)
+        :type filename: str or None
 
         """
         design = getDefaultWavelength(design)
@@ -347,7 +578,7 @@ class OpticalImage(ImagePlane):
         obj,ima = lens.planePair(mag,self.xsize,self.ysize,design)
         self.setPoint(obj.point)        # Set self to correct location
 
-        im = self.getImage(lens,ima,nrays,wavelength)     # get the image
+        im = self.getImage(lens,ima,nrays,wavelength,filename)     # get the image
 
         return im
 
@@ -394,9 +625,11 @@ class OpticalImage(ImagePlane):
 
 class ColourImage(ImagePlane):
     """
-    Class to hold a colour (rbg) image, with the colour image held as three-D numpy array
+    Class to hold a colour (rbg) image, with the colour image held as three-D numpy array, which may be
+    held in a file as a np.memmap if filename is given, see OpticalImage.
     """
-    def __init__(self,pt =  Vector3d() ,xpixel = 256, ypixel = None, xsize = 200, ysize = None, wave = TriColour):
+    def __init__(self,pt =  Vector3d() ,xpixel = 256, ypixel = None, xsize = 200, ysize = None, wave = TriColour,\
+                 filename = None):
         """
         Form the OpticalImage with either blank array of nmpy image array
         """
@@ -411,11 +644,51 @@ class ColourImage(ImagePlane):
         if isinstance(xpixel,int):
             if ypixel == None:
                 ypixel = xpixel
-            self.image = np.zeros((xpixel,ypixel,3))  # Make array of zeros.
+            self.image = makeImageBuffer((xpixel,ypixel,3),filename)  # Make array of zeros.
         else:
             self.image = xpixel                             # assume numpy array given
         self.xpixel,self.ypixel,c = self.image.shape          # set xpixel and ypixel from image data
         self.wavelengths = wave
+        self.deposit = "nearest"
+
+
+    def setDeposit(self,mode = "nearest"):
+        """
+        Set how rays are added to the image, see OpticalImage.setDeposit().
+        """
+        return OpticalImage.setDeposit(self,mode)
+
+
+    def getPixelCoordinates(self,x,y):
+        """
+        Get the fractional pixel coordinates of points in global coordinates, see OpticalImage.getPixelCoordinates().
+        """
+        return OpticalImage.getPixelCoordinates(self,x,y)
+
+
+    def flush(self):
+        """
+        Write a file backed image to its file, see OpticalImage.flush().
+        """
+        return OpticalImage.flush(self)
+
+
+    def addTile(self,tile,i = 0,j = 0):
+        """
+        Add a tile of pixel values to the image, see OpticalImage.addTile().
+        """
+        return OpticalImage.addTile(self,tile,i,j)
+
+
+    def getChannel(self,wavelength):
+        """
+        Get the colour channel for a wavelength, being 0 or 1 for the first two of TriColour and 2 otherwise.
+
+        :param wavelength: the wavelength
+        :type wavelength: float or np.ndarray
+        :return: the channel as int or np.ndarray
+        """
+        return np.where(wavelength == TriColour[0],0,np.where(wavelength == TriColour[1],1,2))
 
 
     def getSurfaceInteraction(self,r):
@@ -429,25 +702,51 @@ class ColourImage(ImagePlane):
 
         #       get interaction with super class
         info = ImagePlane.getSurfaceInteraction(self,r)
-
-        #            Add ray to pixel
-        if not math.isnan(info.position.x) or not math.isnan(info.position.y) :
-            i = int(round(self.xpixel*(info.position.x + self.xsize/2 - info.point.x)/self.xsize))
-            j = int(round(self.ypixel*(info.position.y + self.ysize/2 - info.point.y)/self.ysize))
-
-            #          Check if pixel is in image (note due to distrortions it may not be)
-            if i >= 0 and i < self.xpixel and j >=0 and j < self.ypixel:
-                if r.wavelength == TriColour[0]:
-                    self.image[i,j,0] += r.intensity               # Add it to the image
-                elif r.wavelength == TriColour[1]:
-                    self.image[i,j,1] += r.intensity               # Add it to the image
-                else:
-                    self.image[i,j,2] += r.intensity
-
-        #          Retun info to calling object
+        self.recordRay(info.position,r.intensity,r.wavelength)
         return info
 
 
+    def getBatchInteraction(self,positions,directors,point = None):
+        """
+        Get the surface interaction for arrays of rays, the rays are added to the image by recordRays() which
+        is called by poptics.ray.RayBundle, which has the intensities.
+        """
+        return ImagePlane.getBatchInteraction(self,positions,directors,point)
+
+
+    def recordRay(self,position,intensity,wavelength):
+        """
+        Add a single ray at a position on the image to the colour channel of its wavelength.
+
+        :param position: the position in global coordinates
+        :type position: Vector3d
+        :param intensity: the intensity
+        :type intensity: float
+        :param wavelength: the wavelength
+        :type wavelength: float
+        """
+        fx,fy = self.getPixelCoordinates(position.x,position.y)
+        accumulatePixel(self.image,fx,fy,intensity,int(self.getChannel(wavelength)),self.deposit)
+
+
+    def recordRays(self,positions,intensities,wavelengths):
+        """
+        Add arrays of rays to the image with each in the colour channel of its wavelength, being the batched version
+        of recordRay().
+
+        :param positions: the positions in global coordinates
+        :type positions: np.ndarray (N,3)
+        :param intensities: the intensities
+        :type intensities: np.ndarray (N,)
+        :param wavelengths: the wavelengths
+        :type wavelengths: np.ndarray (N,)
+        :return: self
+        """
+        fx,fy = self.getPixelCoordinates(positions[:,0],positions[:,1])
+        accumulatePixels(self.image,fx,fy,intensities,self.getChannel(wavelengths),self.deposit)
+        return self
+
+
     def getPixelSourcePoint(self,i,j,plane):
         """
         Get pixel as i,j as a SourcePoint.
@@ -496,7 +795,7 @@ class ColourImage(ImagePlane):
             return rp
 
 
-    def getImage(self, lens, ip, nrays = 5):
+    def getImage(self, lens, ip, nrays = 5, filename = None):
         """
         Method to get the image of OpticalPlane where the image localion is specifed
         by the supplied ImagePlane.
@@ -504,11 +803,13 @@ class ColourImage(ImagePlane):
         :param lens: the lens system
         :param ip: ImagePlane
         :param nrays: number of rays on radius
+        :param filename: file to hold the image as a np.memmap (Default = None, image held in memory)
+        :type filename: str or None
         :return: OpticalImage with same pixel resolution as the object
 
         """
 
-        image = ColourImage(ip,self.xpixel,self.ypixel)      # Form image
+        image = ColourImage(ip,self.xpixel,self.ypixel,filename = filename)      # Form image
 
         #
         #            Go through each pixel in turn and progate it.
@@ -523,9 +824,9 @@ class ColourImage(ImagePlane):
 
         imax = np.amax(image.image)
         image.image /= imax
-        return image                                 # Return the image
+        return image.flush()                         # Return the image
 
-    def getSystemImage(self,lens,mag,nrays = 5, wave = Default, design = None):
+    def getSystemImage(self,lens,mag,nrays = 5, wave = Default, design = None, filename = None):
         """
         Method to get the image of the object plane from and imaging system with specified lens and magnification.
         The location of the object and image planes are given by paraxial optics using the design wavelength.
@@ -539,6 +840,8 @@ class ColourImage(ImagePlane):
         :param wave: wavelength of rays in simulation (Default = optics.wavelength.Default)
         :type wave: float
         :param design: wavelength used for the paraxial location of the planes (Default = None) (same as wave)
+        :param filename: file to hold the image as a np.memmap (Default = None, image held in memory)
+        :type filename: str or None
 
         """
         if design == None:
@@ -548,7 +851,7 @@ class ColourImage(ImagePlane):
         obj,ima = lens.planePair(mag,self.xsize,self.ysize,design)
         self.setPoint(obj.point)        # Set self to correct location
 
-        im = self.getImage(lens,ima,nrays)     # get the image
+        im = self.getImage(lens,ima,nrays,filename)     # get the image
 
         return im
 
@@ -598,7 +901,7 @@ class SphericalOpticalImage(SphericalImagePlane,OpticalImage):
     """
 
     def __init__(self,pt = None,curve = 0.0, xpixel = 256, ypixel = None,\
-                 xsize = 200.0, ysize = None):
+                 xsize = 200.0, ysize = None, filename = None):
         """
         Form the OpticalImage with either blank array of nmpy image array
         param pt the plane point (default = None,(0,0,0))
@@ -606,9 +909,10 @@ class SphericalOpticalImage(SphericalImagePlane,OpticalImage):
         param xsize the x size (default = 200)
         param ysize the y size (default  = 200)
         param xpixel_or_im x-pixel size of image (default = 256) OR nmpy array of floats
+        param filename file to hold the image as a np.memmap (default = None, image held in memory)
         """
 
-        OpticalImage.__init__(self,pt,xpixel,ypixel,xsize,ysize)
+        OpticalImage.__init__(self,pt,xpixel,ypixel,xsize,ysize,filename)
         self.curvature = curve
         self.maxRadius = 0.25*math.sqrt(xsize*xsize + ysize*ysize)
         self.epsilon = 1.0
@@ -623,26 +927,25 @@ class SphericalOpticalImage(SphericalImagePlane,OpticalImage):
 
 
 
-    #def getSurfaceInteraction(self,r):
+    def getSurfaceInteraction(self,r):
         """
-        Method to get back the surface interaction information for a ray
-        Returns the list
-        type:     surface type
-        distance: distance from current ray position to surface
-        pos :     Position, intration point with surface
-        norm:     surface normal at that point
-        refrative : refrative index (if refracting surface)
+        Method to get back the surface interaction information for a ray with the curved surface and add the ray
+        to the image at its x/y position.
 
-        This also add the ray intensity to the cloeset pixel
+        :return: SurfaceInteraction.
         """
-
-     #   info = SphericalSurface.getSurfaceInteraction(self,r)
-
-
+        info = SphericalImagePlane.getSurfaceInteraction(self,r)
+        if not math.isnan(info.distance):
+            self.recordRay(info.position,r.intensity,r.wavelength)
+        return info
 
 
-        #     Return list of information
-      #  return SurfaceInteraction(self.type,d,pos,u,self.refractiveindex)
+    def getBatchInteraction(self,positions,directors,point = None):
+        """
+        Get the surface interaction for arrays of rays with the curved surface, the rays are added to the image by
+        recordRays() which is called by poptics.ray.RayBundle.
+        """
+        return SphericalImagePlane.getBatchInteraction(self,positions,directors,point)
 
 
 class KnifeTest(object):
@@ -821,6 +1124,228 @@ class SpotAnalysis(SpotDiagram):
 
 
 
+class GhostPath(object):
+    """
+    Class to hold the sequence of surfaces for a ghost formed by a double reflection, first at surface second and then
+    back at surface first, with the surfaces between them traversed in reverse order. If first and second are
+    None this is the direct path through the lens. Each step is a tuple of (surface, reflect, index), where index
+    is the refractive index after a refraction or on the far side of a reflection, or None for object space, which
+    takes the index of the RayBundle being traced. For a coordinate break reflect is True where it is traversed in reverse.
+
+    :param lens: the lens
+    :type lens: poptics.lens.OpticalGroup
+    :param first: index in the lens of the second reflecting surface (Default = None)
+    :type first: int or None
+    :param second: index in the lens of the first reflecting surface, after first (Default = None)
+    :type second: int or None
+    """
+    def __init__(self,lens,first = None,second = None):
+        """
+        Build the list of steps.
+        """
+        self.first = first
+        self.second = second
+        left = []                                # Index on object side of each surface
+        right = []
+        index = None                             # Object space, set by the traced bundle
+        for sur in lens:
+            left.append(index)
+            if sur.type == ray.Refracting:
+                index = sur.refractiveindex
+            right.append(index)
+
+        n = len(lens)
+        if first == None:
+            self.steps = [(lens[k],False,right[k]) for k in range(n)]
+        else:
+            self.steps = [(lens[k],False,right[k]) for k in range(second)]
+            self.steps.append((lens[second],True,right[second]))
+            self.steps += [(lens[k],lens[k].type == ray.Break,left[k]) for k in range(second - 1,first,-1)]
+            self.steps.append((lens[first],True,left[first]))
+            self.steps += [(lens[k],False,right[k]) for k in range(first + 1,n)]
+        self.focus = float("nan")
+        self.spot = float("nan")
+        self.power = 0.0
+        self.irradiance = 0.0
 
+    def __str__(self):
+        """
+        Implement str() to give the path and results.
+        """
+        if self.first == None:
+            name = "direct"
+        else:
+            name = "ghost {0:d}-{1:d}".format(self.second,self.first)
+        return "{0:s} focus: {1:8.4f} spot: {2:8.4e} power: {3:8.4e} irradiance: {4:8.4e}".\
+            format(name,self.focus,self.spot,self.power,self.irradiance)
+
+    def __repr__(self):
+        """
+        Implement repr()
+        """
+        return "{0:s} ".format(self.__class__.__name__) + str(self)
+
+
+    def trace(self,bundle,plane):
+        """
+        Trace a copy of a RayBundle along the path to a plane, with the intensities multiplied by the Fresnel reflectance
+        at the two reflections and transmittance at each refraction.
+
+        :param bundle: the input rays, which are not altered
+        :type bundle: poptics.ray.RayBundle
+        :param plane: the output plane
+        :type plane: poptics.surface.OpticalPlane
+        :return: RayBundle at the plane
+        """
+        b = bundle.copy()
+        start = bundle.refractiveindex           # Object space index
+        for sur,reflect,index in self.steps:
+            if index == None:
+                index = start
+            if sur.type == ray.Break:             # Coordinate break, reversed between the reflections
+                sur.transform(b.positions,b.directors,None,reflect)
+                continue
+            v = np.flatnonzero(b.valid)
+            distance,pos,normal,blocked = sur.getBatchInteraction(b.positions[v],b.directors[v])
+            blocked |= ~(distance > 0.0)          # Must be forward along the ray
+            n = b.getIndexValues(b.refractiveindex)[v]
+            hit = ~blocked
+            b.positions[v[hit]] = pos[hit]
+            b.pathlengths[v[hit]] += distance[hit]*n[hit]
+            b.valid[v[blocked]] = False
+            v = v[hit]
+            if sur.type == ray.Clear:
+                continue
+            normal = normal[hit]
+            u = b.directors[v]
+            ratio = b.getIndexValues(index)[v]/n[hit]
+            r = ray.fresnelReflectance(u,normal,ratio)
+            if reflect:
+                b.intensities[v] *= r
+                ray.reflectDirectors(u,normal)
+            else:
+                b.intensities[v] *= 1.0 - r
+                critical = ray.refractDirectors(u,normal,ratio)
+                b.valid[v[critical]] = False
+                b.refractiveindex = index
+            b.directors[v] = u
+        b.propagateThrough(plane)
+        return b
+
+
+    def evaluate(self,bundle,plane):
+        """
+        Trace the rays along the path and find the focus, rms spot radius and power at the plane.
+
+        :param bundle: the input rays
+        :type bundle: poptics.ray.RayBundle
+        :param plane: the output plane
+        :type plane: poptics.surface.OpticalPlane
+        :return: (focus, spot, power) as floats
+        """
+        b = self.trace(bundle,plane)
+        v = b.valid
+        if np.count_nonzero(v) < 2:
+            return float("nan"),float("nan"),0.0
+        xy = b.positions[v,0:2]
+        slope = b.directors[v,0:2]/b.directors[v,2:3]
+        xy = xy - xy.mean(axis = 0)
+        slope = slope - slope.mean(axis = 0)
+        z = plane.getPoint().z
+        focus = z - (xy*slope).sum()/(slope*slope).sum()     # Plane of least rms spot
+        spot = math.sqrt((xy*xy).sum(axis = 1).mean())
+        return focus,spot,float(b.intensities[v].sum())
+
+
+def ghostWorker(path,bundle,plane):
+    """
+    Evaluate a GhostPath in a worker process. Not called by users.
+    """
+    return path.evaluate(bundle,plane)
+
+
+class GhostAnalysis(object):
+    """
+    Class to find the ghost images formed by double reflections between the refracting surfaces of a lens, so N
+    surfaces give N(N-1)/2 GhostPaths. Each path is traced with a RayBundle to give the ghost focus, its rms spot radius
+    and power at the image plane, and its irradiance relative to the irradiance of the input beam.
 
+    :param lens: the lens, typically a DataBaseLens
+    :type lens: poptics.lens.Lens
+    :param source: source of rays, angle for collimated or SourcePoint for point (Default = 0.0)
+    :type source: SourcePoint, Unit3d, Angle or float
+    :param plane: the image plane (Default = None, the back focal plane of the lens)
+    :type plane: poptics.surface.OpticalPlane or None
+    :param wavelength: wavelength of analysis (Default = None, package default)
+    :type wavelength: float
+    :param nrays: number of rays across the radius of the beam (Default = 10)
+    :type nrays: int
+    """
+    def __init__(self,lens,source = 0.0,plane = None,wavelength = None,nrays = 10):
+        """
+        Enumerate the ghost paths
+        """
+        self.lens = lens
+        self.source = source
+        self.wavelength = getDefaultWavelength(wavelength)
+        if plane == None:
+            plane = ImagePlane(lens.backFocalPlane().getPoint())
+        self.plane = plane
+        self.nrays = int(nrays)
+        self.direct = GhostPath(lens)
+        refracting = [i for i,s in enumerate(lens) if s.type == ray.Refracting]
+        self.paths = [GhostPath(lens,i,j) for j in refracting for i in refracting if i < j]
 
+    def __str__(self):
+        """
+        Implement str() to give the number of paths
+        """
+        return "paths: {0:d}".format(len(self.paths))
+
+    def __repr__(self):
+        """
+        Implement repr()
+        """
+        return "{0:s} ".format(self.__class__.__name__) + str(self)
+
+
+    def evaluate(self,workers = None):
+        """
+        Trace the direct path and all the ghost paths, with the paths split across a pool of worker processes
+        if more than one worker.
+
+        :param workers: number of worker processes (Default = None, the value set by poptics.ray.setTraceWorkers())
+        :type workers: int or None
+        :return: self
+        """
+        if workers == None:
+            workers = ray.TraceWorkers
+        bundle = ray.RayBundle().addBeam(self.lens,self.source,"array",self.nrays,self.wavelength)
+        ca = self.lens.entranceAperture()
+        irradiance = bundle.intensities.sum()/(math.pi*ca.maxRadius*ca.maxRadius)     # Input irradiance
+
+        paths = [self.direct] + self.paths
+        if workers > 1:
+            with ProcessPoolExecutor(min(workers,len(paths))) as pool:
+                results = list(pool.map(ghostWorker,paths,[bundle]*len(paths),[self.plane]*len(paths)))
+        else:
+            results = [p.evaluate(bundle,self.plane) for p in paths]
+
+        for p,(focus,spot,power) in zip(paths,results):
+            p.focus = focus
+            p.spot = spot
+            p.power = power
+            if spot > 0.0:
+                p.irradiance = power/(math.pi*spot*spot)/irradiance
+        return self
+
+    def getInfo(self):
+        """
+        Get the results as a formatted string, one path per line.
+
+        :return: str
+        """
+        st = repr(self) + "\n" + str(self.direct)
+        for p in self.paths:
+            st += "\n" + str(p)
+        return st
@@ -3,12 +3,17 @@ Set of classes to implement various types lenses, being lists of surfaces, with
 method to extract the geomertic parameters in a simple way.
 """
 from poptics.surface import OpticalPlane,ImagePlane,CircularAperture,IrisAperture,\
-    AnnularAperture,SphericalSurface,QuadricSurface,ParabolicSurface,SphericalImagePlane
+    AnnularAperture,SphericalSurface,QuadricSurface,ParabolicSurface,SphericalImagePlane,Clear,Refracting,Reflecting,\
+    EvenAsphericSurface,XYPolynomialSurface,CoordinateBreak,CoordinateReturn,Break
 from poptics.matrix import ParaxialPlane,ParaxialMatrix,DielectricMatrix,ParaxialGroup
-from poptics.vector import Vector3d
-from poptics.wavelength import getDesignWavelength,AirIndex,MaterialIndex,CauchyIndex,PhotopicPeak
+from poptics.vector import Vector2d,Vector3d,Unit3d
+from poptics.wavelength import getDesignWavelength,AirIndex,MaterialIndex,CauchyIndex,PhotopicPeak,\
+    RefractiveIndex,GradedIndex,getDefaultWavelength
+from poptics.ray import IntensityRay,SourcePoint,RayBundle,reflectDirectors,refractDirectors,fresnelReflectance
 from poptics.analysis import SphericalOpticalImage
 import poptics.tio as tio
+import numpy as np
+import math
 from matplotlib.pyplot import plot
 from os.path import join,splitext,isabs
 from importlib.resources import path
@@ -70,6 +75,7 @@ class OpticalGroup(list):
         self.aperture = None                # Aperture when added
         self.iris = None                    # Variable iris aperture when added
         self.paraxial = None                # associated paraxial group (auto added)
+        self.plan = None                    # compiled trace plan (auto added)
         self.wavelength = getDesignWavelength()         # Default wavelength
         self.group = None                   # Allow to be member of an other group
         self.setPoint(group_pt)             # Us method that does tidy up as well
@@ -121,6 +127,7 @@ class OpticalGroup(list):
         else:
             self.point = Vector3d(pt) # Make local copy of vector
         self.paraxial = None          # Remove paraxial matrix since geometery changed.
+        self.plan = None
 
     def getPoint(self):
         """
@@ -140,6 +147,7 @@ class OpticalGroup(list):
         else:
             self.point += delta
         self.paraxial = None
+        self.plan = None
 
     #
     def add(self,surface):
@@ -165,6 +173,7 @@ class OpticalGroup(list):
 
             self.append(surface)
             self.paraxial = None                         # Clear any old paraxial matrix.
+            self.plan = None
             surface.group = self                         # Make surface joint group
             if isinstance(surface,CircularAperture): # Record location of aperture
                 self.aperture = surface
@@ -188,6 +197,7 @@ class OpticalGroup(list):
             s.scale(a)
 
         self.paraxial = None
+        self.plan = None
         return self
 
     #
@@ -372,6 +382,37 @@ class OpticalGroup(list):
         return self.paraxial
 
 
+    def compile(self):
+        """
+        Get the TracePlan for the group, which holds the global geometry of each surface so that repeated
+        traces through the group do not recalculate it. This will be remade on first call or after the
+        geometry of the group has changed.
+
+        :return: the TracePlan
+
+        """
+        if self.plan == None:
+            self.plan = TracePlan(self)
+        return self.plan
+
+
+    def traceNonSequential(self,bundle,threshold = 1.0e-3,maxdepth = 10):
+        """
+        Trace a RayBundle through the group non-sequentially, so each ray goes to its nearest surface in any order
+        and is split into reflected and transmitted rays at refracting surfaces by the Fresnel coefficients.
+        See NonSequentialTrace for details.
+
+        :param bundle: the input rays, which are not altered
+        :type bundle: poptics.ray.RayBundle
+        :param threshold: fraction of the input intensity below which rays are dropped (Default = 1.0e-3)
+        :type threshold: float
+        :param maxdepth: maximum number of surface interactions of each ray (Default = 10)
+        :type maxdepth: int
+        :return: NonSequentialTrace holding the rays leaving the group
+        """
+        return NonSequentialTrace(self,threshold,maxdepth).trace(bundle)
+
+
     def draw(self):
         """
         Method to draw the surfaces   (but NOT the paraxial planes, see Lens.draw below for more useful method)
@@ -380,6 +421,558 @@ class OpticalGroup(list):
             s.draw()
 
 
+class AimedPupil(object):
+    """
+    Class to hold the result of real ray aiming for a lens at a field point. This maps points in the unit circle
+    onto the entrance aperture of the lens so that rays from them fill the real stop, with
+
+    - self.aperture the entrance aperture of the lens.
+    - self.chief the point in the entrance aperture, (relative to its centre), of the ray through the centre of the stop.
+    - self.centre the centre of the mapped pupil, being the average of the four marginal rays.
+    - self.xaxis and self.yaxis the half-axes of the mapped pupil as Vector2d.
+    - self.converged True if all five rays were found, False if some are vignetted before the stop, when the edge of
+      the unvignetted beam is used instead.
+
+    This is not normally created by the user, use Lens.getAimedPupil() that caches the result.
+
+    :param lens: the lens
+    :type lens: Lens
+    :param source: the field, either a SourcePoint or angle
+    :type source: SourcePoint or Unit3d or Angle or float
+    :param wavelength: the wavelength
+    :type wavelength: float
+    :param tolerance: required accuracy in the stop plane (Default = 1.0e-6 mm)
+    :type tolerance: float
+    :param maxiter: maximum number of Newton iterations per ray (Default = 20)
+    :type maxiter: int
+
+    """
+    def __init__(self,lens,source,wavelength,tolerance = 1.0e-6,maxiter = 20):
+        """
+        Solve for the chief and marginal rays.
+        """
+        self.aperture = lens.entranceAperture()
+        self.source = source
+        self.wavelength = wavelength
+        self.tolerance = tolerance
+        self.maxiter = maxiter
+        radius = self.aperture.maxRadius
+
+        stop = lens.iris if lens.iris != None else lens.aperture
+        if stop == None:                               # No stop so no aiming, fill the aperture
+            self.chief = Vector2d()
+            self.centre = Vector2d()
+            self.xaxis = Vector2d(radius,0.0)
+            self.yaxis = Vector2d(0.0,radius)
+            self.converged = True
+            return
+
+        self.stop = stop
+        self.surfaces = list(lens[:lens.index(stop)])  # Surfaces before the stop
+        r = stop.getRadius()
+        scale = lens.entrancePupil(wavelength).maxRadius/stop.maxRadius   # Paraxial guess at pupil magnification
+
+        self.chief,c = self.solve(0.0,0.0,Vector2d())
+        rims = []
+        for tx,ty in ((r,0.0),(-r,0.0),(0.0,r),(0.0,-r)):
+            rim,b = self.solve(tx,ty,self.chief + Vector2d(tx,ty)*scale)
+            rims.append(rim)
+            c = c and b
+        self.converged = c
+        self.centre = (rims[0] + rims[1] + rims[2] + rims[3])*0.25
+        self.xaxis = (rims[0] - rims[1])*0.5
+        self.yaxis = (rims[2] - rims[3])*0.5
+
+
+    def __str__(self):
+        """
+        Implement str() to give the chief, centre and axes
+        """
+        return "chief: {0:s} centre: {1:s} x: {2:s} y: {3:s}".format(str(self.chief),str(self.centre),\
+                                                                   str(self.xaxis),str(self.yaxis))
+
+    def __repr__(self):
+        """
+        Implement repr()
+        """
+        return "{0:s} ".format(self.__class__.__name__) + str(self)
+
+
+    def getRay(self,x,y):
+        """
+        Get the ray from the field through a point in the entrance aperture, (as in RayPencil.addBeam()).
+
+        :param x: x position in the aperture relative to its centre
+        :type x: float
+        :param y: y position in the aperture relative to its centre
+        :type y: float
+        :return: IntensityRay
+
+        """
+        pt = self.aperture.getPoint()
+        p = Vector3d(pt.x + x,pt.y + y,pt.z)
+        if isinstance(self.source,SourcePoint):
+            return IntensityRay(self.source,Unit3d(p - self.source),self.wavelength)
+        else:
+            u = Unit3d().parseAngle(self.source)
+            p -= (self.aperture.maxRadius + x*u.x + y*u.y)*u
+            return IntensityRay(p,u,self.wavelength)
+
+    def stopPoint(self,x,y):
+        """
+        Get where the ray through a point in the entrance aperture reaches the plane of the stop.
+
+        :param x: x position in the aperture relative to its centre
+        :type x: float
+        :param y: y position in the aperture relative to its centre
+        :type y: float
+        :return: Vector2d relative to the centre of the stop, or None if the ray fails before the stop.
+
+        """
+        ray = self.getRay(x,y)
+        if len(self.surfaces) > 0:
+            ray *= self.surfaces
+        if not ray:
+            return None
+        return ray.pointInPlane(self.stop)
+
+
+    def solve(self,tx,ty,guess):
+        """
+        Solve for the point in the entrance aperture of the ray that reaches a target point in the stop by Newton iteration
+        with a numerical Jacobian.
+
+        :param tx: x target relative to the centre of the stop
+        :type tx: float
+        :param ty: y target relative to the centre of the stop
+        :type ty: float
+        :param guess: the starting guess in the entrance aperture
+        :type guess: Vector2d
+        :return: (Vector2d,bool) being the point and True if converged. If the ray is blocked before the stop the
+            edge of the unvignetted beam towards the target is returned with False, else if not converged the guess is returned.
+
+        """
+        x,y = guess.x,guess.y
+        valid = None                                    # Last point that reached the stop
+        h = 1.0e-4*self.aperture.maxRadius              # Step for Jacobian
+        for i in range(self.maxiter):
+            p = self.stopPoint(x,y)
+            if p == None:
+                if valid == None:
+                    break
+                for j in range(40):                     # Bisect to find edge of unvignetted beam
+                    mx,my = 0.5*(valid[0] + x),0.5*(valid[1] + y)
+                    if self.stopPoint(mx,my) == None:
+                        x,y = mx,my
+                    else:
+                        valid = (mx,my)
+                return Vector2d(valid[0],valid[1]),False
+            valid = (x,y)
+            fx,fy = p.x - tx,p.y - ty
+            if math.hypot(fx,fy) < self.tolerance:
+                return Vector2d(x,y),True
+            px = self.stopPoint(x + h,y)                # Forward differences, or backward if fails
+            dh = h
+            if px == None:
+                px = self.stopPoint(x - h,y)
+                dh = -h
+            py = self.stopPoint(x,y + h)
+            eh = h
+            if py == None:
+                py = self.stopPoint(x,y - h)
+                eh = -h
+            if px == None or py == None:
+                break
+            a,c = (px.x - p.x)/dh,(px.y - p.y)/dh      # Jacobian
+            b,d = (py.x - p.x)/eh,(py.y - p.y)/eh
+            det = a*d - b*c
+            if det == 0.0:
+                break
+            x -= (d*fx - b*fy)/det
+            y -= (a*fy - c*fx)/det
+
+        return guess,False
+
+
+    def getPoints(self,x,y):
+        """
+        Map points in the unit circle to points in the entrance aperture, relative to its centre, that fill the stop.
+
+        :param x: x points in the unit circle
+        :type x: np.ndarray
+        :param y: y points in the unit circle
+        :type y: np.ndarray
+        :return: x,y as np.ndarray
+
+        """
+        return self.centre.x + x*self.xaxis.x + y*self.yaxis.x, self.centre.y + x*self.xaxis.y + y*self.yaxis.y
+
+
+class TracePlan(object):
+    """
+    Class to hold a compiled trace plan for an OpticalGroup, being the surfaces in order with
+    their global geometry held in arrays. This is normally made and cached by OpticalGroup.compile()
+    and used automatically by poptics.ray.IntensityRay and poptics.ray.RayBundle.
+
+    The plan holds:
+
+    - self.surfaces list of the surfaces.
+    - self.points list of surface reference points in global coordinates as Vector3d.
+    - self.point (N,3) array of surface reference points in global coordinates.
+    - self.curvature (N,) array of curvatures (0.0 for flat surfaces).
+    - self.epsilon (N,) array of quadric parameters (1.0 if not quadric).
+    - self.maxRadius (N,) array of maximum radius (inf if not limited), for apertures this is the current radius.
+    - self.type (N,) array of surface types.
+    - self.flatRadius list of radius of clear flat surfaces normal to the optical axis, None for other surfaces, see Surface.getFlatRadius().
+    - self.refractiveindex list of refractive indices on the image side.
+    - self.indices list of the distinct refractive indices that can be held in a table.
+    - self.indexTable dictionary, keyed on wavelength, of index tables made by getIndexTable().
+    - self.aimCache dictionary, keyed on field and wavelength, of AimedPupils made by Lens.getAimedPupil().
+
+    :param group: the OpticalGroup
+    :type group: OpticalGroup
+
+    """
+    def __init__(self,group):
+        """
+        Form the plan from the current state of the group.
+        """
+        self.surfaces = list(group)
+        self.points = [s.getPoint().copy() for s in self.surfaces]
+        self.point = np.array([[p.x,p.y,p.z] for p in self.points]).reshape(-1,3)
+        self.curvature = np.array([getattr(s,"curvature",0.0) for s in self.surfaces])
+        self.epsilon = np.array([getattr(s,"epsilon",1.0) for s in self.surfaces])
+        self.maxRadius = np.array([s.getRadius() if isinstance(s,CircularAperture) else \
+                                   getattr(s,"maxRadius",float("inf")) for s in self.surfaces])
+        self.type = np.array([s.type for s in self.surfaces],dtype = int)
+        self.flatRadius = [s.getFlatRadius() for s in self.surfaces]
+        self.refractiveindex = [s.refractiveindex for s in self.surfaces]
+        #          Distinct indices that depend on wavelength only (not GradedIndex or dynamic)
+        self.indices = list(dict.fromkeys([n for n in self.refractiveindex \
+                                           if isinstance(n,RefractiveIndex) and not isinstance(n,GradedIndex) \
+                                           and not n.dynamic]))
+        self.indexTable = {}
+        self.aimCache = {}
+
+    def __str__(self):
+        """
+        Implement str() to give the number of surfaces
+        """
+        return "surfaces: {0:d}".format(len(self))
+
+    def __repr__(self):
+        """
+        Implement repr()
+        """
+        return "{0:s} ".format(self.__class__.__name__) + str(self)
+
+    def __len__(self):
+        """
+        Implement len() being the number of surfaces.
+        """
+        return len(self.surfaces)
+
+    def getIndexTable(self,wavelength):
+        """
+        Get the table of refractive index values for each distinct medium in the plan at a wavelength, this
+        is calculated once per wavelength and cached, so mixed wavelength pencils do not recalculate the dispersion
+        formula for each ray at each surface.
+
+        :param wavelength: the wavelength
+        :type wavelength: float
+        :return: dictionary of values keyed on the RefractiveIndex.
+
+        """
+        w = float(wavelength)
+        table = self.indexTable.get(w)
+        if table == None:
+            table = {n : n.getValue(w) for n in self.indices}
+            self.indexTable[w] = table
+        return table
+
+    def getIndexValue(self,index,wavelength):
+        """
+        Get the value of a refractive index at a wavelength, using the index table if the index is in the plan.
+
+        :param index: the refractive index
+        :type index: RefractiveIndex
+        :param wavelength: the wavelength
+        :type wavelength: float
+        :return: the value as a float
+
+        """
+        table = self.getIndexTable(wavelength)
+        if index in table:
+            return table[index]
+        else:
+            return index.getValue(wavelength)
+
+
+class NonSequentialTrace(object):
+    """
+    Class to trace rays non-sequentially through an OpticalGroup, for ghost and stray light estimates. Each ray
+    goes to the nearest surface it hits in any order. At refracting surfaces the ray is split into a transmitted
+    and a reflected ray with intensities given by the unpolarised Fresnel coefficients, with total internal reflection
+    giving just the reflected ray. Reflecting surfaces reflect, while apertures, and surfaces outside their maximum radius,
+    absorb the rays they block. Rays are
+    held in a queue of arrays and each generation of interactions is processed as a batch.
+
+    The medium on the image side of each refracting surface is its refractive index and on the object side the index
+    of the previous refracting surface, (or the index of the input rays for the first), so the normals of the surfaces
+    give the side each ray hits from.
+
+    After trace() the results are held in:
+
+    - self.output RayBundle of the rays that leave the group into image space, in the image space index.
+    - self.reflections (M,) array of the number of reflections of each output ray, so 0 for the direct path and 2 for ghosts.
+    - self.events (M,) array of the number of surface interactions of each output ray.
+    - self.backward RayBundle of the rays that leave the group back into object space, in the index of the input rays.
+    - self.backReflections (K,) array of the number of reflections of each backward ray.
+    - self.backEvents (K,) array of the number of surface interactions of each backward ray.
+    - self.input total input intensity.
+    - self.absorbed intensity absorbed by apertures.
+    - self.lost intensity dropped below the threshold, at the maximum depth or leaving inside the group, (for example past
+      the edge of a lens).
+
+    :param group: the OpticalGroup
+    :type group: OpticalGroup
+    :param threshold: fraction of the input intensity below which rays are dropped (Default = 1.0e-3)
+    :type threshold: float
+    :param maxdepth: maximum number of surface interactions of each ray (Default = 10)
+    :type maxdepth: int
+    """
+    def __init__(self,group,threshold = 1.0e-3,maxdepth = 10):
+        """
+        Set up the trace for the group.
+        """
+        self.group = group
+        self.threshold = float(threshold)
+        self.maxdepth = int(maxdepth)
+        self.tolerance = 1.0e-9                  # Minimum distance to the next surface
+        self.output = None
+        self.reflections = None
+        self.events = None
+        self.backward = None
+        self.backReflections = None
+        self.backEvents = None
+        self.input = 0.0
+        self.absorbed = 0.0
+        self.lost = 0.0
+
+    def __str__(self):
+        """
+        Implement str() to give the energy balance.
+        """
+        out = 0.0 if self.output == None else float(self.output.intensities.sum())
+        back = 0.0 if self.backward == None else float(self.backward.intensities.sum())
+        return "input: {0:8.4e} output: {1:8.4e} backward: {2:8.4e} absorbed: {3:8.4e} lost: {4:8.4e}".\
+            format(self.input,out,back,self.absorbed,self.lost)
+
+    def __repr__(self):
+        """
+        Implement repr()
+        """
+        return "{0:s} ".format(self.__class__.__name__) + str(self)
+
+
+    def getIndexValues(self,media,medium,wavelengths,plan):
+        """
+        Get the refractive index values for rays in a list of media.
+
+        :param media: list of RefractiveIndex
+        :param medium: (N,) array of the index of each ray in media
+        :param wavelengths: (N,) array of wavelengths
+        :param plan: the TracePlan for the index table
+        :return: (N,) np.ndarray
+        """
+        values = np.empty(len(medium))
+        for m in np.unique(medium):
+            i = np.flatnonzero(medium == m)
+            waves,inverse = np.unique(wavelengths[i],return_inverse = True)
+            values[i] = np.array([plan.getIndexValue(media[m],float(w)) for w in waves])[inverse]
+        return values
+
+
+    def trace(self,bundle):
+        """
+        Trace the valid rays of a bundle non-sequentially through the group.
+
+        :param bundle: the input rays, which are not altered
+        :type bundle: poptics.ray.RayBundle
+        :return: self
+        """
+        plan = self.group.compile()
+        surfaces = plan.surfaces
+        if Break in plan.type:
+            raise TypeError("lens.NonSequentialTrace.trace: coordinate breaks can only be traced sequentially")
+
+        #          Media list with the object and image side medium of each surface
+        media = [bundle.refractiveindex]
+        left = []
+        right = []
+        for s in surfaces:
+            left.append(len(media) - 1)
+            if s.type == Refracting:
+                media.append(s.refractiveindex)
+            right.append(len(media) - 1)
+        left = np.array(left)
+        right = np.array(right)
+
+        #          Ray queue as arrays
+        v = bundle.valid
+        pos = bundle.positions[v].copy()
+        dirn = bundle.directors[v].copy()
+        wave = bundle.wavelengths[v].copy()
+        start = bundle.intensities[v].copy()      # Input intensity of the ray that started the path
+        fraction = np.ones(len(pos))              # Fraction of input intensity left
+        path = bundle.pathlengths[v].copy()
+        medium = np.zeros(len(pos),dtype = int)
+        reflections = np.zeros(len(pos),dtype = int)
+        events = np.zeros(len(pos),dtype = int)
+        last = np.full(len(pos),-1)               # Last surface hit
+
+        self.input = float(start.sum())
+        self.absorbed = 0.0
+        self.lost = 0.0
+        done = []                                 # Output rays as list of array tuples
+
+        while len(pos) > 0:
+            #      Distance to every surface, inf if missed
+            distance = np.full((len(pos),len(surfaces)),np.inf)
+            hits = []
+            for j,s in enumerate(surfaces):
+                d,p,normal,blocked = s.getBatchInteraction(pos,dirn,plan.points[j])
+                ok = (d > self.tolerance) & (last != j)     # False for NaN
+                if s.type == Clear:
+                    ok &= blocked                 # Only blocked rays interact with apertures
+                distance[ok,j] = d[ok]
+                hits.append((p,normal,blocked))
+
+            j = np.argmin(distance,axis = 1)
+            d = distance[np.arange(len(pos)),j]
+            n = self.getIndexValues(media,medium,wave,plan)
+
+            #      Rays with no more hits leave the group
+            out = np.isinf(d)
+            escape = out & ((medium == 0) | (medium == len(media) - 1))
+            done.append((pos[escape],dirn[escape],wave[escape],start[escape]*fraction[escape],path[escape],\
+                         reflections[escape],events[escape],medium[escape]))
+            self.lost += float((start[out & ~escape]*fraction[out & ~escape]).sum())
+
+            new = []                              # New generation of rays
+            for k,s in enumerate(surfaces):
+                i = np.flatnonzero((j == k) & ~out)
+                if len(i) == 0:
+                    continue
+                p,normal,blocked = hits[k]
+                absorb = i[blocked[i]]                 # Blocked by aperture or edge of surface
+                self.absorbed += float((start[absorb]*fraction[absorb]).sum())
+                i = i[~blocked[i]]
+                if len(i) == 0:
+                    continue
+                ray = [p[i],dirn[i].copy(),wave[i],start[i],fraction[i],path[i] + d[i]*n[i],\
+                       medium[i],reflections[i],events[i] + 1,np.full(len(i),k)]
+
+                if s.type == Reflecting:
+                    reflectDirectors(ray[1],normal[i])
+                    ray[7] = ray[7] + 1
+                    new.append(ray)
+                    continue
+
+                #      Refracting, sort out which side the ray comes from
+                forward = (dirn[i]*normal[i]).sum(axis = 1) > 0.0
+                other = np.where(forward,right[k],left[k])
+                n1 = n[i]
+                n2 = self.getIndexValues(media,other,wave[i],plan)
+                r = fresnelReflectance(dirn[i],normal[i],n2/n1)
+                tir = r == 1.0
+
+                reflected = [x.copy() for x in ray]
+                reflectDirectors(reflected[1],normal[i])
+                reflected[4] = fraction[i]*r
+                reflected[7] = reflected[7] + 1
+                new.append(reflected)
+
+                t = ~tir
+                transmitted = [x[t] for x in ray]
+                u = transmitted[1]
+                refractDirectors(u,normal[i][t],n2[t]/n1[t])
+                transmitted[4] = fraction[i][t]*(1.0 - r[t])
+                transmitted[6] = other[t]
+                new.append(transmitted)
+
+            if len(new) == 0:
+                break
+            pos,dirn,wave,start,fraction,path,medium,reflections,events,last = \
+                [np.concatenate([r[m] for r in new]) for m in range(10)]
+
+            #      Drop weak rays and rays at the maximum depth
+            drop = (fraction < self.threshold) | (events >= self.maxdepth)
+            self.lost += float((start[drop]*fraction[drop]).sum())
+            keep = ~drop
+            pos,dirn,wave,start,fraction,path,medium,reflections,events,last = \
+                [x[keep] for x in (pos,dirn,wave,start,fraction,path,medium,reflections,events,last)]
+
+        #          Output rays as RayBundles split by the side they leave, if no refracting surfaces all in output
+        if len(done) == 0:
+            done = [tuple(np.empty((0,3)) if m < 2 else np.empty(0,dtype = int if m > 4 else float) for m in range(8))]
+        pos,dirn,wave,intensity,path,reflections,events,medium = [np.concatenate([r[m] for r in done]) for m in range(8)]
+        back = (medium == 0) & (len(media) > 1)
+        self.output,self.reflections,self.events = \
+            self.makeOutput(media[-1],~back,pos,dirn,wave,intensity,path,reflections,events)
+        self.backward,self.backReflections,self.backEvents = \
+            self.makeOutput(media[0],back,pos,dirn,wave,intensity,path,reflections,events)
+        return self
+
+    def makeOutput(self,index,select,pos,dirn,wave,intensity,path,reflections,events):
+        """
+        Make an output RayBundle from the selected rays.
+
+        :param index: the refractive index of the bundle
+        :type index: RefractiveIndex
+        :param select: (M,) boolean array of the rays to use
+        :return: RayBundle, reflections array and events array
+        """
+        bundle = RayBundle(index = index)
+        if select.any():
+            bundle.addRays(pos[select],dirn[select],wave[select],intensity[select],path[select])
+        return bundle,reflections[select],events[select]
+
+
+    def getOutput(self,reflections = None,backward = False):
+        """
+        Get the output rays, optionally only those with a given number of reflections.
+
+        :param reflections: number of reflections, or None for all rays (Default = None)
+        :type reflections: int or None
+        :param backward: if True get the rays leaving back into object space (Default = False)
+        :type backward: bool
+        :return: RayBundle
+        """
+        if backward:
+            b,r = self.backward,self.backReflections
+        else:
+            b,r = self.output,self.reflections
+        if reflections == None:
+            return b.copy()
+        b = b.copy()
+        b.valid &= r == reflections
+        return b.removeInvalid()
+
+    def getIntensities(self,backward = False):
+        """
+        Get the total output intensity against the number of reflections, so element 0 is the direct path, element 2 the
+        double reflection ghosts.
+
+        :param backward: if True for the rays leaving back into object space, where element 1 are single reflections (Default = False)
+        :type backward: bool
+        :return: np.ndarray
+        """
+        if backward:
+            return np.bincount(self.backReflections,weights = self.backward.intensities)
+        return np.bincount(self.reflections,weights = self.output.intensities)
+
+
 #
 class Lens(OpticalGroup):
     """
@@ -470,6 +1063,32 @@ class Lens(OpticalGroup):
         return CircularAperture(p,mag*self.aperture.getRadius())
 
 
+    def getAimedPupil(self,source,wavelength = None):
+        """
+        Get the AimedPupil for a field point, found by real ray aiming so that rays from the entrance aperture
+        fill the stop, (the iris if there is one, else the last circular aperture). The chief ray is solved to pass
+        through the centre of the stop and four marginal rays through its rim. The result is cached in the
+        TracePlan so is only solved once per lens configuration, field and wavelength.
+
+        :param source: the field, either a SourcePoint or angle
+        :type source: SourcePoint or Unit3d or Angle or float
+        :param wavelength: the wavelength (Default = None, package default)
+        :type wavelength: float or None
+        :return: AimedPupil
+
+        This is used by RayPencil.addBeam() and RayBundle.addBeam() with aim = True.
+        """
+        wavelength = getDefaultWavelength(wavelength)
+        if isinstance(source,SourcePoint):
+            key = ("point",source.x,source.y,source.z,wavelength)
+        else:
+            u = Unit3d().parseAngle(source)
+            key = ("angle",u.x,u.y,u.z,wavelength)
+
+        cache = self.compile().aimCache
+        if key not in cache:
+            cache[key] = AimedPupil(self,source,wavelength)
+        return cache[key]
 
 
     def setIris(self,ratio):
@@ -482,6 +1101,7 @@ class Lens(OpticalGroup):
         """
         if self.iris != None:
             self.iris.ratio = ratio
+            self.plan = None
         return self
 
 
@@ -714,6 +1334,7 @@ class Singlet(Lens):
         if back != None:
             self[1].curvature = back
         self.paraxial = None
+        self.plan = None
         return self
 
     def invert(self):
@@ -764,6 +1385,7 @@ class Singlet(Lens):
         self[0].maxRadius = abs(r)
         self[1].maxRadius = abs(r)
         self.paraxial = None
+        self.plan = None
         return self
 
 
@@ -799,6 +1421,7 @@ class Singlet(Lens):
         c = self[0].curvature - self[1].curvature
         self.setCurvatures(0.5*c*(beta + 1.0),0.5*c*(beta - 1.0))
         self.paraxial = None
+        self.plan = None
         if fixedfocal:                    # Scale focal length if required.
             self.setFocalLength(f,True)
         return self
@@ -830,6 +1453,7 @@ class Singlet(Lens):
 
         self[1].point.z += move
         self.paraxial = None
+        self.plan = None
         return self
 
     def getEdgeThickness(self):
@@ -859,6 +1483,7 @@ class Singlet(Lens):
 
         self[1].point.z += move
         self.paraxial = None
+        self.plan = None
         return self
 
     def setThickness(self,t = 0.0):
@@ -1085,6 +1710,7 @@ class Doublet(Lens):
         t = self[2].point - self[1].point
         self[1].setPoint(self[0].point + t)
         self.paraxial = None
+        self.plan = None
         return self
 
 
@@ -1139,6 +1765,7 @@ class Doublet(Lens):
         self[1].maxRadius = abs(r)
         self[2].maxRadius = abs(r)
         self.paraxial = None
+        self.plan = None
         return self
 
     def setCurvatures(self,front=None,centre=None,back=None):
@@ -1158,6 +1785,7 @@ class Doublet(Lens):
         if back != None:
             self[2].curvature = back
         self.paraxial = None
+        self.plan = None
         return self
 
 
@@ -1327,6 +1955,7 @@ class Eye(Lens):
         """
         pt = self.bfp + delta
         self.retina.point = Vector3d(0,0,pt)
+        self.plan = None
         return self
 
     def accommodation(self,a):
@@ -1361,6 +1990,7 @@ class Eye(Lens):
         self[4].curvature = backcurve
 
         self.paraxial = None
+        self.plan = None
         return self
 
     def setFocalLength(self,f):
@@ -1435,10 +2065,24 @@ class DataBaseLens(Lens):
         point: x,y,z     (reference point)
         spherical:
         quadratic
+        asphere:
+        xypolynomial:
+        break:
+        return:
         iris:
         aperture:
 
     End
+
+    The index of a surface is a material name, or a graded index about the lens axis given by the base material and
+    the polynomial coefficients in r^2, for example "index: grin: N-SK4 1.0,-0.005".
+
+    Aspheric surfaces give the coefficients of r^4, r^6 ... after the radius, for example
+    "asphere: 5.0 curve: 0.05 epsilon: 0.5 radius: 8.0 coef: 1.0e-5,-2.0e-8 index: N-BK7", and
+    XY polynomial surfaces give each term as "coef: x2y0=1.0e-3,x0y2=-1.0e-3".
+
+    The surfaces following a coordinate break are decentered and tilted, with tilts about the x, y and z axis in degrees,
+    for example "break: 8.0 decenter: 0.1,0.0 tilt: 0.5,0.0,0.0", up to a "return: 10.5" that returns from the last break.
     """
 
     def __init__(self,fn = None):
@@ -1476,6 +2120,7 @@ class DataBaseLens(Lens):
 
         #          Process the read file  one line at a time
         #
+        breaks = []                     # Coordinate breaks not yet returned from
         for line in lenslines:
             line = line.strip()
             if not line.startswith("#") and len(line) > 0:   # Kill comments and blanks
@@ -1488,6 +2133,19 @@ class DataBaseLens(Lens):
                     v = eval(token[1])
                     self.setPoint(v)                          # Set point
 
+                elif token[0].startswith("break"):            # Coordinate break
+                    p = float(token[1])                       # z-position
+                    d = [float(x) for x in token[3].split(",")]         # decenter
+                    t = [math.radians(float(x)) for x in token[5].split(",")]   # tilts in degrees
+                    s = CoordinateBreak(p,Vector2d(d[0],d[1]),t[0],t[1],t[2])
+                    breaks.append(s)
+                    self.add(s)
+
+                elif token[0].startswith("return"):           # Return from last coordinate break
+                    p = float(token[1])
+                    s = CoordinateReturn(p,breaks.pop())
+                    self.add(s)
+
                 elif token[0].startswith("iris"):             # Iris aperture
                     p = float(token[1])                       # z-position
                     r = float(token[3])                       # radius
@@ -1512,7 +2170,7 @@ class DataBaseLens(Lens):
                     c = float(token[3])                       # curvature
                     r = float(token[5])                       # max radius
                     if token[6].startswith("index"):          # refrective index
-                        index = MaterialIndex(token[7])
+                        index = self.parseIndex(token[7:])
                         s = SphericalSurface(p,c,r,index)
                     elif token[6].startswith("mirror"):       # else its a mirror
                         s = SphericalSurface(p,c,r)
@@ -1525,7 +2183,7 @@ class DataBaseLens(Lens):
                     c = float(token[3])
                     r = float(token[5])
                     if token[6].startswith("index"):
-                        index = MaterialIndex(token[7])
+                        index = self.parseIndex(token[7:])
                         s = ParabolicSurface(p,c,r,index)
                     elif token[6].startswith("mirror"):
                         s = ParabolicSurface(p,c,r)
@@ -1539,30 +2197,81 @@ class DataBaseLens(Lens):
                     e = float(token[5])
                     r = float(token[7])
                     if token[8].startswith("index"):
-                        index = MaterialIndex().getIndex(token[9])
-                        s = QuadricSurface(p,c,r,e,index)
+                        index = self.parseIndex(token[9:])
+                        s = QuadricSurface(p,c,e,r,index)
                     elif token[8].startswith("mirror"):
                         s = QuadricSurface(p,c,e,r)
                     else:
                         raise IOError("inknow  index ")
                     self.add(s)
 
+                elif token[0].startswith("asphere"):          # Even asphere
+                    p = float(token[1])
+                    c = float(token[3])
+                    e = float(token[5])
+                    r = float(token[7])
+                    coef = [float(a) for a in token[9].split(",")]
+                    if token[10].startswith("index"):
+                        index = self.parseIndex(token[11:])
+                        s = EvenAsphericSurface(p,c,e,r,coef,index)
+                    elif token[10].startswith("mirror"):
+                        s = EvenAsphericSurface(p,c,e,r,coef)
+                    else:
+                        raise IOError("unknow type")
+                    self.add(s)
+
+                elif token[0].startswith("xypolynomial"):     # XY polynomial freeform
+                    p = float(token[1])
+                    c = float(token[3])
+                    e = float(token[5])
+                    r = float(token[7])
+                    coef = self.parsePolynomial(token[9])
+                    if token[10].startswith("index"):
+                        index = self.parseIndex(token[11:])
+                        s = XYPolynomialSurface(p,c,e,r,coef,index)
+                    elif token[10].startswith("mirror"):
+                        s = XYPolynomialSurface(p,c,e,r,coef)
+                    else:
+                        raise IOError("unknow type")
+                    self.add(s)
+
                 else:
                     print("Unknown token : " + str(token[0]))
 
             #lensfile.close()             # close file
 
 
+    def parseIndex(self,token):
+        """
+        Parse the refractive index tokens following "index:" in a lens file, being either a material name or
+        "grin:" followed by the base material and the comma separated coefficients of a GradedIndex.
 
+        :param token: the tokens
+        :type token: list of str
+        :return: RefractiveIndex
+        """
+        if token[0].startswith("grin"):
+            coef = [float(c) for c in token[2].split(",")]
+            return GradedIndex(Vector2d(),MaterialIndex(token[1]),coef,self)      # About the lens axis, moves with lens
+        else:
+            return MaterialIndex(token[0])
 
 
+    def parsePolynomial(self,token):
+        """
+        Parse the comma separated coefficients of an XY polynomial in a lens file, each of the form "x2y0=1.0e-3" for
+        the x^2 y^0 term.
 
-
-
-
-
-
-
+        :param token: the token
+        :type token: str
+        :return: dict of coefficients keyed by the powers (i,j)
+        """
+        coef = {}
+        for term in token.split(","):
+            powers,value = term.split("=")
+            i,j = powers.lstrip("x").split("y")
+            coef[(int(i),int(j))] = float(value)
+        return coef
 
 
 class OpticalSystem(Lens):
@@ -1613,6 +2322,14 @@ class OpticalSystem(Lens):
         """
         return self[0].entranceAperture()
 
+    def compile(self):
+        """
+        The system is traced group by group with each group using its own TracePlan, so there is no plan for the whole system.
+
+        :return: None
+        """
+        return None
+
     def exitApeture(self):
         """
         Get the exit aperture of the system, being the exit apertrure of the last component.
@@ -334,18 +334,23 @@ class Psf(Vector3d):
         :param plane: The OpticalPlane, of if float OpticalPlane as (0,0,plane)
         :type plane: OpticalPlane or float or None
 
-        This is th main used method to calcaute a psf in a plane.
+        This is th main used method to calcaute a psf in a plane. If the pencil is weighted, (for example
+        from RayPencil.addAdaptiveBeam()), the ray intensities are used as weights.
         """
 
         if isinstance(plane,(float,int)) or isinstance(plane,Vector3d):
             plane = OpticalPlane(plane)
         #          Form the moments
 
+        weighted = getattr(pencil,"weighted",False)
         moments = FixedMoments()    # Initialse
         for r in pencil:
             if r:
                 pt = r.pointInPlane(plane)
-                moments.addPoint(pt)
+                if weighted:
+                    moments.addPoint(pt,r.getIntensity())
+                else:
+                    moments.addPoint(pt)
                 self.wavelength = r.wavelength
 
         # Get the poisting of the centre of the Psf from the moments.
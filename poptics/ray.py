@@ -3,14 +3,19 @@ Set of classes to hold rays for optical ray tracing. This includes Paraxial and
 """
 import math
 from poptics.vector import Vector3d,Vector2d,Unit3d,Angle
-from poptics.wavelength import Spectrum,AirIndex,WavelengthColour,getDefaultWavelength
+from poptics.wavelength import Spectrum,AirIndex,WavelengthColour,getDefaultWavelength,GradedIndex
 from poptics.matrix import ParaxialMatrix,ParaxialGroup,ParaxialPlane
 from matplotlib.pyplot import plot
 from numpy import linspace
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
+import os
 
 Clear = 0             #: Defeine a clear surface.
 Refracting = 1        #: Define a refracting surface.
 Reflecting = 2        #: Define a reflecting surface,
+Break = 3             #: Define a coordinate break.
 
 #   Global Current Angle (mainly used by GUI)
 CurrentAngle = Unit3d(0.0,0.0,1.0)
@@ -48,6 +53,44 @@ def setCurrentSourcePoint(self,p):
     global CurrentSource
     CurrentSource = p.copy()
 
+#   Global to control the fast in place tracing of IntensityRays
+FastTrace = True
+
+def setFastTrace(fast = True):
+    """
+    Function to switch the fast in place tracing used by IntensityRay.propagateThrough(), and the z-intercept
+    propagateFlat() kernel for clear flat surfaces used by IntensityRay, RayPencil and RayBundle, on or off. When off
+    the general SurfaceInteraction method is used for all surfaces, and RayBundle uses the surface getBatchInteraction();
+    mainly used for testing and benchmarking.
+
+    :param fast: use fast tracing (Default = True)
+    :type fast: bool
+    """
+    global FastTrace
+    FastTrace = fast
+
+
+#   Number of worker processes used to trace RayPencils and RayBundles (1 = serial)
+TraceWorkers = 1
+ParallelMinimum = 10000           #: Minimum number of rays for parallel trace
+
+def setTraceWorkers(workers = None, minimum = None):
+    """
+    Function to set the number of worker processes used to trace large RayPencils and RayBundles through
+    surfaces in parallel. The results are identical to serial tracing.
+
+    :param workers: number of worker processes, 1 for serial, (Default = None, number of cpus)
+    :type workers: int or None
+    :param minimum: minimum number of rays to trace in parallel (Default = None, unchanged)
+    :type minimum: int or None
+    """
+    global TraceWorkers, ParallelMinimum
+    if workers == None:
+        workers = os.cpu_count()
+    TraceWorkers = max(int(workers),1)
+    if minimum != None:
+        ParallelMinimum = int(minimum)
+
 
 
 class SourcePoint(Vector3d):
@@ -336,7 +379,7 @@ class Ray(object):
         """
         Implement a draw the ray if there is a a suitable RayPath minotor attacked.
         """
-        if self.monitor != None and isinstance(self.monitor,RayPath):
+        if self.monitor != None and isinstance(self.monitor,(RayPath,PencilPathRow)):
             self.monitor.draw()
 
 #
@@ -789,7 +832,7 @@ class IntensityRay(Ray):
 
     #
     #
-    def propagateThrough(self,surface):
+    def propagateThrough(self,surface,point = None,table = None):
         """
         Method to propagate a ray through surface, or list of ray surfaces.
         This is the main method that does most of the work, it first propagate the
@@ -799,21 +842,46 @@ class IntensityRay(Ray):
 
         :param surface:  Surface or list of list(Surface), if list each one is dealt with in order.
         :type surface: optics.surface.Surface or list of Surfces.
+        :param point: the surface reference point in global coordinates if known (Default = None)
+        :type point: Vector3d or None
+        :param table: refractive index values at the ray wavelength keyed on RefractiveIndex (Default = None)
+        :type table: dict or None
         :return: bool true is passed through, false if blocked.
 
-        Normalled called via the "\*=" operator.
+        Normalled called via the "\*=" operator. If the list has a compile() method, (for example an OpticalGroup),
+        its cached TracePlan is used to supply the surface points and the refractive index table.
 
         """
         #
         #      Deal with list.
         if isinstance(surface,list):
-            for s in surface:                # process each surface in the list in turn
-                b = self.propagateThrough(s)
-                if not b:                    # failed of surface, don't do anymore
-                    break
+            plan = surface.compile() if hasattr(surface,"compile") else None
+            if plan == None:
+                for s in surface:                # process each surface in the list in turn
+                    b = self.propagateThrough(s)
+                    if not b:                    # failed of surface, don't do anymore
+                        break
+            else:
+                table = plan.getIndexTable(self.wavelength)
+                for s,pt,radius in zip(plan.surfaces,plan.points,plan.flatRadius):
+                    if radius == None or not FastTrace or isinstance(self.refractiveindex,GradedIndex):
+                        b = self.propagateThrough(s,pt,table)
+                    else:
+                        b = self.propagateFlat(pt,radius,table)
+                    if not b:
+                        break
 
             return b
 
+        if surface.type == Break:                            # Coordinate break, so transform the ray
+            return surface.transformRay(self,point)
+
+        if isinstance(self.refractiveindex,GradedIndex):     # Curved path to near the surface
+            if not self.propagateGradedIndex(surface,point):
+                return False
+
+        if FastTrace and surface.hasFastInteraction():
+            return self.fastPropagateThrough(surface,point,table)
         #
         #           get interaction info as a list
         #
@@ -826,7 +894,7 @@ class IntensityRay(Ray):
         self.updateMonitor()                # Update the monitor
 
         if self.pathlength != None:       # Update pathlength if valid
-            self.pathlength += info.distance*self.refractiveindex.getValue(self.wavelength)
+            self.pathlength += info.distance*self.getIndexValue(self.refractiveindex,table)
 
 
         #          Check if surface normal is valid
@@ -840,8 +908,8 @@ class IntensityRay(Ray):
             return True
 
         elif info.type == Refracting:                              # Refraction
-            nl = self.refractiveindex.getValue(self)              # Current refractive index
-            nr = info.refractiveindex.getValue(self)              # Refractive index after surface
+            nl = self.getIndexValue(self.refractiveindex,table)   # Current refractive index
+            nr = self.getIndexValue(info.refractiveindex,table)   # Refractive index after surface
             ratio = nr/nl
             b = self.director.refraction(info.normal,ratio)       # Do the refratcion
             if b:
@@ -860,6 +928,145 @@ class IntensityRay(Ray):
         return False                                   # If here we have failed (somehow), return false
 
 
+    def propagateFlat(self,point,radius,table = None):
+        """
+        Propagate the ray to a clear flat surface normal to the optical axis, being the intercept with the plane
+        and a radius test, which gives the same result as propagateThrough(). Called automatically when tracing
+        an OpticalGroup for surfaces where Surface.getFlatRadius() is not None.
+
+        :param point: the surface reference point in global coordinates
+        :type point: Vector3d
+        :param radius: the radius of the surface, inf if not limited
+        :type radius: float
+        :param table: refractive index values at the ray wavelength keyed on RefractiveIndex (Default = None)
+        :type table: dict or None
+        :return: bool true is passed through, false if blocked.
+        """
+        p = self.position
+        u = self.director
+        distance = (point.z - p.z)/u.z
+        p.x += distance*u.x
+        p.y += distance*u.y
+        p.z += distance*u.z
+        self.updateMonitor()
+        if self.pathlength != None:
+            self.pathlength += distance*self.getIndexValue(self.refractiveindex,table)
+
+        dx = p.x - point.x
+        dy = p.y - point.y
+        if distance == distance and (radius == math.inf or dx*dx + dy*dy <= radius*radius):
+            return True
+        self.setInvalid()
+        return False
+
+
+    def propagateGradedIndex(self,surface,point = None):
+        """
+        Propagate the ray through its graded index medium to within tolerance of a surface, see propagateGradedIndex().
+        Called automatically by propagateThrough() when the ray is in a GradedIndex.
+
+        :param surface: the next surface
+        :type surface: optics.surface.Surface
+        :param point: the surface reference point in global coordinates if known (Default = None)
+        :type point: Vector3d or None
+        :return: bool, False if the ray does not reach the surface.
+
+        """
+        p = self.position
+        u = self.director
+        r,u,path,valid = propagateGradedIndex(np.array([[p.x,p.y,p.z]]),np.array([[u.x,u.y,u.z]]),\
+                                              np.array([self.wavelength]),self.refractiveindex,surface,point)
+        if not valid[0]:
+            self.setInvalid()
+            return False
+        self.position = Vector3d(r[0].tolist())
+        self.director = Unit3d(u[0].tolist())
+        if self.pathlength != None:
+            self.pathlength += float(path[0])
+        self.updateMonitor()
+        return True
+
+
+    def getIndexValue(self,index,table = None):
+        """
+        Get the value of a refractive index at the wavelength of the ray, looking it up in the table
+        if present, else calculating it.
+
+        :param index: the refractive index
+        :type index: RefractiveIndex
+        :param table: refractive index values at the ray wavelength keyed on RefractiveIndex (Default = None)
+        :type table: dict or None
+        :return: the value as a float
+
+        """
+        if table != None and index in table:
+            return table[index]
+        else:
+            return index.getValue(self)
+
+
+    def fastPropagateThrough(self,surface,point = None,table = None):
+        """
+        Fast version of propagateThrough() for a single surface that updates the position and director of the
+        ray in place using surface.moveToSurface() without making a SurfaceInteraction, this does the same calculation
+        and gives the same results. Called automatically by propagateThrough() where the surface supports it.
+
+        :param surface: the Surface
+        :type surface: optics.surface.Surface
+        :param point: the surface reference point in global coordinates if known (Default = None)
+        :type point: Vector3d or None
+        :param table: refractive index values at the ray wavelength keyed on RefractiveIndex (Default = None)
+        :type table: dict or None
+        :return: bool true is passed through, false if blocked.
+
+        """
+        distance,nx,ny,nz = surface.moveToSurface(self,point)
+        if distance != distance:                # Distance failed (NaN)
+            self.setInvalid()
+            return False
+
+        self.updateMonitor()                    # Update the monitor
+        n = self.getIndexValue(self.refractiveindex,table) # Current refractive index
+        if self.pathlength != None:             # Update pathlength if valid
+            self.pathlength += distance*n
+
+        if nx != nx:                            # Blocked by surface
+            self.setInvalid()
+            return False
+
+        type = surface.type
+        if type == Clear:
+            return True
+
+        u = self.director
+        if type == Refracting:
+            ratio = self.getIndexValue(surface.refractiveindex,table)/n
+            if ratio != 1.0:                             # Same calcualtion as Unit3d.refraction()
+                a = 1.0/ratio
+                b = u.x*nx + u.y*ny + u.z*nz
+                c = 1.0 - a*a*(1.0 - b*b)
+                if c < 0:
+                    self.setInvalid()                    # Above critical, set invalid
+                    return False
+                c = math.copysign(math.sqrt(c),b)
+                d = c - a*b
+                u.x = u.x*a + nx*d
+                u.y = u.y*a + ny*d
+                u.z = u.z*a + nz*d
+            self.refractiveindex = surface.refractiveindex
+            return True
+
+        elif type == Reflecting:                         # Same calculation as Unit3d.reflection()
+            b = 2.0*(u.x*nx + u.y*ny + u.z*nz)
+            u.x -= b*nx
+            u.y -= b*ny
+            u.z -= b*nz
+            return u.isValid()
+
+        else:
+            raise TypeError("IntensityRay from unknow surface type {0:d}".format(type))
+
+
     def pointInPlane(self,plane):
         """
         Method to calcualte where the ray will striked a specified optical surface
@@ -874,8 +1081,8 @@ class IntensityRay(Ray):
         pt = plane.getPoint()
         if self:
             d = plane.getDistance(self.position,self.director)
-            return Vector2d(self.position.x + d*self.director.x - pt.x,\
-                            self.position.y + d*self.director.y - pt.y)
+            return Vector2d.fromFloats(self.position.x + d*self.director.x - pt.x,\
+                                       self.position.y + d*self.director.y - pt.y)
         else:
             return Vector2d().setInvalid()
 
@@ -1004,6 +1211,215 @@ class RayPath(RayMonitor):
         plot(self.z,self.y,color = col)
 
 
+class PencilPath(RayMonitor):
+    """
+    Class to record the paths of all the rays in a RayPencil in a single preallocated array rather than a
+    RayPath per ray. The path is held in self.path, a (nrays,npoints,3) np.ndarray of x,y,z positions, with
+    unused points set to NaN, self.count, the number of points recorded for each ray, and self.wavelengths.
+    This is added to a RayPencil with RayPencil.addMonitor() and drawn with RayPencil.draw().
+
+    :param nsurfaces: number of surfaces expected, or OpticalGroup or list of surfaces, the buffer will
+        extend if more points are recorded. (Default = 10)
+    :type nsurfaces: int or list
+    """
+    def __init__(self,nsurfaces = 10):
+        RayMonitor.__init__(self)
+        if isinstance(nsurfaces,list):
+            nsurfaces = len(nsurfaces) + 1              # allow for final plane
+        self.npoints = int(nsurfaces) + 1               # Start plus one point per surface
+        self.path = np.full((0,self.npoints,3),float("nan"))
+        self.count = np.zeros(0,dtype = int)
+        self.wavelengths = np.empty(0)
+
+    def copy(self):
+        """
+        Method to form a new empty copy of itself
+        """
+        return PencilPath(self.npoints - 1)
+
+    def __str__(self):
+        """
+        str, return number of rays and number of points in the buffer
+        """
+        return "rays: {0:d} n: {1:d}".format(len(self.count),self.path.shape[1])
+
+    def addPencil(self,pencil):
+        """
+        Allocate the buffer for a pencil and add a PencilPathRow monitor to each ray, which records the
+        current position. Normally called via RayPencil.addMonitor().
+
+        :param pencil: the RayPencil
+        :type pencil: RayPencil
+        :return: self
+
+        """
+        n = len(pencil)
+        self.path = np.full((n,self.npoints,3),float("nan"))
+        self.count = np.zeros(n,dtype = int)
+        self.wavelengths = np.array([r.wavelength for r in pencil],dtype = float)
+        for i,r in enumerate(pencil):
+            r.addMonitor(PencilPathRow(self,i))
+        return self
+
+    def record(self,i,ray):
+        """
+        Record the current position of a ray as the next point in row i, extending the buffer if full.
+        Called automatically by the PencilPathRow monitor as the ray is propagated.
+
+        :param i: the row of the ray
+        :type i: int
+        :param ray: the ray
+        :type ray: Ray
+
+        """
+        j = self.count[i]
+        if j == self.path.shape[1]:                     # Buffer full, so double it
+            self.path = np.concatenate((self.path,np.full(self.path.shape,float("nan"))),axis = 1)
+        if isinstance(ray,ParaxialRay):
+            self.path[i,j] = 0.0,ray.h,ray.z
+        else:
+            self.path[i,j] = ray.position.x,ray.position.y,ray.position.z
+        self.count[i] = j + 1
+
+    def getPath(self,i):
+        """
+        Get the recorded path of ray i.
+
+        :param i: the row of the ray
+        :type i: int
+        :return: (n,3) np.ndarray of the recorded points.
+
+        """
+        return self.path[i,:self.count[i]]
+
+    def draw(self):
+        """
+        Plot all the paths to the current axis with a single plot call for each wavelength, (so normally a single call),
+        with the colour given by wavelength.WavelengthColour. The paths are joined with NaN breaks.
+
+        """
+        #           Add a NaN point to the end of each path to break the lines.
+        path = np.concatenate((self.path,np.full((len(self.count),1,3),float("nan"))),axis = 1)
+        for w in np.unique(self.wavelengths):
+            p = path[self.wavelengths == w]
+            plot(p[:,:,2].ravel(),p[:,:,1].ravel(),color = WavelengthColour(float(w)))
+
+
+class PencilPathRow(object):
+    """
+    Light weight monitor added to each ray by PencilPath to record the ray position in a row of the PencilPath
+    buffer. Not normally created by the user.
+
+    :param buffer: the PencilPath
+    :type buffer: PencilPath
+    :param row: the row in the buffer
+    :type row: int
+    """
+    __slots__ = ("buffer","row")
+
+    def __init__(self,buffer,row):
+        self.buffer = buffer
+        self.row = row
+
+    def update(self,ray):
+        """
+        Record the ray position in the buffer, called automatically as the ray is propagated.
+        """
+        self.buffer.record(self.row,ray)
+
+    def copy(self):
+        """
+        Copy, being a new row monitor of a the same row.
+        """
+        return PencilPathRow(self.buffer,self.row)
+
+    def draw(self):
+        """
+        Plot the path of this row.
+        """
+        p = self.buffer.getPath(self.row)
+        plot(p[:,2],p[:,1],color = WavelengthColour(float(self.buffer.wavelengths[self.row])))
+
+
+
+
+def getPupilSamples(key = "vl", nrays = 10, radius = 1.0):
+    """
+    Function to get the sample points and weights across a circular pupil, as used by RayPencil.addBeam()
+    and RayBundle.addBeam(). The allowed keys are:
+
+    - "vl" vertical line of 2*nrays + 1 points.
+    - "hl" horizontal line of 2*nrays + 1 points.
+    - "array" square array of 2*nrays + 1 points each way, masked to the pupil.
+    - "hexapolar" centre point plus nrays rings with 6k points on ring k.
+    - "fibonacci" Fibonacci spiral with about the same number of points as "array".
+    - "gaussian" hexapolar points with Gaussian weights, exp(-2r^2/radius^2), so 1/e^2 at the edge.
+    - "halton" or "sobol" low discrepancy sequences with an equal area mapping to the pupil.
+
+    All except "gaussian" have weight 1.0.
+
+    :param key: the sampling pattern, (Default = "vl")
+    :type key: str
+    :param nrays: number of rays across radius, (Default = 10)
+    :type nrays: int
+    :param radius: radius of the pupil, (Default = 1.0)
+    :type radius: float
+    :return: x,y,weight as np.ndarray relative to the centre of the pupil
+
+    """
+    if key.startswith("ar") or key.startswith("vl") or key.startswith("hl"):
+        rscan = np.linspace(-radius,radius,2*nrays + 1)   # Point across radius (make sure one in centre)
+        if key.startswith("ar"):
+            x,y = np.meshgrid(rscan,rscan)
+        elif key.startswith("vl"):
+            y = rscan
+            x = np.zeros(y.size)
+        else:
+            x = rscan
+            y = np.zeros(x.size)
+        x = x.ravel()
+        y = y.ravel()
+        inside = x*x + y*y <= radius*radius           # Ignore if outside radius of aperture
+        x = x[inside]
+        y = y[inside]
+
+    elif key.startswith("hex") or key.startswith("gau"):
+        k = np.repeat(np.arange(1,nrays + 1),6*np.arange(1,nrays + 1))     # Ring of each point
+        j = np.arange(k.size) - 3*k*(k - 1)                                  # Point in ring
+        r = radius*k/nrays
+        theta = 2.0*math.pi*j/(6*k)
+        x = np.concatenate(([0.0],r*np.sin(theta)))
+        y = np.concatenate(([0.0],r*np.cos(theta)))
+
+    elif key.startswith("fib"):
+        n = int(round(math.pi*nrays*nrays)) + 1
+        i = np.arange(n)
+        r = radius*np.sqrt((i + 0.5)/n)
+        theta = math.pi*(3.0 - math.sqrt(5.0))*i      # Golden angle
+        x = r*np.sin(theta)
+        y = r*np.cos(theta)
+
+    elif key.startswith("hal") or key.startswith("sob"):
+        from scipy.stats import qmc                   # Only needed here and slow to import
+        n = int(round(math.pi*nrays*nrays)) + 1
+        if key.startswith("hal"):
+            uv = qmc.Halton(d = 2,scramble = False).random(n)
+        else:
+            uv = qmc.Sobol(d = 2,scramble = False).random_base2(max(int(math.ceil(math.log2(n))),0))
+        r = radius*np.sqrt(uv[:,0])                   # Equal area mapping
+        theta = 2.0*math.pi*uv[:,1]
+        x = r*np.sin(theta)
+        y = r*np.cos(theta)
+
+    else:
+        raise ValueError("ray.getPupilSamples: unknown key {0:s}".format(key))
+
+    if key.startswith("gau"):
+        weight = np.exp(-2.0*(x*x + y*y)/(radius*radius))
+    else:
+        weight = np.ones(x.size)
+
+    return x,y,weight
 
 #
 class RayPencil(list):
@@ -1013,6 +1429,14 @@ class RayPencil(list):
 
     :param \*args: list of rays to be added to the Pancil (Default = None)
 
+    There are two local variables to control removal of invalid rays,
+
+    - self.autoCompact = False (if True invalid rays are removed after each surface of an OpticalGroup)
+    - self.blocked = None (if a list, rays removed by removeInvalid() are appended as (surface index, ray))
+
+    and self.weighted = False, set True when the ray intensities carry sample weights, (see addBeam() and addAdaptiveBeam()),
+    so the intensities are used as weights by psf.Psf.setWithRays().
+
     """
 
     def __init__(self, *args):
@@ -1020,6 +1444,10 @@ class RayPencil(list):
         Make a ray pencil with optional set of rays to be appended.
         """
         list.__init__(self)
+        self.autoCompact = False       # Remove invalid rays between surfaces
+        self.blocked = None            # Record of removed rays
+        self.monitor = None            # PencilPath if added
+        self.weighted = False          # Intensities carry sample weights
 
         for r in args:
             self.append(r)
@@ -1055,7 +1483,7 @@ class RayPencil(list):
         return self
 
 
-    def addBeam(self, ca, source, key = "vl", nrays = 10, wavelength = None, intensity = 1.0, index = AirIndex(), path = False):
+    def addBeam(self, ca, source, key = "vl", nrays = 10, wavelength = None, intensity = 1.0, index = AirIndex(), path = False, aim = False):
         """
         Method to add a beam if intensity rays being either Collimated or Source Beam. The beam will fill the given circular aperture and will
         either come from a single SourcePoint or at a specified angle.
@@ -1064,23 +1492,63 @@ class RayPencil(list):
         :type ca: optics.surface.CircularAperture
         :param source: source or rays, either a SourcePoint or angle.
         :type source: SourcePoint or Vectore3d or Unit3d or Angle or float
-        :param key: method of fill, allowed keys as "vl", "hl" and "array",(default is "vl")
+        :param key: method of fill, allowed keys as "vl", "hl", "array", "hexapolar", "fibonacci", "gaussian", "halton" and "sobol", see getPupilSamples(), (default is "vl")
         :type key: str
         :param nrays: number or rays across radius, (default = 10)
         :type nrays: int
         :param wavelenth: the wavelength, (default = Default)
         :type wavelength: float
-        :param intensity: the ray intensity, (default = 1.0) only used for Collimated beam; for SourceBeam picked up from SourcePoint
+        :param intensity: the ray intensity, (default = 1.0) only used for Collimated beam; for SourceBeam picked up from SourcePoint. This is multiplied by the sample weight.
         :type intensity: float
         :param index: the refratcive index, (Default = AirIndex())
         :type index: RefractiveIndex
         :param path: record pathlength, (default = False) is pathlength of each ray recorded
         :type path: bool
+        :param aim: use real ray aiming to fill the stop of the lens, see lens.Lens.getAimedPupil(), (Default = False)
+        :type aim: bool
         :return: self
 
         """
+        if aim and hasattr(ca,"getAimedPupil"):   # Fill the real stop
+            pupil = ca.getAimedPupil(source,wavelength)
+            x,y,weight = getPupilSamples(key,nrays,1.0)
+            x,y = pupil.getPoints(x,y)
+            return self.addPupilRays(pupil.aperture,source,x,y,weight,wavelength,intensity,index,path)
 
         #          Sort out aperture to fill.
+        if not hasattr(ca, "maxRadius"):
+            ca = ca.entranceAperture()
+
+        x,y,weight = getPupilSamples(key,nrays,ca.maxRadius)
+        return self.addPupilRays(ca,source,x,y,weight,wavelength,intensity,index,path)
+
+
+    def addPupilRays(self, ca, source, x, y, weight = None, wavelength = None, intensity = 1.0, index = AirIndex(), path = False):
+        """
+        Method to add rays through specified points in a circular aperture, being either Collimated or from a SourcePoint.
+        This is used by addBeam() and addAdaptiveBeam().
+
+        :param ca: circular aperture (any object with maxRadius attribute, or a lens)
+        :type ca: optics.surface.CircularAperture
+        :param source: source or rays, either a SourcePoint or angle.
+        :type source: SourcePoint or Vectore3d or Unit3d or Angle or float
+        :param x: x position of the points relative to the centre of the aperture
+        :type x: np.ndarray
+        :param y: y position of the points relative to the centre of the aperture
+        :type y: np.ndarray
+        :param weight: the weight of each point multiplying the intensity, (Default = None, all 1.0)
+        :type weight: np.ndarray or None
+        :param wavelenth: the wavelength, (default = Default)
+        :type wavelength: float
+        :param intensity: the ray intensity, (default = 1.0) only used for Collimated beam; for SourceBeam picked up from SourcePoint.
+        :type intensity: float
+        :param index: the refratcive index, (Default = AirIndex())
+        :type index: RefractiveIndex
+        :param path: record pathlength, (default = False) is pathlength of each ray recorded
+        :type path: bool
+        :return: self
+
+        """
         if not hasattr(ca, "maxRadius"):
             ca = ca.entranceAperture()
         pt = ca.getPoint()         # Reference point
@@ -1093,41 +1561,180 @@ class RayPencil(list):
             s = Vector3d().setInvalid()             # Set s unvalid (will be used for testing)
             u = Unit3d().parseAngle(source)
 
-        rscan = linspace(-radius,radius,2*nrays + 1)   # Point across radius (make sure one in centre)
-        if key.startswith("ar"):
-            xscan = rscan
-            yscan = rscan
-        elif key.startswith("vl"):
-            xscan = [0.0]
-            yscan = rscan
-        elif key.startswith("hl"):
-            xscan = rscan
-            yscan = [0.0]
+        x = np.asarray(x,dtype = float)
+        y = np.asarray(y,dtype = float)
+        px = pt.x + x                              # Points in aperture in global coordinates
+        py = pt.y + y
+        pz = np.full(x.size,pt.z)
+        if s:                                      # From source, director from source to point
+            dx = px - s.x
+            dy = py - s.y
+            dz = pz - s.z
+            with np.errstate(divide = "ignore",invalid = "ignore"):
+                a = np.sqrt(dx*dx + dy*dy + dz*dz)
+                a[a == 0.0] = float("nan")         # Invalid if point at source
+                ux,uy,uz = dx/a,dy/a,dz/a
+            px = np.full(x.size,s.x)
+            py = np.full(x.size,s.y)
+            pz = np.full(x.size,s.z)
+        else:                                      # Collimated beam
+            dist = radius + x*u.x + y*u.y          # Propagate point to make it look nicer
+            px -= dist*u.x
+            py -= dist*u.y
+            pz -= dist*u.z
+            ux,uy,uz = np.full(x.size,u.x),np.full(x.size,u.y),np.full(x.size,u.z)
+        if weight is not None and np.any(weight != 1.0):      # Weighted samples
+            intensity = (intensity*np.asarray(weight)).tolist()
+            self.weighted = True
         else:
-            print("Error")
+            intensity = [intensity]*x.size
 
+        # Make the rays
+        for p in zip(px.tolist(),py.tolist(),pz.tolist(),ux.tolist(),uy.tolist(),uz.tolist(),intensity):
+            ray = IntensityRay(Vector3d.fromFloats(p[0],p[1],p[2]),Unit3d.fromFloats(p[3],p[4],p[5]),wavelength,p[6],index)
+            if path:
+                ray.pathlength = 0.0
+            self.append(ray)                       # Append to self
 
-        # Scan through making the rays
-        for y in yscan:
-            for x in xscan:
-                if x*x + y*y <= radius*radius:                 # Ignore if outside radius of aperture
-                    p = Vector3d(pt.x + x, pt.y + y, pt.z)     # Point in aperture in global coordinates
-                    if s:                                      # From source
-                         u = Unit3d(p - s)
-                         ray = IntensityRay(s,u,wavelength,intensity,index)    # Make source ray
-                    else:                                      # Collimated beam
-                        dist = float(radius + x*u.x + y*u.y)
-                        p -= dist*u                                # Propagate point to make it look nicer
-                        ray = IntensityRay(p,u,wavelength,intensity,index)     # Make collimated
-                    if path:
-                        ray.pathlength = 0.0
-                    self.append(ray)                           # Append to self
+        return self
 
 
-        return self
 
 
 
+    def addAdaptiveBeam(self, lens, source, plane, tolerance = 0.01, nrays = 4, maxlevel = 5, wavelength = None, intensity = 1.0, \
+                        index = AirIndex(), path = False):
+        """
+        Method to add a beam of rays that fills the entrance aperture of a lens with adaptive sampling and traced through the lens.
+        The aperture is divided into square cells with one ray at the centre of each, (starting as the "array" pattern of addBeam()),
+        where cells that cross the edge of the aperture with their centre outside are divided at once and only their sub-cells with
+        centres inside are traced. Cells are divided into four where they cross the edge of the aperture, where the ray and a neighbouring ray differ
+        in validity, (so at the edge of a vignetted pupil), or where they diverge in the plane much more strongly than the median,
+        (so in caustic zones). This is
+        repeated until the weighted spot RMS radius in the plane changes by less than tolerance (as a fraction) or the maximum
+        level of division is reached.
+
+        Each ray has intensity multiplied by the area of its cell, (1.0 for a cell at the start), and self.weighted is set
+        True, so the pencil can be used directly with psf.Psf.setWithRays() and psf.SpotDiagram.
+
+        :param lens: the lens to fill and trace the rays through
+        :type lens: OpticalGroup
+        :param source: source or rays, either a SourcePoint or angle.
+        :type source: SourcePoint or Vectore3d or Unit3d or Angle or float
+        :param plane: the plane used to assess the spot, or float for OpticalPlane at (0,0,plane)
+        :type plane: OpticalPlane or float
+        :param tolerance: fractional change in spot RMS radius for convergence (Default = 0.01)
+        :type tolerance: float
+        :param nrays: number of rays across radius at the start (Default = 4)
+        :type nrays: int
+        :param maxlevel: maximum number of divisions of a cell (Default = 5)
+        :type maxlevel: int
+        :param wavelenth: the wavelength, (default = Default)
+        :type wavelength: float
+        :param intensity: the ray intensity, (default = 1.0) only used for Collimated beam; for SourceBeam picked up from SourcePoint
+        :type intensity: float
+        :param index: the refratcive index, (Default = AirIndex())
+        :type index: RefractiveIndex
+        :param path: record pathlength, (default = False) is pathlength of each ray recorded
+        :type path: bool
+        :return: self
+
+        """
+        if isinstance(plane,(float,int)):
+            from poptics.surface import OpticalPlane      # Not at top since surface imports ray
+            plane = OpticalPlane(plane)
+        ca = lens.entranceAperture()
+        radius = ca.maxRadius
+        h0 = radius/max(nrays,1)                     # Size of starting cell
+        origin = -(nrays + 0.5)*h0                   # Lower edge of starting cells
+
+        def centre(c):                               # Centre and size of a cell
+            h = h0*0.5**c[0]
+            return origin + (c[1] + 0.5)*h,origin + (c[2] + 0.5)*h,h
+
+        cells = {}                                   # (level,i,j) : [ray,point] for each leaf cell, ray None if not traced
+        new = [(0,i,j) for i in range(2*nrays + 1) for j in range(2*nrays + 1)]
+        rms = float("nan")
+        for level in range(maxlevel + 1):
+            #          Cells with centre outside but crossing the edge are divided, and their outside sub-cells held untraced
+            trace = []
+            for c in new:
+                x,y,h = centre(c)
+                if math.hypot(x,y) <= radius:
+                    trace.append(c)
+                elif math.hypot(x,y) - 0.7072*h <= radius and c[0] < maxlevel:
+                    for a in (0,1):
+                        for b in (0,1):
+                            sub = (c[0] + 1,2*c[1] + a,2*c[2] + b)
+                            x,y,h = centre(sub)
+                            if math.hypot(x,y) <= radius:
+                                trace.append(sub)
+                            elif math.hypot(x,y) - 0.7072*h <= radius:
+                                cells[sub] = [None,None]      # Divided again at next level
+
+            #          Make and trace rays at centre of cells inside the aperture
+            x,y,h = np.array([centre(c) for c in trace]).reshape(-1,3).T
+            pencil = RayPencil().addPupilRays(ca,source,x,y,(h/h0)**2,wavelength,intensity,index,path)
+            pencil *= lens
+            for c,r in zip(trace,pencil):
+                p = r.pointInPlane(plane) if r else None
+                cells[c] = [r,p]
+
+            #          Weighted spot RMS radius in the plane
+            last = rms
+            pts = [(cell[0].getIntensity(),cell[1].x,cell[1].y) for cell in cells.values() if cell[0]]
+            if len(pts) == 0:
+                break
+            w,px,py = np.array(pts).T
+            cx = np.sum(w*px)/np.sum(w)
+            cy = np.sum(w*py)/np.sum(w)
+            rms = math.sqrt(np.sum(w*((px - cx)**2 + (py - cy)**2))/np.sum(w))
+            if abs(rms - last) <= tolerance*rms or level == maxlevel:
+                break
+
+            #          Find pairs of neighbouring cells that differ and mark for division
+            divide = set()
+            slopes = []
+            pairs = []
+            for c,cell in cells.items():
+                l,i,j = c
+                x,y,h = centre(c)
+                if math.hypot(x,y) + 0.7072*h > radius:
+                    divide.add(c)                                  # Cell crosses edge of aperture
+                if cell[0] == None:
+                    continue                                       # Untraced edge cell
+                for n in ((l,i + 1,j),(l,i - 1,j),(l,i,j + 1),(l,i,j - 1)):
+                    while n not in cells and n[0] > 0:           # Look for containing coarser cell
+                        n = (n[0] - 1,n[1]//2,n[2]//2)
+                    if n in cells and n != c and cells[n][0] != None:
+                        other = cells[n]
+                        if bool(cell[0]) != bool(other[0]):       # Change of validity
+                            divide.update((c,n))
+                        elif cell[0]:
+                            d = h0*(0.5**l + 0.5**n[0])/2.0      # Distance between centres in pupil
+                            slope = math.hypot(cell[1].x - other[1].x,cell[1].y - other[1].y)/d
+                            slopes.append(slope)
+                            pairs.append((slope,c,n))
+            if len(slopes) > 0:
+                limit = 2.0*float(np.median(slopes))
+                for slope,c,n in pairs:
+                    if slope > limit:
+                        divide.update((c,n))
+
+            new = []
+            for c in divide:
+                if c[0] < maxlevel and c in cells:
+                    del cells[c]
+                    l,i,j = c
+                    new += [(l + 1,2*i + a,2*j + b) for a in (0,1) for b in (0,1)]
+            if len(new) == 0:
+                break
+
+        for c in sorted(cells):
+            if cells[c][0] != None:
+                self.append(cells[c][0])
+        self.weighted = True
+        return self
 
 
     def addCollimatedParaxialBeam(self,ca,u,nrays = 10 ,wave = getDefaultWavelength() , intensity = 1.0):
@@ -1186,13 +1793,39 @@ class RayPencil(list):
         return self
     #
     #
-    def removeInvalid(self):
+    def removeInvalid(self,surface = None):
         """
-        Method to remove invalid rays from the pencil
+        Method to remove invalid rays from the pencil in a single pass.
+
+        :param surface: index of the surface that blocked the rays, recorded in self.blocked (Default = None)
+        :type surface: int or None
+        :return: self
+
         """
-        for r in self:
-            if not r :
-                self.remove(r)
+        if self.blocked != None:                  # Record removed rays
+            self.blocked.extend([(surface,r) for r in self if not r])
+        self[:] = [r for r in self if r]
+        return self
+
+    def setCompact(self,compact = True,record = False):
+        """
+        Set automatic removal of invalid rays after each surface when propagating through an OpticalGroup,
+        so later surfaces do not process rays that have already been blocked. This is useful for heavily
+        vignetted systems.
+
+        :param compact: remove invalid rays after each surface (Default = True)
+        :type compact: bool
+        :param record: record the removed rays with the index of the surface that blocked them in self.blocked (Default = False)
+        :type record: bool
+        :return: self
+
+        """
+        self.autoCompact = compact
+        if record:
+            self.blocked = []
+        else:
+            self.blocked = None
+        return self
 
     def rotateAboutX(self,angle,origin = None):
         """
@@ -1230,11 +1863,89 @@ class RayPencil(list):
         :param sur: the Surface of OpticalGroup
         :type sur: Surface or OpticlGroup
 
+        If self.autoCompact is set the pencil of IntensityRays is propagated through an OpticalGroup one surface
+        at a time with invalid rays removed after each surface.
+
         """
+        if TraceWorkers > 1 and len(self) >= ParallelMinimum and self.isParallel(sur):
+            return self.parallelPropagateThrough(sur)
+
+        plan = sur.compile() if self.autoCompact and hasattr(sur,"compile") else None
+        if plan != None:
+            for i,(s,pt,radius) in enumerate(zip(plan.surfaces,plan.points,plan.flatRadius)):
+                for r in self:
+                    if radius == None or not FastTrace or isinstance(r.refractiveindex,GradedIndex):
+                        r.propagateThrough(s,pt,plan.getIndexTable(r.wavelength))
+                    else:
+                        r.propagateFlat(pt,radius,plan.getIndexTable(r.wavelength))
+                self.removeInvalid(i)
+            return self
+
         for r in self:             # For each ray
             if r:                  # in  each ray is valid
                 r.propagateThrough(sur)
 
+        if self.autoCompact:
+            self.removeInvalid()
+
+        return self
+
+
+    def isParallel(self,sur):
+        """
+        Test if the pencil can be traced in parallel, so it must be IntensityRays in the same refractive index
+        without monitors being traced through surfaces with batch interactions.
+
+        :param sur: the Surface or OpticalGroup
+        :type sur: Surface or OpticalGroup
+        :return: bool
+
+        """
+        if len(self) == 0 or not isBatchSurface(sur):
+            return False
+        index = self[0].refractiveindex
+        for r in self:
+            if not isinstance(r,IntensityRay) or r.monitor != None or r.refractiveindex is not index:
+                return False
+        return True
+
+    def parallelPropagateThrough(self,sur,workers = None):
+        """
+        Propagate the pencil through a Surface or OpticalGroup using a pool of worker processes. The rays are
+        held in shared memory and traced in chunks as RayBundles, giving identical results to serial tracing.
+        Normally called automatically by propagateThrough() for large pencils, see setTraceWorkers().
+
+        :param sur: the Surface or OpticalGroup
+        :type sur: Surface or OpticalGroup
+        :param workers: number of worker processes (Default = None, use the value set by setTraceWorkers())
+        :type workers: int or None
+        :return: self
+
+        Rays with a monitor or paraxial rays are not supported and raise a TypeError.
+        """
+        if not self.isParallel(sur):
+            raise TypeError("ray.RayPencil.parallelPropagateThrough: pencil or surface can not be traced in parallel")
+
+        bundle = RayBundle(index = self[0].refractiveindex)
+        n = len(self)
+        bundle.positions = np.array([[r.position.x,r.position.y,r.position.z] for r in self])
+        bundle.directors = np.array([[r.director.x,r.director.y,r.director.z] for r in self])
+        bundle.wavelengths = np.array([r.wavelength for r in self],dtype = float)
+        bundle.intensities = np.ones(n)
+        bundle.pathlengths = np.array([0.0 if r.pathlength == None else r.pathlength for r in self])
+        bundle.valid = np.array([r.isValid() for r in self],dtype = bool)
+
+        bundle.parallelPropagateThrough(sur,workers)
+
+        for i,r in enumerate(self):
+            if r:
+                r.position = Vector3d.fromFloats(*bundle.positions[i].tolist())
+                r.director = Unit3d.fromFloats(*bundle.directors[i].tolist())
+                if r.pathlength != None:
+                    r.pathlength = float(bundle.pathlengths[i])
+                r.refractiveindex = bundle.refractiveindex
+                if not bundle.valid[i]:
+                    r.setInvalid()
         return self
 
 
@@ -1250,11 +1961,16 @@ class RayPencil(list):
 
     def addMonitor(self,monitor = None):
         """
-        Method to add/remove a copy of the monitor to each ray.
+        Method to add/remove a copy of the monitor to each ray. If the monitor is a PencilPath, the path of
+        all rays is recorded in its single buffer.
 
         :param monitor: The RayMonitor, if None, then the monitor is removed.
 
         """
+        if isinstance(monitor,PencilPath):
+            self.monitor = monitor.addPencil(self)
+            return self
+        self.monitor = None
         for r in self:
             if monitor == None:
                 r.addMonitor()
@@ -1266,43 +1982,1560 @@ class RayPencil(list):
     def draw(self):
         """
         Draw each ray in turn to the current plot axis assuming that a RayPath monitor have been added, else it will do nothing.
+        If a PencilPath has been added the whole pencil is drawn from it in a single plot call.
 
         """
+        if self.monitor != None:
+            self.monitor.draw()
+            return
         for r in self:
             r.draw()
 
 
 
-class GaussianBeam(ParaxialRay):
+def reflectDirectors(directors,normals):
     """
-    Class to work with Gaussian Beams that used the uderlying ParaxialRay class
-    being
+    Function to reflect an array of directors from surfaces specified by their surface normals.
+    This is the array version of vector.Unit3d.reflection() and does the same calcualtion.
+
+    :param directors: the directors, these are updated in place
+    :type directors: np.ndarray (N,3)
+    :param normals: the surface normals
+    :type normals: np.ndarray (N,3)
+    :return: the directors
+
     """
-    def __init__(self,p = 0.0 ,waist = 25.0e-3 , wavelength = None, intensity = 1.0):
-        """
-        Construct Gaussan beam
+    b = directors[:,0]*normals[:,0] + directors[:,1]*normals[:,1] + directors[:,2]*normals[:,2]
+    directors -= (2.0*b)[:,np.newaxis]*normals
+    return directors
 
-        :param p: the plane of the beam
-        :type p: float
-        :param waist:   beam waist in mm
-        :type waist: float
-        :param wavelength: wavelength in micoms
-        :type wavelength: float
-        :param intesity: the intensity
-        :type intensity: float
+
+def refractDirectors(directors,normals,ratio):
+    """
+    Function to refract an array of directors through surfaces specified by their surface normals.
+    This is the array version of vector.Unit3d.refraction() and does the identical calcualtion
+    so gives the same results as IntensityRay.propagateThrough().
+
+    :param directors: the directors, these are updated in place
+    :type directors: np.ndarray (N,3)
+    :param normals: the surface normals
+    :type normals: np.ndarray (N,3)
+    :param ratio: the ratio of refractive index at the boundary
+    :type ratio: np.ndarray (N,) or float
+    :return: (N,) boolean array, True if above critical angle, these directors are not altered.
+
+    """
+    ratio = np.broadcast_to(ratio,len(directors))
+    a = 1.0/ratio
+    b = directors[:,0]*normals[:,0] + directors[:,1]*normals[:,1] + directors[:,2]*normals[:,2]
+    c = 1.0 - a*a*(1.0 - b*b)
+    critical = c < 0
+
+    i = np.flatnonzero(~critical & (ratio != 1.0))     # Rays to refract, ratio of 1 has nothing to do
+    a = a[i]
+    b = b[i]
+    c = np.copysign(np.sqrt(c[i]),b)
+    d = c - a*b
+    directors[i] = directors[i]*a[:,np.newaxis] + normals[i]*d[:,np.newaxis]
+    return critical
+
+
+#     Dormand-Prince 5(4) coefficients used by propagateGradedIndex()
+DormandPrinceA = [[],[1/5],[3/40,9/40],[44/45,-56/15,32/9],[19372/6561,-25360/2187,64448/6561,-212/729],\
+                  [9017/3168,-355/33,46732/5247,49/176,-5103/18656],[35/384,0.0,500/1113,125/192,-2187/6784,11/84]]
+DormandPrinceE = [35/384 - 5179/57600,0.0,500/1113 - 7571/16695,125/192 - 393/640,\
+                  -2187/6784 + 92097/339200,11/84 - 187/2100,-1/40]
+
+def propagateGradedIndex(positions,directors,wavelengths,index,surface,point = None,tolerance = 1.0e-6,\
+                         step = 1.0,maxsteps = 10000):
+    """
+    Function to propagate arrays of rays through a graded index medium up to a surface by integrating the ray
+    equation d/ds(n dr/ds) = grad n with an adaptive step Dormand-Prince Runge-Kutta method. This is written
+    with T = n dr/ds and parameter dt = ds/n, so that dr/dt = T, dT/dt = n grad n and the optical pathlength
+    increases by n^2 dt. All the rays are integrated together, each with its own step size.
+
+    The steps are limited so the rays do not cross the surface, and the integration stops when the rays are within
+    tolerance of the surface, the final move to the surface is then done by the normal surface interaction.
+
+    :param positions: the ray positions
+    :type positions: np.ndarray (N,3)
+    :param directors: the ray directors
+    :type directors: np.ndarray (N,3)
+    :param wavelengths: the ray wavelengths
+    :type wavelengths: np.ndarray (N,)
+    :param index: the graded index
+    :type index: poptics.wavelength.GradedIndex
+    :param surface: the surface the rays are propagating to
+    :type surface: poptics.surface.Surface
+    :param point: the surface reference point in global coordinates if known (Default = None)
+    :type point: Vector3d or None
+    :param tolerance: the error per step and the distance from the surface to stop (Default = 1.0e-6 mm)
+    :type tolerance: float
+    :param step: the initial step in mm (Default = 1.0)
+    :type step: float
+    :param maxsteps: the maximum number of steps, rays not reaching the surface are invalid (Default = 10000)
+    :type maxsteps: int
+    :return: positions (N,3), directors (N,3), pathlengths (N,) and valid (N,) arrays
+
+    """
+    r = np.array(positions,dtype = float)
+    n = index.getArrayValues(r,wavelengths)
+    t = np.array(directors,dtype = float)*n[:,np.newaxis]     # Optical direction vector
+    path = np.zeros(len(r))
+    valid = np.ones(len(r),dtype = bool)
+    h = step/n                                  # Step in t for each ray
+    active = np.arange(len(r))
+
+    def distanceTo(r,t):
+        u = t/np.sqrt((t*t).sum(axis = 1))[:,np.newaxis]
+        return surface.getBatchInteraction(r,u,point)[0]
+
+    distance = distanceTo(r,t)
+    for i in range(maxsteps):
+        #      Rays that are done or miss the surface
+        miss = np.isnan(distance)
+        valid[active[miss]] = False
+        done = miss | (np.abs(distance) < tolerance)
+        active = active[~done]
+        distance = distance[~done]
+        if len(active) == 0:
+            break
+        ra = r[active]
+        ta = t[active]
+        w = wavelengths[active]
+        na = np.sqrt((ta*ta).sum(axis = 1))
+        ha = np.minimum(h[active],distance/na)      # Do not step past the surface
+
+        #      Dormand-Prince stages
+        kr = []
+        kt = []
+        kp = []
+        for a in DormandPrinceA:
+            rs = ra.copy()
+            ts = ta.copy()
+            for j,c in enumerate(a):
+                if c != 0.0:
+                    rs += (c*ha)[:,np.newaxis]*kr[j]
+                    ts += (c*ha)[:,np.newaxis]*kt[j]
+            ns,grad = index.getArrayGradients(rs,w)
+            kr.append(ts)
+            kt.append(ns[:,np.newaxis]*grad)
+            kp.append(ns*ns)
+        b = DormandPrinceA[-1]
+        rn = ra + ha[:,np.newaxis]*sum(c*k for c,k in zip(b,kr))
+        tn = ta + ha[:,np.newaxis]*sum(c*k for c,k in zip(b,kt))
+        pn = ha*sum(c*k for c,k in zip(b,kp))
+        er = ha[:,np.newaxis]*sum(c*k for c,k in zip(DormandPrinceE,kr))
+        et = ha[:,np.newaxis]*sum(c*k for c,k in zip(DormandPrinceE,kt))
+        error = np.maximum(np.abs(er).max(axis = 1),np.abs(et).max(axis = 1))/tolerance
+
+        #      Accept steps within tolerance that do not cross the surface
+        dn = distanceTo(rn,tn)
+        accept = (error <= 1.0) & ~(dn < -tolerance)
+        k = active[accept]
+        r[k] = rn[accept]
+        t[k] = tn[accept]
+        path[k] += pn[accept]
+        distance = np.where(accept,dn,distance)
+
+        #      New step sizes
+        with np.errstate(divide = "ignore"):
+            scale = np.clip(0.9*np.power(error,-0.2),0.2,5.0)
+        scale[~accept & (dn < -tolerance) & (error <= 1.0)] = 0.5    # Crossed surface
+        h[active] = ha*scale
+    else:
+        valid[active] = False                   # Not reached surface
+
+    u = t/np.sqrt((t*t).sum(axis = 1))[:,np.newaxis]
+    return r,u,path,valid
+
+
+def fresnelReflectance(directors,normals,ratio):
+    """
+    Function to get the unpolarised Fresnel reflectance for an array of directors at surfaces specified by their surface
+    normals, being the mean of the s and p reflectances. Rays above the critical angle have a reflectance of 1.
+
+    :param directors: the directors
+    :type directors: np.ndarray (N,3)
+    :param normals: the surface normals
+    :type normals: np.ndarray (N,3)
+    :param ratio: the ratio of refractive index at the boundary
+    :type ratio: np.ndarray (N,) or float
+    :return: (N,) np.ndarray of reflectances
+
+    """
+    ratio = np.broadcast_to(ratio,len(directors))
+    a = 1.0/ratio
+    b = np.abs(directors[:,0]*normals[:,0] + directors[:,1]*normals[:,1] + directors[:,2]*normals[:,2])
+    c = 1.0 - a*a*(1.0 - b*b)
+    critical = c < 0
+    c = np.sqrt(np.where(critical,0.0,c))
+    rs = ((b - ratio*c)/(b + ratio*c))**2
+    rp = ((c - ratio*b)/(c + ratio*b))**2
+    return np.where(critical,1.0,0.5*(rs + rp))
+
+
+class RayBundle(object):
+    """
+    Class to hold a bundle of intensity rays as contiguous NumPy arrays rather than as a list of
+    IntensityRay objects as in RayPencil. This avoids the per-ray object overhead so is suitable for
+    very large numbers of rays. All rays in the bundle are assumed to be in the same refractive index,
+    which will be the case for sequential ray tracing.
+
+    The ray information is held in:
+
+    - self.positions (N,3) array of ray positions in global coordinates.
+    - self.directors (N,3) array of ray directors (normalised).
+    - self.wavelengths (N,) array of wavelengths in microns.
+    - self.intensities (N,) array of intensities.
+    - self.pathlengths (N,) array of optical pathlengths.
+    - self.valid (N,) boolean array, True if the ray is valid.
+    - self.waveaxis (K,) array of wavelengths if set by setWavelengths(), else None.
+
+    :param positions: ray positions as (N,3) array or list (Default = None, empty bundle)
+    :type positions: np.ndarray or list
+    :param directors: ray directors as (N,3) array or list, will be normalised (Default = None)
+    :type directors: np.ndarray or list
+    :param wavelength: wavelength of the rays, float or (N,) array (Default = None, package default)
+    :type wavelength: float or np.ndarray
+    :param intensity: ray intensities, float or (N,) array (Default = 1.0)
+    :type intensity: float or np.ndarray
+    :param index: the refractive index the rays are in, (Default = AirIndex())
+    :type index: RefractiveIndex
+
+    Normally the bundle is formed by .addBeam() in the same way as a RayPencil.
+    """
+
+    def __init__(self, positions = None, directors = None, wavelength = None, intensity = 1.0, index = AirIndex()):
         """
-        ParaxialRay.__init__(self,0.0,0.0,p,wavelength,intensity)     # Paraxial Ray class
-        self.wavelengthMM = self.wavelength/1000.0                    # wavelength in mm
-        gamma = math.pi*waist*waist/self.wavelengthMM
-        alpha = 1.0/gamma
-        self.beam = complex(0.0,-alpha)
+        Make a bundle of rays, if no positions, it will be empty.
+        """
+        self.positions = np.empty((0,3))
+        self.directors = np.empty((0,3))
+        self.wavelengths = np.empty(0)
+        self.intensities = np.empty(0)
+        self.pathlengths = np.empty(0)
+        self.valid = np.empty(0,dtype = bool)
+        self.refractiveindex = index
+        self.waveaxis = None                 # Wavelengths set by setWavelengths()
+        self.shared = False                  # Rays at each wavelength on same path
+        if positions is not None:
+            self.addRays(positions,directors,wavelength,intensity)
 
 
     def __str__(self):
         """
-        The str() method
+        Implement str() to give number of rays, number of valid rays and refractive index
         """
-        return ParaxialRay.__str__(self) + " beam : {0:s}".format(str(self.beam))
+        return "rays: {0:d} valid: {1:d} n: {2:s}".format(len(self),self.getValidCount(),str(self.refractiveindex))
+
+    def __repr__(self):
+        """
+        Implement repr() to append class name to str()
+        """
+        return "{0:s} ".format(self.__class__.__name__) + str(self)
+
+    def __len__(self):
+        """
+        Implement len() to give the total number of rays (valid and invalid)
+        """
+        return len(self.positions)
+
+    def copy(self):
+        """
+        Make a deep copy of the bundle.
+
+        :return: RayBundle
+        """
+        b = RayBundle(index = self.refractiveindex.copy())
+        b.positions = self.positions.copy()
+        b.directors = self.directors.copy()
+        b.wavelengths = self.wavelengths.copy()
+        b.intensities = self.intensities.copy()
+        b.pathlengths = self.pathlengths.copy()
+        b.valid = self.valid.copy()
+        if self.waveaxis is not None:
+            b.waveaxis = self.waveaxis.copy()
+        b.shared = self.shared
+        return b
+
+    def getValidCount(self):
+        """
+        Get the number of valid rays in the bundle
+
+        :return: int number of valid rays.
+        """
+        return int(np.count_nonzero(self.valid))
+
+
+    def addRays(self, positions, directors, wavelength = None, intensity = 1.0, pathlength = 0.0):
+        """
+        Add a set of rays to the bundle
+
+        :param positions: ray positions as (N,3) array or list.
+        :type positions: np.ndarray or list
+        :param directors: ray directors as (N,3) array or list, or single (3,) direction used for all rays.
+        :type directors: np.ndarray or list
+        :param wavelength: the wavelength, float or (N,) array (Default = None, package default)
+        :type wavelength: float or np.ndarray
+        :param intensity: the intensities, float or (N,) array (Default = 1.0)
+        :type intensity: float or np.ndarray
+        :param pathlength: the starting pathlength, float or (N,) array (Default = 0.0)
+        :type pathlength: float or np.ndarray
+        :return: self
+
+        """
+        pos = np.array(positions,dtype = float).reshape(-1,3)
+        n = len(pos)
+        dirn = np.empty((n,3))
+        dirn[:] = np.asarray(directors,dtype = float).reshape(-1,3)       # Broadcast single director
+        dirn /= np.sqrt(dirn[:,0]*dirn[:,0] + dirn[:,1]*dirn[:,1] + dirn[:,2]*dirn[:,2])[:,np.newaxis]   # Normalise
+
+        if np.ndim(wavelength) == 0:
+            wavelength = getDefaultWavelength(wavelength)     # Sort out default
+
+        self.positions = np.concatenate((self.positions,pos))
+        self.directors = np.concatenate((self.directors,dirn))
+        self.wavelengths = np.concatenate((self.wavelengths,np.broadcast_to(wavelength,n)))
+        self.intensities = np.concatenate((self.intensities,np.broadcast_to(intensity,n)))
+        self.pathlengths = np.concatenate((self.pathlengths,np.broadcast_to(pathlength,n)))
+        self.valid = np.concatenate((self.valid,np.isfinite(dirn).all(axis = 1)))
+        self.waveaxis = None                  # No longer one set of rays per wavelength
+        self.shared = False
+        return self
+
+
+    def addBeam(self, ca, source, key = "vl", nrays = 10, wavelength = None, intensity = 1.0, aim = False):
+        """
+        Method to add a beam of rays, being either Collimated or Source Beam. The beam will fill the given circular aperture and will
+        either come from a single SourcePoint or at a specified angle. This takes the same parameters as RayPencil.addBeam
+        and makes the same rays.
+
+        :param ca: circular aperture to filled (any object with maxRadius attribute)
+        :type ca: optics.surface.CircularAperture
+        :param source: source or rays, either a SourcePoint or angle.
+        :type source: SourcePoint or Vectore3d or Unit3d or Angle or float
+        :param key: method of fill, allowed keys as "vl", "hl", "array", "hexapolar", "fibonacci", "gaussian", "halton" and "sobol", see getPupilSamples(), (default is "vl")
+        :type key: str
+        :param nrays: number or rays across radius, (default = 10)
+        :type nrays: int
+        :param wavelenth: the wavelength, (default = Default)
+        :type wavelength: float
+        :param intensity: the ray intensity, (default = 1.0) only used for Collimated beam; for SourceBeam picked up from SourcePoint. This is multiplied by the sample weight.
+        :type intensity: float
+        :param aim: use real ray aiming to fill the stop of the lens, see lens.Lens.getAimedPupil(), (Default = False)
+        :type aim: bool
+        :return: self
+
+        """
+        if aim and hasattr(ca,"getAimedPupil"):   # Fill the real stop
+            pupil = ca.getAimedPupil(source,wavelength)
+            ca = pupil.aperture
+            x,y,weight = getPupilSamples(key,nrays,1.0)
+            x,y = pupil.getPoints(x,y)
+        else:
+            #          Sort out aperture to fill.
+            if not hasattr(ca, "maxRadius"):
+                ca = ca.entranceAperture()
+            x,y,weight = getPupilSamples(key,nrays,ca.maxRadius)
+        pt = ca.getPoint()         # Reference point
+        radius = ca.maxRadius
+
+        p = np.column_stack((pt.x + x, pt.y + y, np.full(x.size,pt.z)))    # Points in aperture
+
+        if isinstance(source,SourcePoint):        # Rays from a source
+            intensity = source.getIntensity(wavelength)
+            s = np.array([source.x,source.y,source.z])
+            self.addRays(np.broadcast_to(s,p.shape),p - s,wavelength,intensity*weight)
+        else:                                     # Collimated beam
+            u = Unit3d().parseAngle(source)
+            dist = radius + x*u.x + y*u.y
+            u = np.array([u.x,u.y,u.z])
+            p -= dist[:,np.newaxis]*u             # Propagate point to make it look nicer
+            self.addRays(p,u,wavelength,intensity*weight)
+
+        return self
+
+
+    def addPencil(self,pencil):
+        """
+        Add the IntensityRays from a RayPencil (or list of IntensityRays) to the bundle.
+        The bundle keeps its own refractive index, so the rays should be in the same index.
+
+        :param pencil: the pencil of rays.
+        :type pencil: RayPencil
+        :return: self
+
+        """
+        for r in pencil:
+            pathlength = 0.0 if r.pathlength == None else r.pathlength
+            self.addRays([r.position.x,r.position.y,r.position.z],\
+                         [r.director.x,r.director.y,r.director.z],\
+                         r.wavelength,r.getIntensity(),pathlength)
+        return self
+
+
+    def getRay(self,i):
+        """
+        Get the i th ray in the bundle as an IntensityRay, this is a copy so changing it does not
+        alter the bundle.
+
+        :param i: the ray index
+        :type i: int
+        :return: IntensityRay
+
+        """
+        ray = IntensityRay(Vector3d(self.positions[i].tolist()),Unit3d(self.directors[i].tolist()),\
+                           float(self.wavelengths[i]),float(self.intensities[i]),self.refractiveindex)
+        ray.pathlength = float(self.pathlengths[i])
+        if not self.valid[i]:
+            ray.setInvalid()
+        return ray
+
+    def setRay(self,i,ray):
+        """
+        Set the i th ray in the bundle from an IntensityRay.
+
+        :param i: the ray index
+        :type i: int
+        :param ray: the IntensityRay
+        :type ray: IntensityRay
+
+        """
+        self.positions[i] = ray.position.x,ray.position.y,ray.position.z
+        self.directors[i] = ray.director.x,ray.director.y,ray.director.z
+        if ray.pathlength != None:
+            self.pathlengths[i] = ray.pathlength
+        self.valid[i] = ray.isValid()
+
+
+    def getPencil(self):
+        """
+        Get the bundle as a RayPencil of IntensityRays, this will be slow for large bundles.
+
+        :return: RayPencil
+        """
+        pencil = RayPencil()
+        for i in range(len(self)):
+            pencil.append(self.getRay(i))
+        return pencil
+
+
+    def setWavelengths(self,wavelengths):
+        """
+        Set the bundle to trace its rays at a set of K wavelengths in a single pass. The current N rays are
+        repeated for each wavelength, so ray k*N + i is ray i at wavelengths[k], and the wavelengths are held
+        in self.waveaxis. While the rays at each wavelength follow the same path, (up to the first refracting
+        surface), the surface interactions are calculated once and shared. Use getSpectral() to get the results
+        with a leading wavelength axis.
+
+        :param wavelengths: the K wavelengths
+        :type wavelengths: list or np.ndarray
+        :return: self
+
+        Note the intensities are the same at each wavelength.
+        """
+        waves = np.array(wavelengths,dtype = float).ravel()
+        k = len(waves)
+        self.wavelengths = np.repeat(waves,len(self))
+        self.positions = np.tile(self.positions,(k,1))
+        self.directors = np.tile(self.directors,(k,1))
+        self.intensities = np.tile(self.intensities,k)
+        self.pathlengths = np.tile(self.pathlengths,k)
+        self.valid = np.tile(self.valid,k)
+        self.waveaxis = waves
+        self.shared = True
+        return self
+
+    def getSpectral(self,values):
+        """
+        Reshape an array of per ray values, (for example self.positions or self.valid), to have a leading
+        wavelength axis. The bundle must have been set with setWavelengths().
+
+        :param values: the per ray values with N*K in first axis
+        :type values: np.ndarray
+        :return: np.ndarray of shape (K,N,...)
+
+        """
+        if self.waveaxis is None:
+            raise ValueError("ray.RayBundle.getSpectral: bundle has no wavelength axis")
+        return values.reshape((len(self.waveaxis),-1) + values.shape[1:])
+
+
+    def getIndexValues(self,index,plan = None):
+        """
+        Get the value of a refractive index for each ray in the bundle. Each distinct wavelength
+        is evaluated once.
+
+        :param index: the refractive index
+        :type index: RefractiveIndex
+        :param plan: TracePlan to take values from its index table (Default = None)
+        :type plan: poptics.lens.TracePlan or None
+        :return: (N,) np.ndarray of values.
+
+        """
+        if isinstance(index,GradedIndex):        # Depends on position
+            return index.getArrayValues(self.positions,self.wavelengths)
+        if len(self.wavelengths) > 0 and np.all(self.wavelengths == self.wavelengths[0]):
+            w = float(self.wavelengths[0])       # Single wavelength, so no need to sort
+            value = index.getValue(w) if plan == None else plan.getIndexValue(index,w)
+            return np.full(len(self.wavelengths),value)
+        waves,inverse = np.unique(self.wavelengths,return_inverse = True)
+        if plan == None:
+            values = np.array([index.getValue(float(w)) for w in waves])
+        else:
+            values = np.array([plan.getIndexValue(index,float(w)) for w in waves])
+        return values[inverse]
+
+
+    def removeInvalid(self):
+        """
+        Remove invalid rays from the bundle.
+
+        :return: self
+        """
+        v = self.valid
+        self.positions = self.positions[v]
+        self.directors = self.directors[v]
+        self.wavelengths = self.wavelengths[v]
+        self.intensities = self.intensities[v]
+        self.pathlengths = self.pathlengths[v]
+        self.valid = self.valid[v]
+        self.waveaxis = None                  # No longer one set of rays per wavelength
+        self.shared = False
+        return self
+
+
+    def propagate(self,distance):
+        """
+        Method to propagate all valid rays a equal distance, also updates the pathlength.
+        Normally called via the += operator
+
+        :param distance: the distance
+        :type distance:  float
+        :return: self
+
+        """
+        v = self.valid
+        self.positions[v] += distance*self.directors[v]
+        self.pathlengths[v] += distance*self.getIndexValues(self.refractiveindex)[v]
+        return self
+
+
+    def propagateThrough(self,surface,point = None,plan = None):
+        """
+        Propagate the whole bundle through a Surface or list of Surfaces (for example an OpticalGroup).
+        Normally called via \*= operator.
+
+        :param surface: the Surface or OpticalGroup
+        :type surface: Surface or OpticalGroup
+        :param point: the surface reference point in global coordinates if known (Default = None)
+        :type point: Vector3d or None
+        :param plan: the TracePlan being traced to supply the refractive index table (Default = None)
+        :type plan: poptics.lens.TracePlan or None
+        :return: self
+
+        """
+        if TraceWorkers > 1 and len(self) >= ParallelMinimum and point == None and isBatchSurface(surface):
+            return self.parallelPropagateThrough(surface)
+
+        if isinstance(surface,list):
+            plan = surface.compile() if hasattr(surface,"compile") else None
+            if plan == None:
+                for s in surface:                # process each surface in the list in turn
+                    self.propagateThrough(s)
+            else:
+                for s,pt,radius in zip(plan.surfaces,plan.points,plan.flatRadius):
+                    if radius == None or not FastTrace or isinstance(self.refractiveindex,GradedIndex):
+                        self.propagateThrough(s,pt,plan)
+                    else:
+                        self.propagateFlat(pt,radius,plan)
+            return self
+
+        if surface.type == Break:                # Coordinate break, so transform all rays with one matrix multiply
+            surface.transform(self.positions,self.directors,point)
+            return self
+
+        if isinstance(self.refractiveindex,GradedIndex):   # Curved paths to near the surface
+            self.propagateGradedIndex(surface,point)
+        else:
+            radius = surface.getFlatRadius() if FastTrace else None
+            if radius != None:                   # Clear flat surface normal to the axis
+                return self.propagateFlat(surface.getPoint() if point == None else point,radius,plan)
+
+        if not surface.hasBatchInteraction():    # Surface only deals with single rays
+            for i in np.flatnonzero(self.valid):
+                ray = self.getRay(i)
+                ray.propagateThrough(surface)
+                self.setRay(i,ray)
+            self.shared = False
+        else:
+            v = np.flatnonzero(self.valid)       # Index of valid rays
+            if self.shared:                      # Same path at each wavelength, so use first set and repeat
+                k = len(self.waveaxis)
+                w = v[v < len(self)//k]
+                distance,pos,normal,blocked = surface.getBatchInteraction(self.positions[w],self.directors[w],point)
+                distance = np.tile(distance,k)
+                pos = np.tile(pos,(k,1))
+                normal = np.tile(normal,(k,1))
+                blocked = np.tile(blocked,k)
+            else:
+                distance,pos,normal,blocked = surface.getBatchInteraction(self.positions[v],self.directors[v],point)
+
+            hit = ~np.isnan(distance)            # Rays that reach the surface
+            n = self.getIndexValues(self.refractiveindex,plan)[v]
+            self.positions[v[hit]] = pos[hit]
+            self.pathlengths[v[hit]] += distance[hit]*n[hit]
+            if hasattr(surface,"recordRays"):    # Surface that records the rays, for example analysis.OpticalImage
+                w = v[hit]
+                surface.recordRays(self.positions[w],self.intensities[w],self.wavelengths[w])
+
+            self.valid[v[blocked]] = False       # Blocked rays now invalid
+            clear = ~blocked
+            v = v[clear]
+            normal = normal[clear]
+
+            if surface.type == Refracting:
+                ratio = self.getIndexValues(surface.refractiveindex,plan)[v]/n[clear]
+                u = self.directors[v]
+                critical = refractDirectors(u,normal,ratio)
+                self.directors[v] = u
+                self.valid[v[critical]] = False  # Above critical angle
+            elif surface.type == Reflecting:
+                u = self.directors[v]
+                reflectDirectors(u,normal)
+                self.directors[v] = u
+
+        if surface.type == Refracting:       # All valid rays now in new index
+            self.refractiveindex = surface.refractiveindex
+            self.shared = False              # Paths now depend on wavelength
+
+        return self
+
+
+    def propagateFlat(self,point,radius,plan = None):
+        """
+        Propagate the bundle to a clear flat surface normal to the optical axis, such as an OpticalPlane, ImagePlane,
+        CircularAperture or IrisAperture, being a z-intercept and radius test on the arrays with no normals formed,
+        which gives the same result as propagateThrough(). Called automatically when tracing an OpticalGroup for
+        surfaces where Surface.getFlatRadius() is not None.
+
+        :param point: the surface reference point in global coordinates
+        :type point: Vector3d
+        :param radius: the radius of the surface, inf if not limited
+        :type radius: float
+        :param plan: the TracePlan being traced to supply the refractive index table (Default = None)
+        :type plan: poptics.lens.TracePlan or None
+        :return: self
+        """
+        with np.errstate(invalid = "ignore", divide = "ignore"):
+            distance = (point.z - self.positions[:,2])/self.directors[:,2]
+        hit = self.valid & ~np.isnan(distance)        # Valid rays that reach the plane, others are not moved
+        n = self.getIndexValues(self.refractiveindex,plan)
+
+        #          Update in place with masks, so no gather / scatter of the arrays
+        step = np.multiply(distance[:,np.newaxis],self.directors,out = np.empty(self.directors.shape),\
+                           where = hit[:,np.newaxis])
+        np.add(self.positions,step,out = self.positions,where = hit[:,np.newaxis])
+        np.add(self.pathlengths,distance*n,out = self.pathlengths,where = hit)
+
+        if radius == math.inf:
+            self.valid = hit
+        else:
+            dx = self.positions[:,0] - point.x
+            dy = self.positions[:,1] - point.y
+            self.valid = hit & (dx*dx + dy*dy <= radius*radius)
+        return self
+
+
+    def propagateGradedIndex(self,surface,point = None):
+        """
+        Propagate the valid rays through the graded index medium of the bundle to within tolerance of a surface,
+        see propagateGradedIndex(). Called automatically by propagateThrough() when the bundle is in a GradedIndex.
+
+        :param surface: the next surface
+        :type surface: optics.surface.Surface
+        :param point: the surface reference point in global coordinates if known (Default = None)
+        :type point: Vector3d or None
+        :return: self
+
+        """
+        v = np.flatnonzero(self.valid)
+        r,u,path,valid = propagateGradedIndex(self.positions[v],self.directors[v],self.wavelengths[v],\
+                                              self.refractiveindex,surface,point)
+        self.positions[v] = r
+        self.directors[v] = u
+        self.pathlengths[v] += path
+        self.valid[v[~valid]] = False
+        self.shared = False
+        return self
+
+
+    def parallelPropagateThrough(self,surface,workers = None):
+        """
+        Propagate the bundle through a Surface or OpticalGroup using a pool of worker processes. The ray state is
+        copied once into shared memory, the surface is sent once to each worker, and each worker traces a chunk of
+        the rays in place, giving identical results to serial tracing. Normally called automatically by
+        propagateThrough() for large bundles, see setTraceWorkers().
+
+        :param surface: the Surface or OpticalGroup, all surfaces must support batch interactions
+        :type surface: Surface or OpticalGroup
+        :param workers: number of worker processes (Default = None, use the value set by setTraceWorkers())
+        :type workers: int or None
+        :return: self
+
+        """
+        if not isBatchSurface(surface):
+            raise TypeError("ray.RayBundle.parallelPropagateThrough: surface does not support batch interactions")
+        if workers == None:
+            workers = TraceWorkers
+        n = len(self)
+        workers = max(min(int(workers),n),1)
+
+        #          Ray state as (n,9) array in shared memory, being position, director, wavelength, pathlength, valid
+        shm = SharedMemory(create = True,size = max(n*9*8,1))
+        try:
+            state = np.ndarray((n,9),buffer = shm.buf)
+            state[:,0:3] = self.positions
+            state[:,3:6] = self.directors
+            state[:,6] = self.wavelengths
+            state[:,7] = self.pathlengths
+            state[:,8] = self.valid
+            bounds = np.linspace(0,n,workers + 1).astype(int)
+            with ProcessPoolExecutor(workers,initializer = traceWorkerInit,initargs = (surface,)) as pool:
+                jobs = [pool.submit(traceWorkerChunk,shm.name,n,int(bounds[i]),int(bounds[i + 1]),self.refractiveindex) \
+                        for i in range(workers)]
+                for j in jobs:
+                    j.result()                   # Wait for all and pick up exceptions
+            self.positions = state[:,0:3].copy()
+            self.directors = state[:,3:6].copy()
+            self.pathlengths = state[:,7].copy()
+            self.valid = state[:,8] != 0.0
+            del state
+        finally:
+            shm.close()
+            shm.unlink()
+
+        self.refractiveindex = getFinalIndex(surface,self.refractiveindex)
+        self.shared = False
+        return self
+
+
+    def __imul__(self,surface):
+        """
+        Implement \*= to propagate through a Surface or OpticalGroup
+        """
+        return self.propagateThrough(surface)
+
+    def __iadd__(self,d):
+        """
+        Implement += to propagate a specified distance
+        """
+        return self.propagate(d)
+
+
+
+class ParaxialBundle(object):
+    """
+    Class to hold a bundle of paraxial rays as NumPy arrays of heights and angles rather than as a
+    list of ParaxialRay objects, so that many rays can be traced through a paraxial system with array
+    operations. All rays in the bundle are assumed to be in the same refractive index.
+
+    The ray information is held in:
+
+    - self.h (N,) array of ray heights.
+    - self.u (N,) array of ray angles, NaN if invalid.
+    - self.z (N,) array of ray positions along the optical axis.
+    - self.wavelengths (N,) array of wavelengths in microns.
+    - self.intensities (N,) array of intensities.
+    - self.valid (N,) boolean array, True if the ray is valid.
+
+    :param height: ray heights as float or (N,) array (Default = None, empty bundle)
+    :type height: float or np.ndarray
+    :param angle: ray angles as float or (N,) array (Default = 0.0)
+    :type angle: float or np.ndarray
+    :param plane: location of the rays along the optical axis, float or (N,) array (Default = 0.0)
+    :type plane: float or np.ndarray
+    :param wavelength: wavelength of the rays, float or (N,) array (Default = None, package default)
+    :type wavelength: float or np.ndarray
+    :param intensity: ray intensities, float or (N,) array (Default = 1.0)
+    :type intensity: float or np.ndarray
+    :param index: the refractive index the rays are in, (Default = AirIndex())
+    :type index: RefractiveIndex
+
+    Rays are propagated with \*= in the same way as a ParaxialRay, through a ParaxialMatrix, ParaxialGroup,
+    Surface, OpticalGroup or list of these.
+    """
+
+    def __init__(self, height = None, angle = 0.0, plane = 0.0, wavelength = None, intensity = 1.0, index = AirIndex()):
+        """
+        Make a bundle of paraxial rays, if no heights, it will be empty.
+        """
+        self.h = np.empty(0)
+        self.u = np.empty(0)
+        self.z = np.empty(0)
+        self.wavelengths = np.empty(0)
+        self.intensities = np.empty(0)
+        self.valid = np.empty(0,dtype = bool)
+        self.refractiveindex = index
+        if height is not None:
+            self.addRays(height,angle,plane,wavelength,intensity)
+
+
+    def __str__(self):
+        """
+        Implement str() to give number of rays, number of valid rays and refractive index
+        """
+        return "rays: {0:d} valid: {1:d} n: {2:s}".format(len(self),self.getValidCount(),str(self.refractiveindex))
+
+    def __repr__(self):
+        """
+        Implement repr() to append class name to str()
+        """
+        return "{0:s} ".format(self.__class__.__name__) + str(self)
+
+    def __len__(self):
+        """
+        Implement len() to give the total number of rays (valid and invalid)
+        """
+        return self.h.size
+
+    def getValidCount(self):
+        """
+        Get the number of valid rays.
+
+        :return: int
+        """
+        return int(np.count_nonzero(self.valid))
+
+
+    def addRays(self, height, angle = 0.0, plane = 0.0, wavelength = None, intensity = 1.0):
+        """
+        Add rays to the bundle, the parameters are broadcast against each other.
+
+        :param height: ray heights, float or (N,) array
+        :type height: float or np.ndarray
+        :param angle: ray angles, float or (N,) array (Default = 0.0)
+        :type angle: float or np.ndarray
+        :param plane: location along the optical axis, float or (N,) array (Default = 0.0)
+        :type plane: float or np.ndarray
+        :param wavelength: wavelength, float or (N,) array (Default = None, package default)
+        :type wavelength: float or np.ndarray
+        :param intensity: intensity, float or (N,) array (Default = 1.0)
+        :type intensity: float or np.ndarray
+        :return: self
+        """
+        if wavelength is None:
+            wavelength = getDefaultWavelength()
+        h,u,z,w,i = np.broadcast_arrays(*[np.atleast_1d(np.asarray(a,dtype = float)) for a in \
+                                          (height,angle,plane,wavelength,intensity)])
+        self.h = np.concatenate((self.h,h))
+        self.u = np.concatenate((self.u,u))
+        self.z = np.concatenate((self.z,z))
+        self.wavelengths = np.concatenate((self.wavelengths,w))
+        self.intensities = np.concatenate((self.intensities,i))
+        self.valid = np.concatenate((self.valid,~np.isnan(u)))
+        return self
+
+
+    def addCollimatedBeam(self,ca,u,nrays = 10, wavelength = None, intensity = 1.0):
+        """
+        Add a collimated beam of paraxial rays to fill an aperture, being the array version of
+        RayPencil.addCollimatedParaxialBeam().
+
+        :param ca: the aperture to fill, must have maxRadius and getPoint()
+        :param u: angle of the rays
+        :type u: float
+        :param nrays: number of rays across the radius (Default = 10)
+        :type nrays: int
+        :param wavelength: the wavelength (Default = None, package default)
+        :type wavelength: float
+        :param intensity: the ray intensity (Default = 1.0)
+        :type intensity: float
+        :return: self
+        """
+        if hasattr(ca, "maxRadius"):
+            if isinstance(ca.maxRadius,float):
+                radius = ca.maxRadius
+            else:
+                radius = ca.maxRadius()
+        else:
+            radius = 10.0
+        pt = ca.getPoint().z
+        y = linspace(-radius,radius,2*nrays + 1)
+        dist = -(radius + y*u)
+        return self.addRays(y + u*dist,u,pt + dist,wavelength,intensity)
+
+
+    def addSourceBeam(self,pg, height, sourceplane, nrays = 10, wavelength = None, intensity = 1.0):
+        """
+        Add a beam of paraxial rays from a point source to fill the input of a ParaxialGroup, being the
+        array version of RayPencil.addSourceParaxialBeam().
+
+        :param pg: the ParaxialGroup
+        :type pg: poptics.matrix.ParaxialGroup
+        :param height: height of the source
+        :type height: float
+        :param sourceplane: the source plane as ParaxialPlane or its location
+        :type sourceplane: poptics.matrix.ParaxialPlane or float
+        :param nrays: number of rays across the radius (Default = 10)
+        :type nrays: int
+        :param wavelength: the wavelength (Default = None, package default)
+        :type wavelength: float
+        :param intensity: the ray intensity (Default = 1.0)
+        :type intensity: float
+        :return: self
+        """
+        if isinstance(sourceplane,ParaxialPlane):
+            z = sourceplane.inputPlane()
+        else:
+            z = float(sourceplane)
+        dist = pg.inputPlane() - z
+        radius = pg.maxRadius()
+        y = linspace(-radius,radius,2*nrays + 1)
+        return self.addRays(height,(y - height)/dist,z,wavelength,intensity)
+
+
+    def getRay(self,i):
+        """
+        Get a ray from the bundle as a ParaxialRay.
+
+        :param i: index of the ray
+        :type i: int
+        :return: ParaxialRay
+        """
+        ray = ParaxialRay(self.h[i],self.u[i],self.z[i],float(self.wavelengths[i]),float(self.intensities[i]))
+        ray.refractiveindex = self.refractiveindex
+        return ray
+
+    def getPencil(self):
+        """
+        Get the bundle as a RayPencil of ParaxialRays.
+
+        :return: RayPencil
+        """
+        pencil = RayPencil()
+        for i in range(len(self)):
+            pencil.append(self.getRay(i))
+        return pencil
+
+
+    def setInvalid(self,mask):
+        """
+        Set the rays selected by a mask to be invalid by setting their angles to NaN.
+
+        :param mask: boolean (N,) array
+        :type mask: np.ndarray
+        :return: self
+        """
+        self.valid &= ~mask
+        self.u[mask] = float("nan")
+        return self
+
+    def removeInvalid(self):
+        """
+        Remove invalid rays from the bundle.
+
+        :return: self
+        """
+        v = self.valid
+        self.h = self.h[v]
+        self.u = self.u[v]
+        self.z = self.z[v]
+        self.wavelengths = self.wavelengths[v]
+        self.intensities = self.intensities[v]
+        self.valid = self.valid[v]
+        return self
+
+
+    def getIndexValues(self,index):
+        """
+        Get the value of a refractive index for each ray in the bundle. Each distinct wavelength
+        is evaluated once.
+
+        :param index: the refractive index
+        :type index: RefractiveIndex
+        :return: (N,) np.ndarray of values.
+        """
+        waves,inverse = np.unique(self.wavelengths,return_inverse = True)
+        values = np.array([index.getValue(float(w)) for w in waves])
+        return values[inverse]
+
+
+    def propagate(self,distance):
+        """
+        Propagate the valid rays a specified distance.
+
+        :param distance: distance, float or (N,) array
+        :type distance: float or np.ndarray
+        :return: self
+        """
+        v = self.valid
+        d = np.broadcast_to(np.asarray(distance,dtype = float),self.h.shape)[v]
+        self.z[v] += d
+        self.h[v] += self.u[v]*d
+        return self
+
+    def propagateTo(self,plane):
+        """
+        Propagate the valid rays to a plane along the optical axis, rays are not moved if the plane is infinite.
+
+        :param plane: the location of the plane
+        :type plane: float
+        :return: self
+        """
+        if not math.isinf(plane):
+            self.propagate(plane - self.z)
+        return self
+
+
+    def multBy(self,m):
+        """
+        Multiply the valid rays by a ParaxialMatrix in place.
+
+        :param m: the ParaxialMatrix
+        :type m: poptics.matrix.ParaxialMatrix
+        :return: self
+        """
+        v = self.valid
+        h = self.h[v]
+        u = self.u[v]
+        self.h[v] = h*m.A + u*m.B
+        self.u[v] = h*m.C + u*m.D
+        self.z[v] += m.thickness
+        return self
+
+
+    def propagateThrough(self,surface):
+        """
+        Propagate the bundle through a ParaxialMatrix, ParaxialGroup, Surface, OpticalGroup or list of these,
+        with the same behaviour as ParaxialRay.propagateThrough() applied to each ray.
+
+        :param surface: what to propagate through
+        :return: self
+
+        Normally called by \*= operator.
+        """
+        if isinstance(surface,list):
+            for s in surface:
+                self.propagateThrough(s)
+            return self
+
+        if isinstance(surface,ParaxialGroup):
+            self.propagateTo(surface.inputPlane())
+            self.setInvalid(self.valid & (self.h > surface.inputPlaneHeight))
+            return self.multBy(surface)
+
+        if isinstance(surface,ParaxialMatrix):
+            return self.multBy(surface)
+
+        if isinstance(surface,float):
+            return self.propagateTo(surface)
+
+        idx = np.flatnonzero(self.valid)
+        distance,height,c = surface.getBatchParaxialInteraction(self.z[idx],self.h[idx],self.u[idx])
+        ok = ~np.isnan(distance)                   # Rays where the distance failed are not moved
+        idx = idx[ok]
+        c = c[ok]
+        self.z[idx] += distance[ok]
+        self.h[idx] = height[ok]
+
+        blocked = np.isnan(c)                      # Blocked rays are set invalid
+        if np.any(blocked):
+            mask = np.zeros(len(self),dtype = bool)
+            mask[idx[blocked]] = True
+            self.setInvalid(mask)
+            idx = idx[~blocked]
+            c = c[~blocked]
+
+        if surface.type == 1:                      # Refraction
+            nl = self.getIndexValues(self.refractiveindex)[idx]
+            nr = self.getIndexValues(surface.refractiveindex)[idx]
+            self.u[idx] = self.h[idx]*c*(nl - nr)/nr + nl*self.u[idx]/nr
+            self.refractiveindex = surface.refractiveindex
+        elif surface.type == 2:                    # Reflection
+            self.u[idx] = 2.0*self.h[idx]*c - self.u[idx]
+        return self
+
+
+    def __imul__(self,surface):
+        """
+        Implement \*= to propagate through a ParaxialMatrix, ParaxialGroup, Surface or list of these.
+        """
+        return self.propagateThrough(surface)
+
+    def __iadd__(self,d):
+        """
+        Implement += to propagate a specified distance
+        """
+        return self.propagate(d)
+
+
+
+def isBatchSurface(surface):
+    """
+    Function to test if a Surface, or all the surfaces in a list or OpticalGroup, support batch interactions
+    and so can be traced in parallel. Surfaces that record the rays, such as analysis.OpticalImage, are traced serially.
+
+    :param surface: the Surface or list of Surfaces
+    :return: bool
+    """
+    if isinstance(surface,list):
+        for s in surface:
+            if not isBatchSurface(s):
+                return False
+        return True
+    return hasattr(surface,"hasBatchInteraction") and surface.hasBatchInteraction() and not hasattr(surface,"recordRays")
+
+def getFinalIndex(surface,index):
+    """
+    Function to get the refractive index a ray will be in after propagating through a Surface or list of Surfaces.
+
+    :param surface: the Surface or list of Surfaces
+    :param index: the refractive index before the surfaces
+    :return: the refractive index after the surfaces
+    """
+    if isinstance(surface,list):
+        for s in surface:
+            index = getFinalIndex(s,index)
+        return index
+    if surface.type == Refracting:
+        return surface.refractiveindex
+    return index
+
+#   Surface being traced by a worker process, set by traceWorkerInit
+WorkerSurface = None
+
+def traceWorkerInit(surface):
+    """
+    Initialise a worker process for parallel tracing with the Surface or OpticalGroup to be traced.
+    Not called by users.
+    """
+    global WorkerSurface,TraceWorkers
+    WorkerSurface = surface
+    TraceWorkers = 1                        # Workers trace serially
+
+def traceWorkerChunk(name,n,start,stop,index):
+    """
+    Trace rays start to stop of the shared memory ray state in a worker process as a RayBundle, updating the state
+    in place. Not called by users.
+    """
+    shm = SharedMemory(name = name)
+    try:
+        state = np.ndarray((n,9),buffer = shm.buf)[start:stop]
+        bundle = RayBundle(index = index)
+        bundle.positions = state[:,0:3].copy()
+        bundle.directors = state[:,3:6].copy()
+        bundle.wavelengths = state[:,6].copy()
+        bundle.intensities = np.ones(len(state))
+        bundle.pathlengths = state[:,7].copy()
+        bundle.valid = state[:,8] != 0.0
+        bundle.propagateThrough(WorkerSurface)
+        state[:,0:3] = bundle.positions
+        state[:,3:6] = bundle.directors
+        state[:,7] = bundle.pathlengths
+        state[:,8] = bundle.valid
+        del state
+    finally:
+        shm.close()
+    return stop - start
+
+
+class DifferentialBundle(RayBundle):
+    """
+    Class to extend RayBundle to carry the derivatives of the ray positions, directors and pathlengths with respect to a set
+    of parameters, being input pupil or field coordinates and surface curvatures or thicknesses. These are propagated
+    analytically with the rays so that one trace gives the Jacobians that would otherwise need a retrace for each
+    parameter by finite differences. The surfaces must be QuadricSurfaces, OpticalPlanes or CoordinateBreaks.
+
+    The derivatives are held in:
+
+    - self.parameters list of P parameter names.
+    - self.dpositions (N,3,P) array of the derivatives of the positions.
+    - self.ddirectors (N,3,P) array of the derivatives of the directors.
+    - self.dpathlengths (N,P) array of the derivatives of the optical pathlengths.
+
+    :param positions: ray positions as (N,3) array or list (Default = None, empty bundle)
+    :type positions: np.ndarray or list
+    :param directors: ray directors as (N,3) array or list, will be normalised (Default = None)
+    :type directors: np.ndarray or list
+    :param wavelength: wavelength of the rays, float or (N,) array (Default = None, package default)
+    :type wavelength: float or np.ndarray
+    :param intensity: ray intensities, float or (N,) array (Default = 1.0)
+    :type intensity: float or np.ndarray
+    :param index: the refractive index the rays are in, (Default = AirIndex())
+    :type index: RefractiveIndex
+
+    The rays are added as for a RayBundle and then the parameters are added before tracing, for example
+
+    .. code-block:: python
+
+       bundle = DifferentialBundle().addBeam(lens,u,"array",10)
+       bundle.addPupilParameters()
+       bundle.addSurfaceParameter(lens[2],"curvature")
+       bundle \*= lens
+       bundle \*= lens.backFocalPlane()
+       spot,gradient = bundle.getSpotJacobian()
+    """
+    def __init__(self, positions = None, directors = None, wavelength = None, intensity = 1.0, index = AirIndex()):
+        """
+        Make a bundle of rays with no parameters.
+        """
+        self.parameters = []
+        self.dpositions = np.zeros((0,3,0))
+        self.ddirectors = np.zeros((0,3,0))
+        self.dpathlengths = np.zeros((0,0))
+        self.surfaceParameters = []           # List of [surface,kind,column]
+        self.moved = []                       # Columns where the surfaces being traced are moved
+        self.breaks = {}                      # Derivative of the point of each CoordinateBreak traced
+        RayBundle.__init__(self,positions,directors,wavelength,intensity,index)
+
+
+    def __str__(self):
+        """
+        Implement str() to add the parameters.
+        """
+        return RayBundle.__str__(self) + " parameters: {0:s}".format(str(self.parameters))
+
+
+    def copy(self):
+        """
+        Make a deep copy of the bundle with its derivatives.
+
+        :return: DifferentialBundle
+        """
+        b = DifferentialBundle(index = self.refractiveindex.copy())
+        b.positions = self.positions.copy()
+        b.directors = self.directors.copy()
+        b.wavelengths = self.wavelengths.copy()
+        b.intensities = self.intensities.copy()
+        b.pathlengths = self.pathlengths.copy()
+        b.valid = self.valid.copy()
+        if self.waveaxis is not None:
+            b.waveaxis = self.waveaxis.copy()
+        b.shared = self.shared
+        b.parameters = list(self.parameters)
+        b.dpositions = self.dpositions.copy()
+        b.ddirectors = self.ddirectors.copy()
+        b.dpathlengths = self.dpathlengths.copy()
+        b.surfaceParameters = [list(sp) for sp in self.surfaceParameters]
+        b.moved = list(self.moved)
+        b.breaks = dict(self.breaks)
+        return b
+
+
+    def addRays(self, positions, directors, wavelength = None, intensity = 1.0, pathlength = 0.0):
+        """
+        Add a set of rays as RayBundle.addRays(), the derivatives of the new rays are zero.
+        """
+        n = len(self)
+        RayBundle.addRays(self,positions,directors,wavelength,intensity,pathlength)
+        m = len(self) - n
+        p = len(self.parameters)
+        self.dpositions = np.concatenate((self.dpositions,np.zeros((m,3,p))))
+        self.ddirectors = np.concatenate((self.ddirectors,np.zeros((m,3,p))))
+        self.dpathlengths = np.concatenate((self.dpathlengths,np.zeros((m,p))))
+        return self
+
+
+    def setWavelengths(self,wavelengths):
+        """
+        Set the bundle to trace at a set of wavelengths as RayBundle.setWavelengths(), repeating the derivatives.
+        """
+        k = len(np.array(wavelengths,dtype = float).ravel())
+        RayBundle.setWavelengths(self,wavelengths)
+        self.dpositions = np.tile(self.dpositions,(k,1,1))
+        self.ddirectors = np.tile(self.ddirectors,(k,1,1))
+        self.dpathlengths = np.tile(self.dpathlengths,(k,1))
+        return self
+
+
+    def removeInvalid(self):
+        """
+        Remove invalid rays and their derivatives from the bundle.
+
+        :return: self
+        """
+        v = self.valid
+        self.dpositions = self.dpositions[v]
+        self.ddirectors = self.ddirectors[v]
+        self.dpathlengths = self.dpathlengths[v]
+        return RayBundle.removeInvalid(self)
+
+
+    def addParameter(self,name,dposition = None,ddirector = None):
+        """
+        Add a parameter with the given starting derivatives of the ray positions and directors.
+
+        :param name: name of the parameter
+        :type name: str
+        :param dposition: derivative of the positions, (3,) or (N,3) array (Default = None, zero)
+        :type dposition: np.ndarray or list
+        :param ddirector: derivative of the directors, (3,) or (N,3) array (Default = None, zero)
+        :type ddirector: np.ndarray or list
+        :return: int, the column of the parameter in the derivative arrays.
+        """
+        n = len(self)
+        dp = np.zeros((n,3,1))
+        du = np.zeros((n,3,1))
+        if dposition is not None:
+            dp[:,:,0] = np.asarray(dposition,dtype = float)
+        if ddirector is not None:
+            du[:,:,0] = np.asarray(ddirector,dtype = float)
+        self.parameters.append(name)
+        self.dpositions = np.concatenate((self.dpositions,dp),axis = 2)
+        self.ddirectors = np.concatenate((self.ddirectors,du),axis = 2)
+        self.dpathlengths = np.concatenate((self.dpathlengths,np.zeros((n,1))),axis = 1)
+        return len(self.parameters) - 1
+
+    def addPupilParameters(self):
+        """
+        Add the x and y input ray positions as parameters "px" and "py".
+
+        :return: self
+        """
+        self.addParameter("px",[1.0,0.0,0.0])
+        self.addParameter("py",[0.0,1.0,0.0])
+        return self
+
+    def addFieldParameters(self):
+        """
+        Add the x and y components of the input ray directors as parameters "ux" and "uy", with the z component
+        changing to keep the directors normalised. The ray start positions are held fixed.
+
+        :return: self
+        """
+        u = self.directors
+        zero = np.zeros(len(self))
+        one = np.ones(len(self))
+        self.addParameter("ux",None,np.column_stack((one,zero,-u[:,0]/u[:,2])))
+        self.addParameter("uy",None,np.column_stack((zero,one,-u[:,1]/u[:,2])))
+        return self
+
+    def addSurfaceParameter(self,surface,kind = "curvature"):
+        """
+        Add the curvature or thickness of a surface as a parameter. The thickness is the gap in front of the surface, so
+        changing it moves this surface and all surfaces traced after it along the optical axis.
+
+        :param surface: the surface, must be in what is traced
+        :type surface: poptics.surface.OpticalPlane
+        :param kind: "curvature" or "thickness" (Default = "curvature")
+        :type kind: str
+        :return: self
+        """
+        if kind == "curvature" and not hasattr(surface,"curvature"):
+            raise TypeError("ray.DifferentialBundle.addSurfaceParameter: surface has no curvature")
+        if not kind in ("curvature","thickness"):
+            raise ValueError("ray.DifferentialBundle.addSurfaceParameter: unknown kind " + str(kind))
+        i = self.addParameter("{0:s} {1:d}".format(kind,len(self.surfaceParameters)))
+        self.surfaceParameters.append([surface,kind,i])
+        return self
+
+
+    def propagate(self,distance):
+        """
+        Propagate all valid rays an equal distance with their derivatives.
+
+        :param distance: the distance
+        :type distance:  float
+        :return: self
+        """
+        v = self.valid
+        self.dpositions[v] += distance*self.ddirectors[v]
+        return RayBundle.propagate(self,distance)
+
+
+    def propagateThrough(self,surface,point = None,plan = None):
+        """
+        Propagate the bundle and its derivatives through a Surface or list of Surfaces, (for example an OpticalGroup).
+        Normally called via \*= operator.
+
+        :param surface: the Surface or OpticalGroup
+        :type surface: poptics.surface.QuadricSurface or poptics.surface.OpticalPlane or OpticalGroup
+        :param point: the surface reference point in global coordinates if known (Default = None)
+        :type point: Vector3d or None
+        :param plan: the TracePlan being traced to supply the refractive index table (Default = None)
+        :type plan: poptics.lens.TracePlan or None
+        :return: self
+        """
+        if isinstance(surface,list):
+            plan = surface.compile() if hasattr(surface,"compile") else None
+            if plan == None:
+                for s in surface:
+                    self.propagateThrough(s)
+            else:
+                for s,pt in zip(plan.surfaces,plan.points):
+                    self.propagateThrough(s,pt,plan)
+            return self
+
+        if surface.type == Break:
+            return self.propagateBreak(surface,point)
+
+        from poptics.surface import OpticalPlane,QuadricSurface,PolynomialSurface
+        if not isinstance(surface,OpticalPlane) or isinstance(surface,PolynomialSurface):
+            raise TypeError("ray.DifferentialBundle.propagateThrough: surface must be QuadricSurface or OpticalPlane")
+        if isinstance(surface,QuadricSurface):
+            c = surface.curvature
+            eps = surface.epsilon
+        else:
+            c = 0.0
+            eps = 1.0
+
+        #          Parameters of this surface
+        dc = np.zeros(len(self.parameters))            # Derivative of curvature
+        for s,kind,i in self.surfaceParameters:
+            if s is surface:
+                if kind == "curvature":
+                    dc[i] = 1.0
+                elif not i in self.moved:
+                    self.moved.append(i)
+        dz = np.zeros(len(self.parameters))            # Derivative of surface position
+        dz[self.moved] = 1.0
+
+        #          Trace the rays, keeping the state before the surface
+        v = self.valid.copy()
+        start = self.positions[v]
+        director = self.directors[v]
+        n = self.getIndexValues(self.refractiveindex,plan)[v]
+        RayBundle.propagateThrough(self,surface,point,plan)
+        v = np.flatnonzero(v)
+        ok = self.valid[v]                             # Rays still valid after surface
+        v = v[ok]
+        start = start[ok]
+        u = director[ok]
+        n = n[ok]
+
+        #          Differentiate the intersection of the ray with the surface F(P) = 0
+        p = surface.getPoint() if point == None else point
+        pos = self.positions[v]
+        t = ((pos - start)*u).sum(axis = 1)            # Distance along the ray
+        x = pos[:,0] - p.x
+        y = pos[:,1] - p.y
+        z = pos[:,2] - p.z
+        g = np.column_stack((-c*x,-c*y,1.0 - c*eps*z))  # Surface normal, not normalised
+        fc = 0.5*(x*x + y*y + eps*z*z)                 # Half derivative of F wrt curvature
+        dr = self.dpositions[v]
+        du = self.ddirectors[v]
+        w = dr + t[:,np.newaxis,np.newaxis]*du
+        dt = (fc[:,np.newaxis]*dc + g[:,2,np.newaxis]*dz - np.einsum("ni,nip->np",g,w))/(g*u).sum(axis = 1)[:,np.newaxis]
+        dp = w + u[:,:,np.newaxis]*dt[:,np.newaxis,:]
+        self.dpositions[v] = dp
+        self.dpathlengths[v] += n[:,np.newaxis]*dt
+
+        if surface.type == Refracting or surface.type == Reflecting:
+            #      Derivative of the normalised surface normal
+            dg = np.empty(dp.shape)
+            dg[:,0,:] = -c*dp[:,0,:] - x[:,np.newaxis]*dc
+            dg[:,1,:] = -c*dp[:,1,:] - y[:,np.newaxis]*dc
+            dg[:,2,:] = -c*eps*(dp[:,2,:] - dz) - (eps*z)[:,np.newaxis]*dc
+            norm = np.sqrt((g*g).sum(axis = 1))
+            normal = g/norm[:,np.newaxis]
+            dnormal = (dg - normal[:,:,np.newaxis]*np.einsum("ni,nip->np",normal,dg)[:,np.newaxis,:])/norm[:,np.newaxis,np.newaxis]
+            b = (u*normal).sum(axis = 1)
+            db = np.einsum("nip,ni->np",du,normal) + np.einsum("ni,nip->np",u,dnormal)
+            if surface.type == Refracting:
+                a = n/self.getIndexValues(surface.refractiveindex,plan)[v]
+                cc = np.copysign(np.sqrt(1.0 - a*a*(1.0 - b*b)),b)
+                dcc = (a*a*b/cc)[:,np.newaxis]*db
+                du = a[:,np.newaxis,np.newaxis]*du + normal[:,:,np.newaxis]*(dcc - a[:,np.newaxis]*db)[:,np.newaxis,:] \
+                     + dnormal*(cc - a*b)[:,np.newaxis,np.newaxis]
+            else:
+                du = du - 2.0*(normal[:,:,np.newaxis]*db[:,np.newaxis,:] + dnormal*b[:,np.newaxis,np.newaxis])
+            self.ddirectors[v] = du
+
+        return self
+
+
+    def propagateBreak(self,surface,point = None):
+        """
+        Transform the bundle and its derivatives through a CoordinateBreak or CoordinateReturn. Called automatically
+        by propagateThrough().
+
+        :param surface: the coordinate break
+        :type surface: poptics.surface.CoordinateBreak
+        :param point: the reference point of the break in global coordinates if known (Default = None)
+        :type point: Vector3d or None
+        :return: self
+        """
+        brk = getattr(surface,"coordinateBreak",surface)  # Break being transformed by
+        if brk is surface:
+            dz = np.zeros(len(self.parameters))
+            dz[self.moved] = 1.0
+            self.breaks[brk] = dz                           # Break point moves with the surfaces before it
+        dz = self.breaks.get(brk,np.zeros(len(self.parameters)))
+        m = surface.getMatrix()
+        RayBundle.propagateThrough(self,surface,point)
+        shift = np.array([0.0,0.0,1.0]) - m[2]             # Derivative of the positions with the break point
+        self.dpositions = np.einsum("nip,ij->njp",self.dpositions,m) + shift[np.newaxis,:,np.newaxis]*dz
+        self.ddirectors = np.einsum("nip,ij->njp",self.ddirectors,m)
+        return self
+
+
+    def getJacobian(self):
+        """
+        Get the derivatives of the positions and directors of the valid rays.
+
+        :return: (M,3,P) derivatives of positions, (M,3,P) derivatives of directors, as np.ndarray
+        """
+        v = self.valid
+        return self.dpositions[v],self.ddirectors[v]
+
+    def getPathJacobian(self):
+        """
+        Get the optical pathlengths of the valid rays and their derivatives, giving the derivatives of the
+        wavefront when the bundle is at the reference plane.
+
+        :return: (M,) pathlengths and (M,P) derivatives as np.ndarray
+        """
+        v = self.valid
+        return self.pathlengths[v],self.dpathlengths[v]
+
+    def getSpotJacobian(self):
+        """
+        Get the rms spot radius about the centroid of the valid rays in the x/y plane at their current positions
+        and its derivatives with respect to the parameters.
+
+        :return: spot radius as float and (P,) derivatives as np.ndarray
+        """
+        v = self.valid
+        xy = self.positions[v,0:2]
+        dxy = self.dpositions[v,0:2,:]
+        xy = xy - xy.mean(axis = 0)
+        dxy = dxy - dxy.mean(axis = 0)
+        spot = math.sqrt((xy*xy).sum(axis = 1).mean())
+        return spot,np.einsum("ni,nip->p",xy,dxy)/(len(xy)*spot)
+
+
+class GaussianBeam(ParaxialRay):
+    """
+    Class to work with Gaussian Beams that used the uderlying ParaxialRay class
+    being
+    """
+    def __init__(self,p = 0.0 ,waist = 25.0e-3 , wavelength = None, intensity = 1.0):
+        """
+        Construct Gaussan beam
+
+        :param p: the plane of the beam
+        :type p: float
+        :param waist:   beam waist in mm
+        :type waist: float
+        :param wavelength: wavelength in micoms
+        :type wavelength: float
+        :param intesity: the intensity
+        :type intensity: float
+        """
+        ParaxialRay.__init__(self,0.0,0.0,p,wavelength,intensity)     # Paraxial Ray class
+        self.wavelengthMM = self.wavelength/1000.0                    # wavelength in mm
+        gamma = math.pi*waist*waist/self.wavelengthMM
+        alpha = 1.0/gamma
+        self.beam = complex(0.0,-alpha)
+
+
+    def __str__(self):
+        """
+        The str() method
+        """
+        return ParaxialRay.__str__(self) + " beam : {0:s}".format(str(self.beam))
 
     def getCurvature(self):
         """
@@ -1390,9 +3623,256 @@ class GaussianBeam(ParaxialRay):
         return test
 
 
+class GaussianBundle(object):
+    """
+    Class to hold many Gaussian beams as arrays of complex q parameters, being the array version of GaussianBeam
+    for scanning waists, wavelengths or input planes through a paraxial system in one call. The beams are on the
+    optical axis.
+
+    The beams are held in:
+
+    - self.q (N,) complex array of beam parameters in mm, with 1/q = curvature - i wavelength/(pi radius^2).
+    - self.z (N,) array of the beam planes along the optical axis.
+    - self.wavelengths (N,) array of wavelengths in microns.
+    - self.intensities (N,) array of intensities.
+
+    :param p: the plane of the beams, float or (N,) array (Default = 0.0)
+    :type p: float or np.ndarray
+    :param waist: beam waists in mm at plane p, float or (N,) array (Default = 25.0e-3)
+    :type waist: float or np.ndarray
+    :param wavelength: wavelength in microns, float or (N,) array (Default = None, package default)
+    :type wavelength: float or np.ndarray
+    :param intensity: the intensity, float or (N,) array (Default = 1.0)
+    :type intensity: float or np.ndarray
+
+    The parameters are broadcast against each other, so a scan of waists at a single wavelength is given by
+    an array of waists and a float wavelength.
+    """
+    def __init__(self,p = 0.0, waist = 25.0e-3, wavelength = None, intensity = 1.0):
+        """
+        Construct the Gaussian beams with their waists at plane p.
+        """
+        if wavelength is None:
+            wavelength = getDefaultWavelength()
+        z,w,wave,i = np.broadcast_arrays(*[np.atleast_1d(np.asarray(a,dtype = float)) for a in \
+                                           (p,waist,wavelength,intensity)])
+        self.z = z.copy()
+        self.wavelengths = wave.copy()
+        self.intensities = i.copy()
+        self.q = 1j*math.pi*w*w/self.getWavelengthMM()       # q at the waist
+
+
+    def __str__(self):
+        """
+        The str() method to give the number of beams
+        """
+        return "beams: {0:d}".format(len(self))
+
+    def __repr__(self):
+        """
+        Implement repr() to append class name to str()
+        """
+        return "{0:s} ".format(self.__class__.__name__) + str(self)
+
+    def __len__(self):
+        """
+        Implement len() to give the number of beams
+        """
+        return self.q.size
+
+    def getWavelengthMM(self):
+        """
+        Get the wavelengths in mm.
+
+        :return: (N,) np.ndarray
+        """
+        return self.wavelengths/1000.0
+
+    def setBeams(self,q,z):
+        """
+        Set the beam parameters and planes, with the wavelengths and intensities broadcast to match so that an
+        array of matrices applied to a single beam gives one beam per matrix.
+
+        :param q: complex beam parameters
+        :type q: np.ndarray
+        :param z: beam planes
+        :type z: np.ndarray
+        :return: self
+        """
+        q,z,w,i = np.broadcast_arrays(q,z,self.wavelengths,self.intensities)
+        self.q = q.astype(complex)
+        self.z = z.astype(float)
+        self.wavelengths = w.copy()
+        self.intensities = i.copy()
+        return self
+
+    def getBeam(self,i):
+        """
+        Get one of the beams as a GaussianBeam.
+
+        :param i: index of the beam
+        :type i: int
+        :return: GaussianBeam
+        """
+        beam = GaussianBeam(float(self.z[i]),1.0,float(self.wavelengths[i]),float(self.intensities[i]))
+        beam.beam = complex(1.0/self.q[i])
+        return beam
+
+
+    def getCurvature(self):
+        """
+        The beam curvatures in 1/mm
+
+        :return: (N,) np.ndarray
+        """
+        return (1.0/self.q).real
+
+    def getRadius(self):
+        """
+        Get the current beam radii (spot sizes) in mm.
+
+        :return: (N,) np.ndarray
+        """
+        alpha = np.abs((1.0/self.q).imag)
+        return np.sqrt(self.getWavelengthMM()/(math.pi*alpha))
+
+    def getWaist(self):
+        """
+        Get the minimum beam waists in mm
+
+        :return: (N,) np.ndarray
+        """
+        return np.sqrt(self.getWavelengthMM()*np.abs(self.q.imag)/math.pi)
+
+    def getWaistLocation(self):
+        """
+        Get the waist locations in global coordinates, typically the beam focus.
+
+        :return: (N,) np.ndarray
+        """
+        return self.z - self.q.real
+
+    def getRayleighRange(self):
+        """
+        Get the Rayleigh ranges of the beams in mm.
+
+        :return: (N,) np.ndarray
+        """
+        return np.abs(self.q.imag)
+
+    def getDivergence(self):
+        """
+        Get the divergence angles in radians of the beams.
+
+        :return: (N,) np.ndarray
+        """
+        return 2.0*self.getWavelengthMM()/(math.pi*self.getWaist())
+
+
+    def propagate(self,distance):
+        """
+        Propagate the beams a distance, used by the += operator.
+
+        :param distance: the distance in mm, float or (N,) array
+        :type distance: float or np.ndarray
+        :return: self
+        """
+        self.z = self.z + distance
+        self.q = self.q + distance
+        return self
+
+    def propagateTo(self,plane):
+        """
+        Propagate the beams to a plane along the optical axis, beams are not moved if the plane is infinite.
+
+        :param plane: the location of the plane
+        :type plane: float
+        :return: self
+        """
+        if not math.isinf(plane):
+            self.propagate(plane - self.z)
+        return self
+
+
+    def multBy(self,m,thickness = 0.0):
+        """
+        Multiply the beams by a ParaxialMatrix with the ABCD law. The matrix may also be given as a (2,2) array, or as a
+        (N,2,2) array of one matrix per beam to scan system configurations.
+
+        :param m: the matrix
+        :type m: ParaxialMatrix or np.ndarray
+        :param thickness: thickness if m is an array (Default = 0.0)
+        :type thickness: float or np.ndarray
+        :return: self
+        """
+        if isinstance(m,ParaxialMatrix):
+            a,b,c,d = m.A,m.B,m.C,m.D
+            thickness = m.thickness
+        else:
+            m = np.asarray(m,dtype = float)
+            a,b,c,d = m[...,0,0],m[...,0,1],m[...,1,0],m[...,1,1]
+        q = (a*self.q + b)/(c*self.q + d)
+        self.setBeams(q,self.z + thickness)
+        return self
+
+
+    def propagateThrough(self,surface):
+        """
+        Propagate the beams through a ParaxialMatrix, ParaxialGroup, ParaxialSystem or list of these.
+        For a ParaxialGroup the beams are first propagated to its input plane.
+
+        :param surface: what to propagate through
+        :return: self
+
+        Normally called by the \*= operator.
+        """
+        if isinstance(surface,list):
+            for s in surface:
+                self.propagateThrough(s)
+            return self
+        if isinstance(surface,ParaxialGroup):
+            self.propagateTo(surface.inputPlane())
+            return self.multBy(surface)
+        if isinstance(surface,ParaxialMatrix):
+            return self.multBy(surface)
+        if isinstance(surface,float):
+            return self.propagateTo(surface)
+        raise TypeError("ray.GaussianBundle.propagateThrough: called with unknown type " + str(surface))
 
 
+    def setCavityMode(self,m):
+        """
+        Set the beams to the self-consistent mode of a cavity so that q is unchanged by a round trip,
+        keeping the current wavelengths and planes. The matrix may be a (N,2,2) array to scan cavities.
+        Unstable cavities give NaN beams.
 
+        :param m: the round trip matrix, typically a CavityMatrix
+        :type m: ParaxialMatrix or np.ndarray
+        :return: self
+        """
+        if isinstance(m,ParaxialMatrix):
+            a,b,c,d = m.A,m.B,m.C,m.D
+        else:
+            m = np.asarray(m,dtype = float)
+            a,b,c,d = m[...,0,0],m[...,0,1],m[...,1,0],m[...,1,1]
+        a,b,c,d = np.broadcast_arrays(*[np.asarray(x,dtype = float) for x in (a,b,c,d)])
+        half = (a + d)/2.0
+        with np.errstate(invalid = "ignore",divide = "ignore"):
+            s = np.sqrt(1.0 - half*half)                   # NaN if unstable
+            invq = (d - a)/(2.0*b) - 1j*s/np.abs(b)        # 1/q with a beam of finite size
+            q = 1.0/invq
+        self.setBeams(q,self.z)
+        return self
 
 
+    def __imul__(self,surface):
+        """
+        Implement \*= to propagate through a ParaxialMatrix, ParaxialGroup or ParaxialSystem
+        """
+        return self.propagateThrough(surface)
 
+    def __iadd__(self,d):
+        """
+        Implement += to propagate a specified distance
+        """
+        return self.propagate(d)
@@ -101,6 +101,7 @@ class Prism(OpticalGroup):
         self[1].point = p
         self[0].normal = fn
         self[1].normal = bn
+        self.plan = None                # Geometry changed so remake trace plan
         return self
 
 
@@ -2,10 +2,11 @@
 Set of classes to implement various types of optical surface.
 
 """
-from poptics.vector import Vector2d,Vector3d,Unit3d
+from poptics.vector import Vector2d,Vector3d,Unit3d,Axis3d
 from poptics.ray import SourcePoint
 from poptics.matrix import ParaxialGroup
 import math
+import numpy as np
 from matplotlib.pyplot import plot
 
 """
@@ -14,6 +15,7 @@ Define the three types of surface.
 Clear = 0             #: Define a clear surface.
 Refracting = 1        #: Define a refracting surface.
 Reflecting = 2        #: Define a reflecting surface,
+Break = 3             #: Define a coordinate break.
 Blocked = Unit3d()    #: Define blacoked as an invalid Units3d
 
 """
@@ -21,6 +23,17 @@ Define surface plotting parameter
 """
 SurfacePlotPoints = 10
 
+"""
+Define the convergence tolerance and maximum iterations of the Newton intersection for PolynomialSurface.
+"""
+NewtonTolerance = 1.0e-10
+NewtonIterations = 20
+
+"""
+Cache of which alternative interaction methods match getSurfaceInteraction() for each surface class.
+"""
+InteractionCache = {}
+
 class SurfaceInteraction(object):
     """
     Class to hold the interaction of a vector skew ray with a general surface.
@@ -88,10 +101,10 @@ class Surface(object):
         Constructor to form a basic surface
         """
 
+        self.group = None
         self.setPoint(pt)
         self.type = type
         #
-        self.group = None
         self.refractiveindex = index
 
 
@@ -111,6 +124,24 @@ class Surface(object):
 
 
 
+    @property
+    def point(self):
+        """
+        The surface reference point relative to any OpticalGroup as a Vector3d.
+        """
+        return self._point
+
+    @point.setter
+    def point(self,pt):
+        """
+        Set the reference point, so clearing the TracePlan of any OpticalGroup
+        the surface belongs to, even if assigned directly rather than by setPoint().
+        """
+        self._point = pt
+        if getattr(self,"group",None) != None:
+            self.group.plan = None         # Geometry of group changed
+
+
     def setPoint(self,pt = 0.0):
         """
         Method to set the surface reference point in a consistent way for
@@ -132,7 +163,6 @@ class Surface(object):
             self.point = Vector3d(0.0,0.0,pt)
         else:
             raise TypeError("surface.Surface.setPoint: called with unknown type")
-
         return self
 
     def incrementPoint(self,delta):
@@ -149,7 +179,6 @@ class Surface(object):
             self.point += Vector3d(0.0,0.0,float(delta))
         else:
             self.point += delta
-
         return self
 
     def incrementSurface(self,delta):
@@ -207,6 +236,7 @@ class Surface(object):
         if self.group != None:
             self.point = self.getPoint()
             self.group.remove(self)
+            self.group.plan = None
             self.group = None
         return self
 
@@ -256,6 +286,97 @@ class Surface(object):
                 Vector3d().setInvalid(),Blocked,self.refractiveindex)
 
 
+    def getBatchInteraction(self,positions,directors,point = None):
+        """
+        Method to get the surface interaction information for a set of rays held
+        as arrays, this is the array version of getSurfaceInteraction().
+
+        :param positions: the ray positions in global coordinates
+        :type positions: np.ndarray (N,3)
+        :param directors: the ray directors
+        :type directors: np.ndarray (N,3)
+        :param point: the surface reference point in global coordinates if known (Default = None, use getPoint())
+        :type point: Vector3d or None
+        :return: distances (N,), positions (N,3), normals (N,3) and blocked (N,) arrays
+
+        This is abstract surface, so all rays will be blocked with NaN distance.
+        Distance will be NaN if ray misses the surface, and normals will be NaN if
+        the ray is blocked.
+        """
+        n = len(positions)
+        return np.full(n,np.nan),np.full((n,3),np.nan),np.full((n,3),np.nan),np.ones(n,dtype = bool)
+
+
+    def getFlatRadius(self):
+        """
+        Get the radius of the surface if it is a clear flat surface normal to the optical axis whose interaction is only
+        the intercept with the plane and a radius test, so it can be traced by the fast flat kernels in poptics.ray.
+
+        :return: the radius as float (inf if not limited), or None if the surface needs its full interaction.
+
+        This is abstract surface, so returns None.
+        """
+        return None
+
+
+    def hasBatchInteraction(self):
+        """
+        Test if getBatchInteraction() gives the same interaction as getSurfaceInteraction(). This will be
+        False if an extending class, for example an image that records rays, has redefined getSurfaceInteraction()
+        without also redefining getBatchInteraction().
+
+        :return: True if getBatchInteraction() can be used.
+        """
+        return self.hasInteraction("getBatchInteraction")
+
+
+    def hasFastInteraction(self):
+        """
+        Test if moveToSurface() gives the same interaction as getSurfaceInteraction(), see hasBatchInteraction().
+
+        :return: True if moveToSurface() can be used.
+        """
+        return self.hasInteraction("moveToSurface")
+
+
+    def hasInteraction(self,name):
+        """
+        Test if the named alternative to getSurfaceInteraction() is defined by the same class, or a class that
+        extends it, as getSurfaceInteraction() so will give the same interaction. The result is cached for each class.
+
+        :param name: name of the method
+        :type name: str
+        :return: True if the named method can be used.
+        """
+        key = (type(self),name)
+        if not key in InteractionCache:
+            InteractionCache[key] = False
+            for c in type(self).__mro__:
+                if name in c.__dict__:
+                    InteractionCache[key] = True
+                    break
+                if "getSurfaceInteraction" in c.__dict__:
+                    break
+        return InteractionCache[key]
+
+
+    def moveToSurface(self,ray,point = None):
+        """
+        Fast version of getSurfaceInteraction() that moves the position of the ray to the surface in place
+        and returns the distance and surface normal as floats, so no new objects are made.
+
+        :param ray: the ray, its position will be updated
+        :type ray: poptics.ray.IntensityRay
+        :param point: the surface reference point in global coordinates if known (Default = None, use getPoint())
+        :type point: Vector3d or None
+        :return: distance,nx,ny,nz as floats, distance is NaN if the ray misses the surface (position not updated), normal is NaN if blocked.
+
+        This is abstract surface, so the ray will miss.
+        """
+        nan = float("nan")
+        return nan,nan,nan,nan
+
+
 
     def draw(self,option = None):
         """
@@ -293,6 +414,22 @@ class FlatSurface(Surface):
             self.normal = Unit3d(normal)
         self.curvature = 0.0
 
+    @property
+    def normal(self):
+        """
+        The surface normal as a Unit3d.
+        """
+        return self._normal
+
+    @normal.setter
+    def normal(self,normal):
+        """
+        Set the surface normal, so clearing the TracePlan of any OpticalGroup the surface belongs to.
+        """
+        self._normal = normal
+        if getattr(self,"group",None) != None:
+            self.group.plan = None         # Geometry of group changed
+
 
     def __str__(self):
         """
@@ -356,6 +493,50 @@ class FlatSurface(Surface):
         return SurfaceInteraction(self.type,pt,distance,pos,self.normal,self.refractiveindex)
 
 
+    def getBatchInteraction(self,positions,directors,point = None):
+        """
+        Method to get the surface interaction information for arrays of rays.
+
+        :param positions: the ray positions
+        :type positions: np.ndarray (N,3)
+        :param directors: the ray directors
+        :type directors: np.ndarray (N,3)
+        :param point: the surface reference point in global coordinates if known (Default = None, use getPoint())
+        :type point: Vector3d or None
+        :return: distances (N,), positions (N,3), normals (N,3) and blocked (N,) arrays
+        """
+        pt = self.getPoint() if point == None else point
+        n = np.array([self.normal.x,self.normal.y,self.normal.z])
+        distances = (np.array([pt.x,pt.y,pt.z]) - positions).dot(n)/directors.dot(n)
+        pos = positions + distances[:,np.newaxis]*directors
+        normals = np.tile(n,(len(distances),1))
+        blocked = np.isnan(distances)
+        normals[blocked] = np.nan
+        return distances,pos,normals,blocked
+
+
+    def moveToSurface(self,ray,point = None):
+        """
+        Fast in place version of getSurfaceInteraction(), see Surface.moveToSurface().
+
+        :param ray: the ray, its position will be updated
+        :type ray: poptics.ray.IntensityRay
+        :param point: the surface reference point in global coordinates if known (Default = None, use getPoint())
+        :type point: Vector3d or None
+        :return: distance,nx,ny,nz as floats
+        """
+        pt = self.getPoint() if point == None else point
+        p = ray.position
+        u = ray.director
+        n = self.normal
+        distance = (n.x*(pt.x - p.x) + n.y*(pt.y - p.y) + n.z*(pt.z - p.z))/n.dot(u)
+        if distance == distance:           # Not NaN
+            p.x += distance*u.x
+            p.y += distance*u.y
+            p.z += distance*u.z
+        return distance,n.x,n.y,n.z
+
+
 class OpticalPlane(FlatSurface):
     """
     Class to implement a flat optical place normal to the optical, this is simpler and
@@ -467,6 +648,61 @@ class OpticalPlane(FlatSurface):
         return SurfaceInteraction(self.type,pt,distance,pos,self.normal,self.refractiveindex)
 
 
+    def getBatchInteraction(self,positions,directors,point = None):
+        """
+        Method to get the surface interaction information for arrays of rays.
+
+        :param positions: the ray positions
+        :type positions: np.ndarray (N,3)
+        :param directors: the ray directors
+        :type directors: np.ndarray (N,3)
+        :param point: the surface reference point in global coordinates if known (Default = None, use getPoint())
+        :type point: Vector3d or None
+        :return: distances (N,), positions (N,3), normals (N,3) and blocked (N,) arrays
+        """
+        pt = self.getPoint() if point == None else point
+        distances = (pt.z - positions[:,2])/directors[:,2]
+        pos = positions + distances[:,np.newaxis]*directors
+        normals = np.tile([self.normal.x,self.normal.y,self.normal.z],(len(distances),1))
+        blocked = np.isnan(distances)
+        normals[blocked] = np.nan
+        return distances,pos,normals,blocked
+
+
+    def moveToSurface(self,ray,point = None):
+        """
+        Fast in place version of getSurfaceInteraction(), see Surface.moveToSurface().
+
+        :param ray: the ray, its position will be updated
+        :type ray: poptics.ray.IntensityRay
+        :param point: the surface reference point in global coordinates if known (Default = None, use getPoint())
+        :type point: Vector3d or None
+        :return: distance,nx,ny,nz as floats
+        """
+        pt = self.getPoint() if point == None else point
+        p = ray.position
+        u = ray.director
+        distance = (pt.z - p.z)/u.z
+        p.x += distance*u.x
+        p.y += distance*u.y
+        p.z += distance*u.z
+        n = self.normal
+        return distance,n.x,n.y,n.z
+
+
+    def getFlatRadius(self):
+        """
+        Get the radius for the fast flat kernels, see Surface.getFlatRadius(), being inf for a clear plane unless
+        an extending class has its own interaction.
+
+        :return: inf or None
+        """
+        if self.type == Clear and type(self).getBatchInteraction is OpticalPlane.getBatchInteraction \
+           and self.hasBatchInteraction():
+            return float("inf")
+        return None
+
+
     def getParaxialInteraction(self,ray):
         p = self.getPoint()
         distance = p.z - ray.z
@@ -474,6 +710,24 @@ class OpticalPlane(FlatSurface):
 
         return [self.type,distance,height,0.0,self.refractiveindex]
 
+    def getBatchParaxialInteraction(self,z,h,u):
+        """
+        Get the paraxial interaction for arrays of paraxial rays, being the array version of getParaxialInteraction(),
+        used by ray.ParaxialBundle.
+
+        :param z: positions of the rays along the optical axis
+        :type z: np.ndarray
+        :param h: ray heights
+        :type h: np.ndarray
+        :param u: ray angles
+        :type u: np.ndarray
+        :return: (distance,height,curvature) as np.ndarray with curvature NaN where the ray is blocked.
+        """
+        p = self.getPoint()
+        distance = p.z - z
+        height = h + distance*u
+        return distance,height,np.zeros(height.size)
+
     def paraxialGroup(self, option = None):
         """
         Get the ParaxialGroup of the surface for compatibility, it will be reference point
@@ -591,6 +845,71 @@ class CircularAperture(OpticalPlane):
         return SurfaceInteraction(self.type,pt,distance,pos,u,self.refractiveindex)
 
 
+    def getBatchInteraction(self,positions,directors,point = None):
+        """
+        Method to get the surface interaction information for arrays of rays, rays
+        outside the aperture are blocked.
+
+        :param positions: the ray positions
+        :type positions: np.ndarray (N,3)
+        :param directors: the ray directors
+        :type directors: np.ndarray (N,3)
+        :param point: the surface reference point in global coordinates if known (Default = None, use getPoint())
+        :type point: Vector3d or None
+        :return: distances (N,), positions (N,3), normals (N,3) and blocked (N,) arrays
+        """
+        distances,pos,normals,blocked = OpticalPlane.getBatchInteraction(self,positions,directors,point)
+        pt = self.getPoint() if point == None else point
+        dx = pos[:,0] - pt.x
+        dy = pos[:,1] - pt.y
+        radius = self.getRadius()
+        blocked = ~(dx*dx + dy*dy <= radius*radius)     # Will also catch NaN
+        normals[blocked] = np.nan
+        return distances,pos,normals,blocked
+
+
+    def moveToSurface(self,ray,point = None):
+        """
+        Fast in place version of getSurfaceInteraction(), see Surface.moveToSurface().
+
+        :param ray: the ray, its position will be updated
+        :type ray: poptics.ray.IntensityRay
+        :param point: the surface reference point in global coordinates if known (Default = None, use getPoint())
+        :type point: Vector3d or None
+        :return: distance,nx,ny,nz as floats
+        """
+        pt = self.getPoint() if point == None else point
+        p = ray.position
+        u = ray.director
+        distance = (pt.z - p.z)/u.z
+        p.x += distance*u.x
+        p.y += distance*u.y
+        p.z += distance*u.z
+
+        dx = p.x - pt.x
+        dy = p.y - pt.y
+        radius = self.getRadius()
+        if dx*dx + dy*dy <= radius*radius:
+            n = self.normal
+            return distance,n.x,n.y,n.z
+        else:
+            nan = float("nan")
+            return distance,nan,nan,nan
+
+
+    def getFlatRadius(self):
+        """
+        Get the radius for the fast flat kernels, see Surface.getFlatRadius(), being the current radius
+        unless an extending class has its own interaction.
+
+        :return: the radius or None
+        """
+        if self.type == Clear and type(self).getBatchInteraction is CircularAperture.getBatchInteraction \
+           and self.hasBatchInteraction():
+            return self.getRadius()
+        return None
+
+
     def getParaxialInteraction(self,ray):
         p = self.getPoint()
         distance = p.z - ray.z
@@ -604,6 +923,25 @@ class CircularAperture(OpticalPlane):
 
         return [self.type,distance,height,c,self.refractiveindex]
 
+    def getBatchParaxialInteraction(self,z,h,u):
+        """
+        Get the paraxial interaction for arrays of paraxial rays, being the array version of getParaxialInteraction(),
+        used by ray.ParaxialBundle.
+
+        :param z: positions of the rays along the optical axis
+        :type z: np.ndarray
+        :param h: ray heights
+        :type h: np.ndarray
+        :param u: ray angles
+        :type u: np.ndarray
+        :return: (distance,height,curvature) as np.ndarray with curvature NaN where the ray is blocked.
+        """
+        p = self.getPoint()
+        distance = p.z - z
+        height = h + distance*u
+        c = np.where(np.abs(height - p.y) <= self.outerRadius,0.0,float("nan"))
+        return distance,height,c
+
 
 
 
@@ -714,6 +1052,58 @@ class AnnularAperture(CircularAperture):
         return SurfaceInteraction(self.type,pt,distance,pos,u,self.refractiveindex)
 
 
+    def getBatchInteraction(self,positions,directors,point = None):
+        """
+        Method to get the surface interaction information for arrays of rays, rays
+        outside the annulus are blocked.
+
+        :param positions: the ray positions
+        :type positions: np.ndarray (N,3)
+        :param directors: the ray directors
+        :type directors: np.ndarray (N,3)
+        :param point: the surface reference point in global coordinates if known (Default = None, use getPoint())
+        :type point: Vector3d or None
+        :return: distances (N,), positions (N,3), normals (N,3) and blocked (N,) arrays
+        """
+        distances,pos,normals,blocked = OpticalPlane.getBatchInteraction(self,positions,directors,point)
+        pt = self.getPoint() if point == None else point
+        dx = pos[:,0] - pt.x
+        dy = pos[:,1] - pt.y
+        rsqr = dx*dx + dy*dy
+        blocked = ~((rsqr <= self.outerRadius*self.outerRadius) & (rsqr >= self.innerRadius*self.innerRadius))
+        normals[blocked] = np.nan
+        return distances,pos,normals,blocked
+
+
+    def moveToSurface(self,ray,point = None):
+        """
+        Fast in place version of getSurfaceInteraction(), see Surface.moveToSurface().
+
+        :param ray: the ray, its position will be updated
+        :type ray: poptics.ray.IntensityRay
+        :param point: the surface reference point in global coordinates if known (Default = None, use getPoint())
+        :type point: Vector3d or None
+        :return: distance,nx,ny,nz as floats
+        """
+        pt = self.getPoint() if point == None else point
+        p = ray.position
+        u = ray.director
+        distance = (pt.z - p.z)/u.z
+        p.x += distance*u.x
+        p.y += distance*u.y
+        p.z += distance*u.z
+
+        dx = p.x - pt.x
+        dy = p.y - pt.y
+        rsqr = dx*dx + dy*dy
+        if rsqr <= self.outerRadius*self.outerRadius and rsqr >= self.innerRadius*self.innerRadius :
+            n = self.normal
+            return distance,n.x,n.y,n.z
+        else:
+            nan = float("nan")
+            return distance,nan,nan,nan
+
+
     def getParaxialInteraction(self,ray):
         p = self.getPoint()
         distance = p.z - ray.z
@@ -727,6 +1117,26 @@ class AnnularAperture(CircularAperture):
 
         return [self.type,distance,height,c,self.refractiveindex]
 
+    def getBatchParaxialInteraction(self,z,h,u):
+        """
+        Get the paraxial interaction for arrays of paraxial rays, being the array version of getParaxialInteraction(),
+        used by ray.ParaxialBundle.
+
+        :param z: positions of the rays along the optical axis
+        :type z: np.ndarray
+        :param h: ray heights
+        :type h: np.ndarray
+        :param u: ray angles
+        :type u: np.ndarray
+        :return: (distance,height,curvature) as np.ndarray with curvature NaN where the ray is blocked.
+        """
+        p = self.getPoint()
+        distance = p.z - z
+        height = h + distance*u
+        dy = np.abs(height - p.y)
+        c = np.where((dy <= self.outerRadius) & (dy >= self.innerRadius),0.0,float("nan"))
+        return distance,height,c
+
     #
     def draw(self,option = None):
         """
@@ -790,6 +1200,8 @@ class IrisAperture(CircularAperture):
 
         """
         self.ratio = float(ratio)
+        if self.group != None:
+            self.group.plan = None         # Radius in group changed
         return self
 
     def getRadius(self):
@@ -812,6 +1224,25 @@ class IrisAperture(CircularAperture):
 
         return [self.type,distance,height,c,self.refractiveindex]
 
+    def getBatchParaxialInteraction(self,z,h,u):
+        """
+        Get the paraxial interaction for arrays of paraxial rays, being the array version of getParaxialInteraction(),
+        used by ray.ParaxialBundle.
+
+        :param z: positions of the rays along the optical axis
+        :type z: np.ndarray
+        :param h: ray heights
+        :type h: np.ndarray
+        :param u: ray angles
+        :type u: np.ndarray
+        :return: (distance,height,curvature) as np.ndarray with curvature NaN where the ray is blocked.
+        """
+        p = self.getPoint()
+        distance = p.z - z
+        height = h + distance*u
+        c = np.where(np.abs(height - p.y) <= self.outerRadius*self.ratio,0.0,float("nan"))
+        return distance,height,c
+
     def draw(self,option = None):
         """
         Draw the aperture, same as aperure but with extra bars to mark current radius
@@ -935,6 +1366,37 @@ class KnifeAperture(CircularAperture):
         return SurfaceInteraction(self.type,pt,distance,pos,u,self.refractiveindex)
 
 
+    def getBatchInteraction(self,positions,directors,point = None):
+        """
+        Method to get the surface interaction information for arrays of rays, rays
+        outside the aperture or stopped by the knife / wire are blocked.
+
+        :param positions: the ray positions
+        :type positions: np.ndarray (N,3)
+        :param directors: the ray directors
+        :type directors: np.ndarray (N,3)
+        :param point: the surface reference point in global coordinates if known (Default = None, use getPoint())
+        :type point: Vector3d or None
+        :return: distances (N,), positions (N,3), normals (N,3) and blocked (N,) arrays
+        """
+        pt = (self.getPoint() if point == None else point) + self.shift   # Include local shift
+        distances = (pt.z - positions[:,2])/directors[:,2]
+        pos = positions + distances[:,np.newaxis]*directors
+
+        dx = pos[:,0] - pt.x
+        dy = pos[:,1] - pt.y
+        r =  dy*math.cos(self.theta) - dx*math.sin(self.theta)
+        if self.wire:
+            clear = ~((r > self.knife - self.thickness/2) & (r < self.knife + self.thickness/2))
+        else:
+            clear = r < self.knife
+        blocked = ~((dx*dx + dy*dy <= self.outerRadius*self.outerRadius) & clear)
+
+        normals = np.tile([self.normal.x,self.normal.y,self.normal.z],(len(distances),1))
+        normals[blocked] = np.nan
+        return distances,pos,normals,blocked
+
+
 class ImagePlane(OpticalPlane):
     """
     Class to form an image plane (either input or output) of specific location and size.
@@ -1175,7 +1637,7 @@ class QuadricSurface(OpticalPlane):
             x *= -c
             y *= -c
             z = 1.0 - c*eps*(r.z - p.z)
-            return Unit3d(x,y,z)   # Will be auto normalsied
+            return Unit3d.fromFloats(x,y,z).normalise()
     #
     #
     #
@@ -1254,12 +1716,116 @@ class QuadricSurface(OpticalPlane):
             x *= -c
             y *= -c
             z = 1.0 - c*eps*(pos.z - p.z)
-            u =  Unit3d(x,y,z)   # Will be auto normalsied
+            u =  Unit3d.fromFloats(x,y,z).normalise()
 
         #
         #     Return list of information
         return SurfaceInteraction(self.type,p,d,pos,u,self.refractiveindex)
 
+
+    def getBatchInteraction(self,positions,directors,point = None):
+        """
+        Method to get the surface interaction information for arrays of rays, this uses
+        the same calcualtion as getSurfaceInteraction().
+
+        :param positions: the ray positions
+        :type positions: np.ndarray (N,3)
+        :param directors: the ray directors
+        :type directors: np.ndarray (N,3)
+        :param point: the surface reference point in global coordinates if known (Default = None, use getPoint())
+        :type point: Vector3d or None
+        :return: distances (N,), positions (N,3), normals (N,3) and blocked (N,) arrays
+        """
+        p = self.getPoint() if point == None else point
+        ux = directors[:,0]
+        uy = directors[:,1]
+        uz = directors[:,2]
+
+        d = (p.z - positions[:,2])/uz                 # Distance to plane (direct calculation)
+        x = positions[:,0] + d*ux - p.x               # x/y Pt in plane
+        y = positions[:,1] + d*uy - p.y
+
+        c = self.curvature
+        eps = self.epsilon
+
+        #         form distance from plane to surface that will NOT fail for curve = 0
+        f = c*(x*x + y*y)
+        g = uz - c*(x*ux + y*uy)
+        e = c*(1.0 + (eps - 1.0)*uz*uz)
+        a = g*g - e*f
+        #          rays that miss the surface totally get NaN distance
+        with np.errstate(invalid = "ignore", divide = "ignore"):
+            d += np.where(a > 0, f/(g + np.copysign(np.sqrt(a),g)), np.nan)
+
+        #          Get position of ray on surface
+        pos = positions + d[:,np.newaxis]*directors
+
+        #          Now get surface normal at these points
+        x = pos[:,0] - p.x
+        y = pos[:,1] - p.y
+        blocked = ~(x*x + y*y <= self.maxRadius*self.maxRadius)     # Blocked by max radius, or NaN
+        nx = -c*x
+        ny = -c*y
+        nz = 1.0 - c*eps*(pos[:,2] - p.z)
+        normals = np.column_stack((nx,ny,nz))
+        normals /= np.sqrt(nx*nx + ny*ny + nz*nz)[:,np.newaxis]     # Normalise as Unit3d
+        normals[blocked] = np.nan
+
+        return d,pos,normals,blocked
+
+
+    def moveToSurface(self,ray,point = None):
+        """
+        Fast in place version of getSurfaceInteraction(), see Surface.moveToSurface(), this
+        does the identical calcualtion.
+
+        :param ray: the ray, its position will be updated
+        :type ray: poptics.ray.IntensityRay
+        :param point: the surface reference point in global coordinates if known (Default = None, use getPoint())
+        :type point: Vector3d or None
+        :return: distance,nx,ny,nz as floats
+        """
+        p = self.getPoint() if point == None else point
+        r = ray.position
+        u = ray.director
+
+        d = (p.z - r.z)/u.z     # Distance to plane (direct calculation)
+        x = r.x + d*u.x - p.x   # x/y Pt in plane
+        y = r.y + d*u.y - p.y
+
+        c = self.curvature
+        eps = self.epsilon
+
+        #         form distance from plane to surface that will NOT fail for curve = 0
+        f = c*(x*x + y*y)
+        g = u.z - c*(x*u.x + y*u.y)
+        e = c*(1.0 + (eps - 1.0)*u.z*u.z)
+        a = g*g - e*f
+        nan = float("nan")
+        if a > 0:
+            d += f/(g + math.copysign(math.sqrt(a),g))     # add extra distance, retaining sign
+        else:
+            return nan,nan,nan,nan                         # Missed surface
+
+        #          Move ray to the surface
+        r.x += d*u.x
+        r.y += d*u.y
+        r.z += d*u.z
+
+        #          Surface normal at this point
+        x = r.x - p.x
+        y = r.y - p.y
+        if x*x + y*y > self.maxRadius*self.maxRadius:
+            return d,nan,nan,nan                           # Blocked by max radius
+
+        x *= -c
+        y *= -c
+        z = 1.0 - c*eps*(r.z - p.z)
+        norm = math.sqrt(x*x + y*y + z*z)                  # Normalise as Unit3d
+        if norm == 0.0:
+            return d,nan,nan,nan
+        return d,x/norm,y/norm,z/norm
+
     #
     #
     def getParaxialInteraction(self,ray):
@@ -1283,6 +1849,25 @@ class QuadricSurface(OpticalPlane):
 
         return [self.type,distance,height,c,self.refractiveindex]
 
+    def getBatchParaxialInteraction(self,z,h,u):
+        """
+        Get the paraxial interaction for arrays of paraxial rays, being the array version of getParaxialInteraction(),
+        used by ray.ParaxialBundle.
+
+        :param z: positions of the rays along the optical axis
+        :type z: np.ndarray
+        :param h: ray heights
+        :type h: np.ndarray
+        :param u: ray angles
+        :type u: np.ndarray
+        :return: (distance,height,curvature) as np.ndarray with curvature NaN where the ray is blocked.
+        """
+        p = self.getPoint()
+        distance = p.z - z
+        height = h + distance*u
+        c = np.where(np.abs(h - p.y) <= self.maxRadius,self.curvature,float("nan"))
+        return distance,height,c
+
 
     def draw(self,option = None):
         """
@@ -1410,3 +1995,694 @@ class ParabolicSurface(QuadricSurface):
                                 self.refractiveIndex)
 
 
+
+
+class PolynomialSurface(QuadricSurface):
+    """
+    Abstract class to implement a surface with sag given by a quadric plus additional polynomial terms, being
+    the base class for EvenAsphericSurface and XYPolynomialSurface which define getPolynomialSag().
+
+    The ray intersection is found by a Newton iteration along each ray seeded from the intersection with the
+    underlying QuadricSurface. This is done for all rays together in getBatchInteraction(), which
+    getSurfaceInteraction() and moveToSurface() also use for a single ray, so they give identical results.
+
+    :param pos: the plane reference point
+    :type pos: Vector3d or float
+    :param curve: the curcature.
+    :type curve: float
+    :param epsilon: the quadric parameter
+    :type epsilon: float
+    :param radius: the maxradius
+    :type radius: float
+    :param index:  the Refratcive index. If present, surface is refracting, if None it is reflecting.
+    :type index: RefractiveIndex or None
+
+    The convergence of the last intersection is held in newtonIterations, the number of iterations taken,
+    newtonFailures, the number of rays that failed to converge, and newtonResidual, the largest remaining
+    distance along the optical axis between the rays and the surface; these are also returned by getConvergence().
+    The paraxial interaction uses the curvature of the underlying quadric.
+    """
+
+    def __init__(self, pos, curve, epsilon, radius, index = None):
+        """
+        Constructor
+        """
+        QuadricSurface.__init__(self,pos,curve,epsilon,radius,index)
+        self.tolerance = NewtonTolerance            # Convergence tolerance on distance
+        self.maxIterations = NewtonIterations       # Maximum number of iterations
+        self.newtonIterations = 0
+        self.newtonFailures = 0
+        self.newtonResidual = 0.0
+
+
+    def getPolynomialSag(self,x,y):
+        """
+        Abstract method to get the sag of the polynomial terms and its derivatives, to be defined by extending classes.
+
+        :param x: x positions relative to the reference point
+        :type x: np.ndarray
+        :param y: y positions relative to the reference point
+        :type y: np.ndarray
+        :return: sag, dsag/dx and dsag/dy as np.ndarray
+        """
+        raise NotImplementedError("surface.PolynomialSurface.getPolynomialSag not implemented")
+
+
+    def getSag(self,x,y):
+        """
+        Get the sag of the surface, being the quadric plus the polynomial terms, and its derivatives.
+        Points outside the quadric give NaN.
+
+        :param x: x positions relative to the reference point
+        :type x: np.ndarray or float
+        :param y: y positions relative to the reference point
+        :type y: np.ndarray or float
+        :return: sag, dsag/dx and dsag/dy as np.ndarray
+        """
+        x = np.asarray(x,dtype = float)
+        y = np.asarray(y,dtype = float)
+        c = self.curvature
+        rsqr = x*x + y*y
+        a = 1.0 - c*c*self.epsilon*rsqr
+        with np.errstate(invalid = "ignore", divide = "ignore"):
+            a = np.where(a > 0.0,np.sqrt(a),np.nan)     # Impossible surface gives NaN
+            z = c*rsqr/(1.0 + a)
+            zx = c*x/a
+            zy = c*y/a
+        s,sx,sy = self.getPolynomialSag(x,y)
+        return z + s,zx + sx,zy + sy
+
+
+    def getConvergence(self):
+        """
+        Get the convergence of the Newton iteration for the last intersection calculated.
+
+        :return: (iterations, failures, residual) as (int,int,float)
+        """
+        return self.newtonIterations,self.newtonFailures,self.newtonResidual
+
+
+    def getSourcePoint(self, x, y = None,intensity = 1.0):
+        """
+        Get the SourcePoint for a specified point in the plane allowing for the sag.
+
+        :param x: Vector2d point in the plane or x component
+        :type x: Vector2d or float
+        :param y: y component (Default = Null)
+        :type y: float
+        :param intensity: the intensity (Default = 1.0)
+        :type intensity: float
+        """
+        if isinstance(x,Vector2d):
+            y = x.y
+            x = x.x
+
+        z = float(self.getSag(x,y)[0])
+        if math.isnan(z):
+            raise ValueError("surface.PolynomialSurface.getSourcePoint: impossible surface at x: {0:8.5e} y: {1:8.5e}"\
+                             .format(x,y))
+        refpt = self.getPoint()
+        return SourcePoint([x + refpt.x,y + refpt.y,z + refpt.z],intensity)
+
+
+    def getDistance(self,r,u):
+        """
+        Method to get the distance from r in direction u to the surface (not use in tracing, use getSurfaceInteraction())
+
+        :param r: the point in space.
+        :type r: Vector3d
+        :param u: the director at that point
+        :type u: Unit3d
+        :return: the distance to the surface as float
+        """
+        d,pos,normals,blocked = self.getBatchInteraction(np.array([[r.x,r.y,r.z]]),np.array([[u.x,u.y,u.z]]))
+        return float(d[0])
+
+
+    def getNormal(self,r):
+        """
+        Method to get the surface normal at point r on the surface
+
+        :param r: the point on the surface
+        :type r: Vector3d
+        :return: Unit3d, the surface normal or Blocked.
+        """
+        p = self.getPoint()
+        x = r.x - p.x
+        y = r.y - p.y
+        if x*x + y*y > self.maxRadius*self.maxRadius:
+            return Blocked
+        s,sx,sy = self.getSag(x,y)
+        return Unit3d.fromFloats(-float(sx),-float(sy),1.0).normalise()
+
+
+    def edgePlane(self):
+        """
+        Get the plane at the edge of the surface, being the sag at maxRadius along the y-axis, it will fail with
+        ValueError if this is an impossible surface that has no edge.
+        """
+        z = float(self.getSag(0.0,self.maxRadius)[0])
+        if math.isnan(z):
+            raise ValueError("surface.PolynomialSurface.edgePlane: impossible surface: c: {0:8.5e} e: {1:8.5} r: {2:8.5e}"\
+                             .format(self.curvature,self.epsilon,self.maxRadius))
+        return z
+
+
+    def getSurfaceInteraction(self,ray):
+        """
+        Method to get back the surface interaction information with a Ray, calculated via getBatchInteraction().
+
+        :param ray: the input ray
+        :type ray: poptics.ray.IntensityRay
+        :return: SurfaceInteraction
+        """
+        p = self.getPoint()
+        d,nx,ny,nz = self.getRayInteraction(ray,p)
+        if math.isnan(d):
+            return SurfaceInteraction(self.type,p,float("nan"),p,Blocked,self.refractiveindex)
+
+        pos = ray.position.propagate(d,ray.director)
+        if math.isnan(nx):
+            u = Blocked
+        else:
+            u = Unit3d.fromFloats(nx,ny,nz)
+        return SurfaceInteraction(self.type,p,d,pos,u,self.refractiveindex)
+
+
+    def getRayInteraction(self,ray,point):
+        """
+        Get the interaction of a single ray as floats via getBatchInteraction().
+
+        :param ray: the ray
+        :type ray: poptics.ray.IntensityRay
+        :param point: the surface reference point in global coordinates
+        :type point: Vector3d
+        :return: distance,nx,ny,nz as floats
+        """
+        r = ray.position
+        u = ray.director
+        d,pos,normals,blocked = self.getBatchInteraction(np.array([[r.x,r.y,r.z]]),np.array([[u.x,u.y,u.z]]),point)
+        return float(d[0]),float(normals[0,0]),float(normals[0,1]),float(normals[0,2])
+
+
+    def getBatchInteraction(self,positions,directors,point = None):
+        """
+        Method to get the surface interaction information for arrays of rays by a Newton iteration along
+        each ray seeded by the intersection with the quadric. Only the unconverged rays are iterated, and rays that fail
+        to converge within maxIterations are taken to miss the surface.
+
+        :param positions: the ray positions
+        :type positions: np.ndarray (N,3)
+        :param directors: the ray directors
+        :type directors: np.ndarray (N,3)
+        :param point: the surface reference point in global coordinates if known (Default = None, use getPoint())
+        :type point: Vector3d or None
+        :return: distances (N,), positions (N,3), normals (N,3) and blocked (N,) arrays
+        """
+        p = self.getPoint() if point == None else point
+        d = QuadricSurface.getBatchInteraction(self,positions,directors,p)[0]
+        with np.errstate(invalid = "ignore", divide = "ignore"):
+            plane = (p.z - positions[:,2])/directors[:,2]
+        d = np.where(np.isnan(d),plane,d)                 # Seed rays that miss the quadric from the plane
+
+        #          Newton iteration on f(d) = z(d) - sag(x(d),y(d)) for the rays not yet converged
+        active = np.flatnonzero(np.isfinite(d))
+        failures = len(d) - len(active)
+        d[~np.isfinite(d)] = np.nan
+        iterations = 0
+        while len(active) > 0 and iterations < self.maxIterations:
+            iterations += 1
+            r = positions[active]
+            u = directors[active]
+            t = d[active]
+            x = r[:,0] + t*u[:,0] - p.x
+            y = r[:,1] + t*u[:,1] - p.y
+            s,sx,sy = self.getSag(x,y)
+            with np.errstate(invalid = "ignore", divide = "ignore"):
+                dt = (r[:,2] + t*u[:,2] - p.z - s)/(u[:,2] - sx*u[:,0] - sy*u[:,1])
+            d[active] = t - dt
+            finite = np.isfinite(dt)
+            d[active[~finite]] = np.nan                  # Left the surface, so missed
+            failures += np.count_nonzero(~finite)
+            active = active[finite & (np.abs(dt) > self.tolerance)]
+
+        d[active] = np.nan                                # Not converged, so missed
+        failures += len(active)
+
+        #          Get position of rays on the surface and the normals
+        pos = positions + d[:,np.newaxis]*directors
+        x = pos[:,0] - p.x
+        y = pos[:,1] - p.y
+        s,sx,sy = self.getSag(x,y)
+        blocked = ~(x*x + y*y <= self.maxRadius*self.maxRadius)     # Blocked by max radius, or NaN
+        normals = np.column_stack((-sx,-sy,np.ones(len(d))))
+        normals /= np.sqrt(sx*sx + sy*sy + 1.0)[:,np.newaxis]
+        normals[blocked] = np.nan
+
+        residual = np.abs(pos[:,2] - p.z - s)
+        self.newtonIterations = iterations
+        self.newtonFailures = int(failures)
+        self.newtonResidual = float(np.max(residual[~np.isnan(residual)],initial = 0.0))
+
+        return d,pos,normals,blocked
+
+
+    def moveToSurface(self,ray,point = None):
+        """
+        In place version of getSurfaceInteraction(), see Surface.moveToSurface(), calculated via getBatchInteraction().
+
+        :param ray: the ray, its position will be updated
+        :type ray: poptics.ray.IntensityRay
+        :param point: the surface reference point in global coordinates if known (Default = None, use getPoint())
+        :type point: Vector3d or None
+        :return: distance,nx,ny,nz as floats
+        """
+        p = self.getPoint() if point == None else point
+        d,nx,ny,nz = self.getRayInteraction(ray,p)
+        if not math.isnan(d):
+            ray.position.x += d*ray.director.x
+            ray.position.y += d*ray.director.y
+            ray.position.z += d*ray.director.z
+        return d,nx,ny,nz
+
+
+    def draw(self,option = None):
+        """
+        Method to draw the y-section of the surface in matplotlib plot.
+        """
+        p = self.getPoint()
+        r = np.linspace(-self.maxRadius,self.maxRadius,2*SurfacePlotPoints + 1)
+        z = self.getSag(np.zeros(len(r)),r)[0]
+        valid = ~np.isnan(z)                   # Ignore impossible surface
+        plot(p.z + z[valid],p.y + r[valid],"k",lw=2.0)           # Plot in black
+
+
+class EvenAsphericSurface(PolynomialSurface):
+    """
+    Class to implement an even aspheric surface, being a quadric with additional terms in r^4, r^6 ... r^16.
+
+    :param pos: the plane reference point
+    :type pos: Vector3d or float
+    :param curve: the curcature.
+    :type curve: float
+    :param epsilon: the quadric parameter, being 1 + conic constant
+    :type epsilon: float
+    :param radius: the maxradius
+    :type radius: float
+    :param coef: the coefficients of r^4, r^6 ... up to r^16
+    :type coef: list of float
+    :param index:  the Refratcive index. If present, surface is refracting, if None it is reflecting.
+    :type index: RefractiveIndex or None
+    """
+
+    def __init__(self, pos, curve, epsilon, radius, coef, index = None):
+        """
+        Constructor
+        """
+        PolynomialSurface.__init__(self,pos,curve,epsilon,radius,index)
+        if len(coef) > 7:
+            raise ValueError("surface.EvenAsphericSurface: maximum of 7 coefficients, given {0:d}".format(len(coef)))
+        self.coef = [float(a) for a in coef]
+
+
+    def __str__(self):
+        """
+        Implement str()
+        """
+        return "spt: {0:s} type: {1:d} c: {2:7.5f} e: {3:7.5f} rad: {4:6.4f} coef: {5:s} n: {6:s}".\
+            format(str(self.point),self.type,self.curvature,self.epsilon,self.maxRadius,str(self.coef),\
+                   str(self.refractiveindex))
+
+    def copy(self):
+        """
+        Form a copy of the surface
+        """
+        return EvenAsphericSurface(self.point,self.curvature,self.epsilon,self.maxRadius,self.coef,\
+                                   self.refractiveindex)
+
+    def scale(self,a):
+        """
+        Scale surface as QuadricSurface.scale(), with the coefficients scaled to keep the same shape.
+
+        :param a:  the scale factor
+        :type a: float
+        """
+        QuadricSurface.scale(self,a)
+        for i in range(len(self.coef)):
+            self.coef[i] *= math.copysign(abs(a)**(-3 - 2*i),a)     # r^(4 + 2i) term
+        return self
+
+    def getPolynomialSag(self,x,y):
+        """
+        Get the sag of the aspheric terms and its derivatives.
+
+        :param x: x positions relative to the reference point
+        :type x: np.ndarray
+        :param y: y positions relative to the reference point
+        :type y: np.ndarray
+        :return: sag, dsag/dx and dsag/dy as np.ndarray
+        """
+        rsqr = x*x + y*y
+        s = np.zeros(rsqr.shape)
+        ds = np.zeros(rsqr.shape)            # d sag / d (r^2)
+        for a in reversed(self.coef):        # Horner in r^2 from r^4 upwards
+            s = (s + a)*rsqr
+        for i,a in reversed(list(enumerate(self.coef))):
+            ds = ds*rsqr + (i + 2)*a
+        s *= rsqr
+        ds *= rsqr
+        return s,2.0*x*ds,2.0*y*ds
+
+
+class XYPolynomialSurface(PolynomialSurface):
+    """
+    Class to implement an XY polynomial freeform surface, being a quadric with additional terms in x^i y^j.
+
+    :param pos: the plane reference point
+    :type pos: Vector3d or float
+    :param curve: the curcature.
+    :type curve: float
+    :param epsilon: the quadric parameter, being 1 + conic constant
+    :type epsilon: float
+    :param radius: the maxradius
+    :type radius: float
+    :param coef: the coefficients keyed by the powers (i,j) of x and y
+    :type coef: dict
+    :param index:  the Refratcive index. If present, surface is refracting, if None it is reflecting.
+    :type index: RefractiveIndex or None
+
+    Terms of second order are not included in the paraxial interaction.
+    """
+
+    def __init__(self, pos, curve, epsilon, radius, coef, index = None):
+        """
+        Constructor
+        """
+        PolynomialSurface.__init__(self,pos,curve,epsilon,radius,index)
+        self.coef = {}
+        for key in coef:
+            i,j = key
+            if i < 0 or j < 0:
+                raise ValueError("surface.XYPolynomialSurface: invalid powers {0:s}".format(str(key)))
+            self.coef[(int(i),int(j))] = float(coef[key])
+
+
+    def __str__(self):
+        """
+        Implement str()
+        """
+        return "spt: {0:s} type: {1:d} c: {2:7.5f} e: {3:7.5f} rad: {4:6.4f} coef: {5:s} n: {6:s}".\
+            format(str(self.point),self.type,self.curvature,self.epsilon,self.maxRadius,str(self.coef),\
+                   str(self.refractiveindex))
+
+    def copy(self):
+        """
+        Form a copy of the surface
+        """
+        return XYPolynomialSurface(self.point,self.curvature,self.epsilon,self.maxRadius,self.coef,\
+                                   self.refractiveindex)
+
+    def scale(self,a):
+        """
+        Scale surface as QuadricSurface.scale(), with the coefficients scaled to keep the same shape.
+
+        :param a:  the scale factor
+        :type a: float
+        """
+        QuadricSurface.scale(self,a)
+        for i,j in self.coef:
+            self.coef[(i,j)] *= math.copysign(abs(a)**(1 - i - j),a)
+        return self
+
+    def getPolynomialSag(self,x,y):
+        """
+        Get the sag of the polynomial terms and its derivatives.
+
+        :param x: x positions relative to the reference point
+        :type x: np.ndarray
+        :param y: y positions relative to the reference point
+        :type y: np.ndarray
+        :return: sag, dsag/dx and dsag/dy as np.ndarray
+        """
+        s = np.zeros(np.shape(x))
+        sx = np.zeros(s.shape)
+        sy = np.zeros(s.shape)
+        for (i,j),a in self.coef.items():
+            s += a*x**i*y**j
+            if i > 0:
+                sx += i*a*x**(i - 1)*y**j
+            if j > 0:
+                sy += j*a*x**i*y**(j - 1)
+        return s,sx,sy
+
+
+class CoordinateBreak(Surface):
+    """
+    Class to implement a coordinate break that tilts and decenters the surfaces that follow it, up to a matching
+    CoordinateReturn. The following surfaces are rotated about the reference point of the break, first about the x, then
+    the y and then the z axis, and then shifted by the decenter. Rays are traced through them by transforming the rays into
+    the local coordinates of the tilted surfaces, with the rotation matrix and its inverse calculated once when the tilt is set,
+    so a whole RayBundle is transformed with a single matrix multiply.
+
+    :param pos: the reference point of the break (Default = 0.0)
+    :type pos: Vector3d or float
+    :param decenter: the decenter in x/y (Default = None, no decenter)
+    :type decenter: Vector2d or None
+    :param xtilt: the tilt about the x-axis in radians (Default = 0.0)
+    :type xtilt: float
+    :param ytilt: the tilt about the y-axis in radians (Default = 0.0)
+    :type ytilt: float
+    :param ztilt: the tilt about the z-axis in radians (Default = 0.0)
+    :type ztilt: float
+
+    Between the break and its return the ray positions and directors are in the local coordinates of the tilted surfaces.
+    """
+
+    def __init__(self,pos = 0.0, decenter = None, xtilt = 0.0, ytilt = 0.0, ztilt = 0.0):
+        """
+        Constructor
+        """
+        Surface.__init__(self,pos,Break)
+        self.setDecenter(decenter)
+        self.setTilt(xtilt,ytilt,ztilt)
+
+
+    def __str__(self):
+        """
+        Implement str()
+        """
+        return "spt: {0:s} type: {1:d} decenter: {2:s} tilt: ({3:7.5f}, {4:7.5f}, {5:7.5f})".\
+            format(str(self.point),self.type,str(self.decenter),self.xtilt,self.ytilt,self.ztilt)
+
+    def copy(self):
+        """
+        Make a copy
+        """
+        return CoordinateBreak(self.point,self.decenter,self.xtilt,self.ytilt,self.ztilt)
+
+
+    def setDecenter(self,decenter = None):
+        """
+        Set the decenter of the following surfaces.
+
+        :param decenter: the decenter in x/y (Default = None, no decenter)
+        :type decenter: Vector2d or None
+        :return: self
+        """
+        if decenter == None:
+            self.decenter = Vector2d()
+        else:
+            self.decenter = Vector2d(decenter)
+        self.shift = np.array([self.decenter.x,self.decenter.y,0.0])
+        return self
+
+
+    def setTilt(self,xtilt = None, ytilt = None, ztilt = None):
+        """
+        Set the tilts of the following surfaces and calculate the rotation matrix and its inverse.
+
+        :param xtilt: tilt about the x-axis in radians (Default = None, keep the current value)
+        :type xtilt: float
+        :param ytilt: tilt about the y-axis in radians (Default = None, keep the current value)
+        :type ytilt: float
+        :param ztilt: tilt about the z-axis in radians (Default = None, keep the current value)
+        :type ztilt: float
+        :return: self
+        """
+        if xtilt != None:
+            self.xtilt = float(xtilt)
+        if ytilt != None:
+            self.ytilt = float(ytilt)
+        if ztilt != None:
+            self.ztilt = float(ztilt)
+
+        #      Columns are the x/y/z axis of the tilted surfaces, the same rotations as Vector3d.rotateAboutX/Y/Z
+        cx,sx = math.cos(self.xtilt),math.sin(self.xtilt)
+        cy,sy = math.cos(self.ytilt),math.sin(self.ytilt)
+        cz,sz = math.cos(self.ztilt),math.sin(self.ztilt)
+        rx = np.array([[1.0,0.0,0.0],[0.0,cx,sx],[0.0,-sx,cx]])
+        ry = np.array([[cy,0.0,-sy],[0.0,1.0,0.0],[sy,0.0,cy]])
+        rz = np.array([[cz,sz,0.0],[-sz,cz,0.0],[0.0,0.0,1.0]])
+        self.rotation = rz @ ry @ rx              # Rotation of the surfaces acting on column vectors
+        self.inverse = self.rotation.T
+        return self
+
+
+    def getAxis(self):
+        """
+        Get the axis of the tilted and decentered surfaces in global coordinates.
+
+        :return: Axis3d with origin at the decentered reference point.
+        """
+        p = self.getPoint()
+        origin = Vector3d(p.x + self.decenter.x,p.y + self.decenter.y,p.z)
+        return Axis3d(origin,[Unit3d(list(self.rotation[:,i])) for i in range(3)])
+
+
+    def getMatrix(self,reverse = False):
+        """
+        Get the matrix that acts on row vectors to transform directors into the local coordinates, so v_local = v @ matrix.
+
+        :param reverse: if True get the matrix from the local back to global coordinates (Default = False)
+        :type reverse: bool
+        :return: np.ndarray (3,3)
+        """
+        if reverse:
+            return self.inverse
+        else:
+            return self.rotation
+
+
+    def transform(self,positions,directors,point = None,reverse = False):
+        """
+        Transform arrays of ray positions and directors in place into the local coordinates of the following
+        surfaces, or back if reverse is True.
+
+        :param positions: the ray positions
+        :type positions: np.ndarray (N,3)
+        :param directors: the ray directors
+        :type directors: np.ndarray (N,3)
+        :param point: the reference point of the break in global coordinates if known (Default = None, use getPoint())
+        :type point: Vector3d or None
+        :param reverse: transform from the local to global coordinates (Default = False)
+        :type reverse: bool
+        :return: positions, directors
+        """
+        p = self.getPoint() if point == None else point
+        p = np.array([p.x,p.y,p.z])
+        m = self.getMatrix(reverse)
+        if reverse:
+            positions[:] = (positions - p) @ m + p + self.shift
+        else:
+            positions[:] = (positions - p - self.shift) @ m + p
+        directors[:] = directors @ m
+        return positions,directors
+
+
+    def transformRay(self,ray,point = None,reverse = False):
+        """
+        Transform a single ray in place, see transform().
+
+        :param ray: the ray
+        :type ray: poptics.ray.IntensityRay
+        :param point: the reference point of the break in global coordinates if known (Default = None, use getPoint())
+        :type point: Vector3d or None
+        :param reverse: transform from the local to global coordinates (Default = False)
+        :type reverse: bool
+        :return: True
+        """
+        r = ray.position
+        u = ray.director
+        pos,dirn = self.transform(np.array([[r.x,r.y,r.z]]),np.array([[u.x,u.y,u.z]]),point,reverse)
+        r.x,r.y,r.z = pos[0].tolist()
+        u.x,u.y,u.z = dirn[0].tolist()
+        return True
+
+
+    def getParaxialInteraction(self,ray):
+        """
+        Get the paraxial interaction, being a clear plane as paraxial rays are not affected by tilts and decenters.
+        """
+        p = self.getPoint()
+        distance = p.z - ray.z
+        height = ray.h + distance*ray.u
+        return [Clear,distance,height,0.0,None]
+
+    def getBatchParaxialInteraction(self,z,h,u):
+        """
+        Get the paraxial interaction for arrays of paraxial rays, being a clear plane, see getParaxialInteraction().
+        """
+        p = self.getPoint()
+        distance = p.z - z
+        height = h + distance*u
+        return distance,height,np.zeros(height.size)
+
+
+    def draw(self,option = None):
+        """
+        A coordinate break is not drawn.
+        """
+        return None
+
+
+class CoordinateReturn(CoordinateBreak):
+    """
+    Class to implement the return from a CoordinateBreak, transforming the rays back into global coordinates.
+
+    :param pos: the reference point, this only sets the location in the group as the transform uses the point of the break.
+    :type pos: Vector3d or float
+    :param brk: the coordinate break being returned from.
+    :type brk: CoordinateBreak
+    """
+
+    def __init__(self,pos,brk):
+        """
+        Constructor
+        """
+        Surface.__init__(self,pos,Break)
+        self.coordinateBreak = brk
+
+
+    def __str__(self):
+        """
+        Implement str()
+        """
+        return "spt: {0:s} type: {1:d} return from: {2:s}".format(str(self.point),self.type,str(self.coordinateBreak))
+
+    def copy(self):
+        """
+        Make a copy, which returns from the same break.
+        """
+        return CoordinateReturn(self.point,self.coordinateBreak)
+
+    def setDecenter(self,decenter = None):
+        """
+        Set the decenter of the break being returned from.
+        """
+        self.coordinateBreak.setDecenter(decenter)
+        return self
+
+    def setTilt(self,xtilt = None, ytilt = None, ztilt = None):
+        """
+        Set the tilts of the break being returned from.
+        """
+        self.coordinateBreak.setTilt(xtilt,ytilt,ztilt)
+        return self
+
+    def getAxis(self):
+        """
+        Get the axis of the break being returned from.
+        """
+        return self.coordinateBreak.getAxis()
+
+    def getMatrix(self,reverse = False):
+        """
+        Get the matrix, being the reverse of that of the break.
+        """
+        return self.coordinateBreak.getMatrix(not reverse)
+
+    def transform(self,positions,directors,point = None,reverse = False):
+        """
+        Transform arrays of ray positions and directors in place back into global coordinates, using the point of the break.
+        """
+        return self.coordinateBreak.transform(positions,directors,None,not reverse)
@@ -16,6 +16,7 @@ class Vector2d(object):
     :param y: y component (Default = 0.0)
     :type y: float
     """
+    __slots__ = ("x","y")              # Fixed components, no per-instance __dict__
 
     def __init__(self, x=0.0, y=0.0):
         """
@@ -31,6 +32,23 @@ class Vector2d(object):
             self.x = float(x)         # Force to floats
             self.y = float(y)
 
+    @classmethod
+    def fromFloats(cls, x, y):
+        """
+        Fast constructor from two floats that does no type checking or conversion,
+        use where the components are known to be floats.
+
+        :param x: x component
+        :type x: float
+        :param y: y component
+        :type y: float
+        :return: new Vector2d
+        """
+        v = cls.__new__(cls)
+        v.x = x
+        v.y = y
+        return v
+
     def set(self, x=0.0, y=0.0):
         """
         Method to set componets of the vector in various formats.
@@ -100,7 +118,7 @@ class Vector2d(object):
 
         :return: copy of current Vector2d
         """
-        return Vector2d(self)
+        return Vector2d.fromFloats(self.x,self.y)
 
 
 
@@ -574,6 +592,7 @@ class Vector3d(object):
     will not be accessed.
 
     """
+    __slots__ = ("x","y","z")          # Fixed components, no per-instance __dict__
     #
     #
     def __init__(self,x = 0.0, y = 0.0, z = 0.0):
@@ -591,6 +610,27 @@ class Vector3d(object):
             self.z = float(z)
 
 
+    @classmethod
+    def fromFloats(cls,x,y,z):
+        """
+        Fast constructor from three floats that does no type checking or conversion, use
+        where the components are known to be floats. When called as Unit3d.fromFloats() the
+        components are NOT normalised, so use .normalise() if needed.
+
+        :param x: x component
+        :type x: float
+        :param y: y component
+        :type y: float
+        :param z: z component
+        :type z: float
+        :return: new Vector3d (or Unit3d)
+        """
+        v = cls.__new__(cls)
+        v.x = x
+        v.y = y
+        v.z = z
+        return v
+
 
     def set(self,x = 0.0 , y = 0.0, z = 0.0):
         """
@@ -675,7 +715,7 @@ class Vector3d(object):
         :return: deep copy current Vector3d
 
         """
-        return Vector3d(self)
+        return Vector3d.fromFloats(self.x,self.y,self.z)
     #
     #
     def polar(self):
@@ -827,7 +867,7 @@ class Vector3d(object):
         Implement the __neg__ method to return a new vector being the -ve of the current.
         Note current not changed.
         """
-        return Vector3d(-self.x,-self.y,-self.z)
+        return Vector3d.fromFloats(-self.x,-self.y,-self.z)
 
     #
     #
@@ -1051,7 +1091,7 @@ class Vector3d(object):
         returns new Vector3d
         """
         if isinstance(b,Vector3d):
-            return Vector3d(self.x + b.x, self.y + b.y, self.z + b.z)
+            return Vector3d.fromFloats(self.x + b.x, self.y + b.y, self.z + b.z)
         else:
             return Vector3d(self.x + b , self.y + b, self.z + b)
     #
@@ -1062,7 +1102,7 @@ class Vector3d(object):
         returns new Vector3d
         """
         if isinstance(b,Vector3d):
-            return Vector3d(self.x + b.x, self.y + b.y, self.z + b.z)
+            return Vector3d.fromFloats(self.x + b.x, self.y + b.y, self.z + b.z)
         else:
             return Vector3d(self.x + b , self.y + b, self.z + b)
 
@@ -1075,7 +1115,7 @@ class Vector3d(object):
         returns new Vector3d
         """
         if isinstance(b,Vector3d):
-            return Vector3d(self.x - b.x, self.y - b.y, self.z - b.z)
+            return Vector3d.fromFloats(self.x - b.x, self.y - b.y, self.z - b.z)
         else:
             return Vector3d(self.x - b , self.y - b, self.z - b)
     #
@@ -1087,7 +1127,7 @@ class Vector3d(object):
         returns new Vector3d
         """
         if isinstance(b,Vector3d):
-            return Vector3d(b.x - self.x, b.y - self.y, b.z - self.z)
+            return Vector3d.fromFloats(b.x - self.x, b.y - self.y, b.z - self.z)
         else:
             return Vector3d(b - self.x , b - self.y, b - self.z)
     #
@@ -1147,7 +1187,8 @@ class Vector3d(object):
         :return: new Vector3d
 
         """
-        return Vector3d(self.x + d*u.x , self.y + d*u.y, self.z + d*u.z)
+        d = float(d)
+        return Vector3d.fromFloats(self.x + d*u.x , self.y + d*u.y, self.z + d*u.z)
 
     def dot(self,b):
         """
@@ -1169,7 +1210,7 @@ class Vector3d(object):
         tx = self.y*b.z - self.z*b.y
         ty = self.z*b.x - self.x*b.z
         tz = self.x*b.y - self.y*b.x
-        return Vector3d(tx,ty,tz)
+        return Vector3d.fromFloats(tx,ty,tz)
 
 
 
@@ -1300,6 +1341,7 @@ class Unit3d(Vector3d):
     Note if (0,0,0) or () suppled, the Unit3d will be set to inValid.
 
     """
+    __slots__ = ()
 
     def __init__(self, x = 0.0, y = 0.0, z = 0.0):
         """
@@ -1412,7 +1454,7 @@ class Unit3d(Vector3d):
         """
         Return copy of current Unit3d.
         """
-        return Unit3d(self)
+        return Unit3d.fromFloats(self.x,self.y,self.z)
 
 
     def random(self):
@@ -1521,6 +1563,7 @@ class Angle(object):
 
     Note all angles in radians.
     """
+    __slots__ = ("theta","psi")        # Fixed components, no per-instance __dict__
 
     def __init__(self,theta = 0.0,psi = 0.0):
         """
@@ -1548,6 +1591,23 @@ class Angle(object):
         else:                                          # Finally two floats
             self.theta = float(theta)
             self.psi = float(psi)
+
+    @classmethod
+    def fromFloats(cls,theta,psi):
+        """
+        Fast constructor from two floats that does no type checking or conversion,
+        use where the angles are known to be floats.
+
+        :param theta: the theta angle wrt to z-axis in radians
+        :type theta: float
+        :param psi: the psi angle wrt to y-axis in radians
+        :type psi: float
+        :return: new Angle
+        """
+        a = cls.__new__(cls)
+        a.theta = theta
+        a.psi = psi
+        return a
     #
     #
     def __str__(self):
@@ -760,25 +760,59 @@ class Sellmeier(InfoIndex):
 class GradedIndex(RefractiveIndex):
     """
     Class to implement a graded index with a underlying base index and a radially symmeetric variation
-    that depend on radial distance from an origin.
+    that depend on radial distance from an origin, being n = base*(c0 + c1 r^2 + c2 r^4 + ...)
+
+    :param pt: two dimensional point giving the location of the origin in global coordinates, or relative to group if given
+    :type pt: Vector2d or list
+    :param index: the base refractive index
+    :type index: RefractiveIndex
+    :param coef: coefficients of the radial polynomial in the form 1,r^2,r^4 ....
+    :type coef: list of floats
+    :param group: OpticalGroup the origin is relative to, so the index moves with the group (Default = None)
+    :type group: poptics.lens.OpticalGroup or None
+
+    Rays are propagated through the medium by poptics.ray.propagateGradedIndex().
     """
 
-    def __init__(self,pt,index,coef):
+    def __init__(self,pt,index,coef,group = None):
         """
         param pt, two dimensional point giving the location of the origin,
         param index, the base refrative index
         param coef the for radial polynomial if form 1,r^2,r^4 .... as a list of floats.
         """
+        RefractiveIndex.__init__(self)
         self.point = Vector2d(pt)
         self.index = index
         self.coef = list(coef)
+        self.group = group
+        self.title = "grin " + str(index.title)
 
 
     def copy(self):
         """
         Make fully copy
         """
-        return GradedIndex(self.point,self.index.copy(),self.coef)
+        return GradedIndex(self.point,self.index.copy(),self.coef,self.group)
+
+    def getOrigin(self):
+        """
+        Get the origin in global coordinates, taking account of the group point if the origin is relative to
+        an OpticalGroup, so it follows the group when moved.
+
+        :return: Vector2d the origin in global coordinates
+        """
+        if self.group == None:
+            return self.point
+        p = self.group.point
+        if self.group.group != None:
+            p = self.group.group.point + p
+        return Vector2d(self.point.x + p.x,self.point.y + p.y)
+
+    def __str__(self):
+        """
+        Implement str() to give the origin and coefficients.
+        """
+        return "pt : {0:s} coef : {1:s}".format(str(self.point),str(self.coef))
 
     def __repr__(self):
         return "wavelength.GradedIndex: pt : {0:s} coef : {1:s}\n base : {2:s}".format(str(self.point),\
@@ -794,45 +828,91 @@ class GradedIndex(RefractiveIndex):
         base = self.index.getValue(ray_or_wave)
         if hasattr(ray_or_wave,"position"):    # Its a ray
             p = ray_or_wave.position
-            dx = p.x - self.point.x
-            dy = p.y - self.point.y
+            o = self.getOrigin()
+            dx = p.x - o.x
+            dy = p.y - o.y
             rsqr = dx*dx + dy*dy
             r = 1.0
             weight = self.coef[0]
             for c in self.coef[1:]:
                 r *= rsqr
                 weight += c*r
-                return base*weight
+            return base*weight
         else:
             return base                       # its a scalar
 
 
-
-
-
     def getGradient(self,ray):
         """
         Method to calcualte the Gradient as specifed ray position
+
+        :param ray: the ray
+        :type ray: poptics.ray.IntensityRay
+        :return: Vector3d the gradient of the index
         """
         p = ray.position
 
         n = self.index.getValue(ray)
 
-        x = p.x - self.point.x
-        y = p.y - self.point.y
+        o = self.getOrigin()
+        x = p.x - o.x
+        y = p.y - o.y
         rsqr = x*x + y*y
 
-        dx = 2*n*x*self.coef[1]
-        dy = 2*n*y*self.coef[1]
+        r = 1.0
+        dw = 0.0                          # Derivative of polynomial wrt r^2
+        for i in range(1,len(self.coef)):
+            dw += i*self.coef[i]*r
+            r *= rsqr
+
+        return Vector3d(2*n*x*dw,2*n*y*dw,0.0)
+
+
+    def getBaseValues(self,wavelengths):
+        """
+        Get the base index for an array of wavelengths, with each distinct wavelength calculated once.
+
+        :param wavelengths: the wavelengths
+        :type wavelengths: np.ndarray
+        :return: np.ndarray of values
         """
-        for i in range(2,len(self.coef)):
-            r = math.pow(rsqr,i-1)
-            dx += 2*x*n*i*coef[i]*r
-            dy += 2*y*n*i*coef[i]*r
+        waves,inverse = np.unique(wavelengths,return_inverse = True)
+        return np.array([self.index.getValue(float(w)) for w in waves])[inverse]
+
+    def getArrayValues(self,positions,wavelengths):
+        """
+        Get the index at arrays of positions, the array version of getValue() with a ray.
+
+        :param positions: the positions in global coordinates
+        :type positions: np.ndarray (N,3)
+        :param wavelengths: the wavelengths
+        :type wavelengths: np.ndarray (N,)
+        :return: (N,) np.ndarray of values
         """
+        o = self.getOrigin()
+        x = positions[:,0] - o.x
+        y = positions[:,1] - o.y
+        return self.getBaseValues(wavelengths)*np.polyval(self.coef[::-1],x*x + y*y)
 
+    def getArrayGradients(self,positions,wavelengths):
+        """
+        Get the index and its gradient at arrays of positions, the array version of getGradient().
 
-        return Vector3d(dx,dy,0.0)
+        :param positions: the positions in global coordinates
+        :type positions: np.ndarray (N,3)
+        :param wavelengths: the wavelengths
+        :type wavelengths: np.ndarray (N,)
+        :return: (N,) np.ndarray of values and (N,3) np.ndarray of gradients
+        """
+        o = self.getOrigin()
+        x = positions[:,0] - o.x
+        y = positions[:,1] - o.y
+        rsqr = x*x + y*y
+        base = self.getBaseValues(wavelengths)
+        dcoef = [i*c for i,c in enumerate(self.coef)][1:]     # Derivative wrt r^2
+        dw = 2.0*base*np.polyval(dcoef[::-1],rsqr) if len(dcoef) > 0 else np.zeros(len(x))
+        gradient = np.column_stack((dw*x,dw*y,np.zeros(len(x))))
+        return base*np.polyval(self.coef[::-1],rsqr),gradient
 
 class Spectrum(WaveLength):
     """